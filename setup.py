@@ -58,6 +58,8 @@ setup(
             'exec = sio.executors.executor:run',
             'sio2jail-exec = sio.executors.sio2jail_exec:run',
             'vcpu-exec = sio.executors.vcpu_exec:run',
+            'sio2jail-batch-exec = sio.executors.sio2jail_exec:run_batch',
+            'vcpu-batch-exec = sio.executors.vcpu_exec:run_batch',
             'cpu-exec = sio.executors.executor:run',
             'unsafe-exec = sio.executors.unsafe_exec:run',
             'ingen = sio.executors.ingen:run',
@@ -1 +1,7 @@
-__import__('pkg_resources').declare_namespace(__name__)
+# Importing pkg_resources takes a large part of the startup time of the
+# command line tools, so it is used only if something has already loaded it.
+import sys
+if 'pkg_resources' in sys.modules:
+    sys.modules['pkg_resources'].declare_namespace(__name__)
+else:
+    __path__ = __import__('pkgutil').extend_path(__path__, __name__)
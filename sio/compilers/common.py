@@ -2,11 +2,10 @@
 from __future__ import absolute_import
 import os.path
 import logging
-from zipfile import ZipFile
 
 from sio.workers import ft
-from sio.workers.executors import UnprotectedExecutor, PRootExecutor
-from sio.workers.util import replace_invalid_UTF, tempcwd
+from sio.workers.executors import UnprotectedExecutor, get_chroot_executor
+from sio.workers.util import replace_invalid_UTF, tempcwd, timed
 import six
 
 logger = logging.getLogger(__name__)
@@ -14,6 +13,7 @@ logger = logging.getLogger(__name__)
 DEFAULT_COMPILER_TIME_LIMIT = 30000  # in ms
 DEFAULT_COMPILER_MEM_LIMIT = 512 * 2**10  # in KiB
 DEFAULT_COMPILER_OUTPUT_LIMIT = 5 * 2**10  # in KiB
+DEFAULT_COMPILER_OUTPUT_LIMIT_ACTION = 'drain'
 
 
 def _lang_option(environ, key, lang):
@@ -26,6 +26,7 @@ def _lang_option(environ, key, lang):
 
 
 def _extract_all(archive_path):
+    from zipfile import ZipFile
     target_path = tempcwd()
     with ZipFile(tempcwd(archive_path), 'r') as zipf:
         for name in zipf.namelist():
@@ -61,10 +62,10 @@ class Compiler(object):
         if sandbox is not None:
             self.sandbox = sandbox
 
+    def _make_executor(self):
         if self.sandbox is None:
-            self.executor = UnprotectedExecutor()
-        else:
-            self.executor = PRootExecutor('compiler-' + self.sandbox)
+            return UnprotectedExecutor()
+        return get_chroot_executor('compiler-' + self.sandbox, self.environ)
 
     def compile(self, environ):
         """
@@ -86,8 +87,10 @@ class Compiler(object):
         self.extra_compilation_args = \
                 _lang_option(environ, 'extra_compilation_args', self.lang)
 
+        self.executor = self._make_executor()
         with self.executor as executor:
-            renv = self._run_in_executor(executor)
+            with timed('compile'):
+                renv = self._run_in_executor(executor)
 
         return self._postprocess(renv)
 
@@ -136,6 +139,7 @@ class Compiler(object):
                 time_limit=DEFAULT_COMPILER_TIME_LIMIT,
                 mem_limit=DEFAULT_COMPILER_MEM_LIMIT,
                 output_limit=DEFAULT_COMPILER_OUTPUT_LIMIT,
+                output_limit_action=DEFAULT_COMPILER_OUTPUT_LIMIT_ACTION,
                 ignore_errors=True,
                 environ=self.tmp_environ,
                 environ_prefix='compilation_',
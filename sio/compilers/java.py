@@ -9,6 +9,10 @@ class JavaCompiler(UnsafeJavaCompiler):
         kwargs['proot_options'] = ['-b', '/proc']
         return super(JavaCompiler, self)._execute(*args, **kwargs)
 
+    def _popen(self, *args, **kwargs):
+        kwargs['proot_options'] = ['-b', '/proc']
+        return super(JavaCompiler, self)._popen(*args, **kwargs)
+
 
 def run(environ):
     return JavaCompiler(sandbox='java.1_8').compile(environ)
@@ -0,0 +1,439 @@
+"""Persistent ``javac`` compile server.
+
+Starting a JVM and loading ``javac`` takes most of the time needed to compile
+a typical solution. When enabled, Java compilers keep one JVM per sandbox
+alive for the lifetime of the worker and compile sources in it through
+``javax.tools``, building the jar in the same process. The server sees only
+its own directory, into which the files of each job are copied for the time
+of the compilation. If the server cannot be started, misbehaves or dies,
+compilation falls back to running ``javac`` and ``jar`` as separate
+processes.
+
+The server is enabled by setting ``SIO_JAVA_COMPILE_SERVER=1`` in the
+worker's environment or ``java_compile_server`` in the job's ``environ``.
+"""
+from __future__ import absolute_import
+import atexit
+import errno
+import logging
+import os
+import select
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+from sio.workers.util import PerfTimer, ms2s, s2ms, tempcwd
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('SIO_JAVA_COMPILE_SERVER', '') not in ('', '0')
+#: Number of compilations after which the server is restarted, so that
+#: the JVM does not grow indefinitely.
+MAX_COMPILATIONS = int(os.environ.get('SIO_JAVA_COMPILE_SERVER_MAX_COMPILATIONS',
+                                      500))
+STARTUP_TIMEOUT = 60000  # in ms
+#: Time for which a sandbox is not retried after its server failed to start.
+RETRY_INTERVAL = 600  # in s
+#: Compiler output reported when a compilation exceeds its time limit.
+TIME_LIMIT_EXCEEDED = b'Compilation time limit exceeded.'
+
+SERVER_CLASS = 'SioCompileServer'
+SERVER_SOURCE = r'''
+import java.io.*;
+import java.lang.management.ManagementFactory;
+import java.lang.management.ThreadMXBean;
+import java.util.Arrays;
+import java.util.jar.*;
+import javax.tools.JavaCompiler;
+import javax.tools.ToolProvider;
+
+public class SioCompileServer {
+    static final long STACK_SIZE = 32L << 20;
+    static final long POLL_INTERVAL = 10;  // in ms
+
+    public static void main(String[] argv) throws Exception {
+        BufferedReader in = new BufferedReader(
+                new InputStreamReader(System.in, "UTF-8"));
+        OutputStream out = new BufferedOutputStream(
+                new FileOutputStream(FileDescriptor.out));
+        // Nothing but responses may ever reach the real stdout.
+        System.setOut(System.err);
+
+        final JavaCompiler javac = ToolProvider.getSystemJavaCompiler();
+        if (javac == null) {
+            System.exit(1);
+        }
+        final ThreadMXBean threads = ManagementFactory.getThreadMXBean();
+        out.write("ready\n".getBytes("UTF-8"));
+        out.flush();
+
+        String jar;
+        while ((jar = in.readLine()) != null) {
+            long timeLimit = Long.parseLong(in.readLine());
+            int argc = Integer.parseInt(in.readLine());
+            final String[] args = new String[argc];
+            for (int i = 0; i < argc; i++) {
+                args[i] = in.readLine();
+            }
+            final String jarPath = jar;
+            final ByteArrayOutputStream log = new ByteArrayOutputStream();
+            final int[] rc = {1};
+            final long[] timeUsed = {0};
+            final boolean[] exit = {false};
+            Thread worker = new Thread(null, new Runnable() {
+                public void run() {
+                    try {
+                        rc[0] = javac.run(null, log, log, args);
+                        if (rc[0] == 0) {
+                            makeJar(jarPath);
+                        }
+                    } catch (Throwable e) {
+                        // The heap may be left unusable, start afresh.
+                        exit[0] = e instanceof OutOfMemoryError;
+                        e.printStackTrace(new PrintStream(log, true));
+                        rc[0] = 1;
+                    } finally {
+                        timeUsed[0] = threads.getCurrentThreadCpuTime()
+                                / 1000000;
+                    }
+                }
+            }, "javac", STACK_SIZE);
+            worker.start();
+
+            long used = 0;
+            while (worker.isAlive() && (timeLimit <= 0 || used <= timeLimit)) {
+                worker.join(POLL_INTERVAL);
+                used = threads.getThreadCpuTime(worker.getId()) / 1000000;
+            }
+
+            // A compilation exceeding the time limit cannot be stopped,
+            // so the server exits after reporting it.
+            int code = 1;
+            boolean exiting = true;
+            byte[] data = new byte[0];
+            if (!worker.isAlive()) {
+                code = rc[0];
+                used = timeUsed[0];
+                exiting = exit[0];
+                data = log.toByteArray();
+            }
+
+            out.write((code + "\n" + used + "\n" + (exiting ? 1 : 0) + "\n"
+                       + data.length + "\n").getBytes("UTF-8"));
+            out.write(data);
+            out.flush();
+            if (exiting) {
+                Runtime.getRuntime().halt(0);
+            }
+        }
+    }
+
+    static void makeJar(String jar) throws IOException {
+        File dir = new File(jar).getAbsoluteFile().getParentFile();
+        File[] classes = dir.listFiles(new FilenameFilter() {
+            public boolean accept(File d, String name) {
+                return name.endsWith(".class");
+            }
+        });
+        Arrays.sort(classes);
+
+        Manifest manifest = new Manifest();
+        manifest.getMainAttributes().put(Attributes.Name.MANIFEST_VERSION,
+                                         "1.0");
+        JarOutputStream jos = new JarOutputStream(new FileOutputStream(jar),
+                                                  manifest);
+        byte[] buf = new byte[65536];
+        try {
+            for (File f : classes) {
+                jos.putNextEntry(new JarEntry(f.getName()));
+                InputStream is = new FileInputStream(f);
+                try {
+                    int n;
+                    while ((n = is.read(buf)) > 0) {
+                        jos.write(buf, 0, n);
+                    }
+                } finally {
+                    is.close();
+                }
+                jos.closeEntry();
+            }
+        } finally {
+            jos.close();
+        }
+    }
+}
+'''
+
+
+class CompileServerError(RuntimeError):
+    pass
+
+
+class CompileServerTimeout(CompileServerError):
+    pass
+
+
+def _relocate(path, old, new):
+    """Returns ``path`` with directory ``old`` replaced by ``new``.
+
+       >>> _relocate('/tmp/job/a.java', '/tmp/job', '/srv/1')
+       '/srv/1/a.java'
+       >>> _relocate('-g', '/tmp/job', '/srv/1')
+       '-g'
+    """
+    if path == old or path.startswith(old + os.sep):
+        return new + path[len(old):]
+    return path
+
+
+class CompileServer(object):
+    """A single ``javac`` server process.
+
+       The protocol is line-based. The request consists of the path of the
+       jar to create, the CPU time limit in ms (``0`` for none), the number
+       of ``javac`` arguments and the arguments themselves, one per line.
+       The response is the return code, the CPU time used in ms, ``1`` if
+       the server exits after the response (``0`` otherwise), the length of
+       the compiler output and the output itself.
+
+       The JVM heap is limited to ``mem_limit`` KiB.
+    """
+
+    def __init__(self, key, mem_limit):
+        self.key = key
+        self.mem_limit = mem_limit
+        self.lock = threading.Lock()
+        self.compilations = 0
+        self.executor = None
+        self.process = None
+        self.dir = None
+        self.exiting = False
+        self._buffer = b''
+
+    def start(self, compiler, executor):
+        """Starts the server in ``executor``, which has to be entered.
+
+           ``compiler`` is used to build the server class, so that it is
+           compiled by the same ``javac`` and with the same limits as
+           solutions.
+        """
+        self.dir = tempfile.mkdtemp(prefix='sioworkers_javac_server_')
+        build_dir = tempcwd('.compile-server')
+        os.mkdir(build_dir)
+        try:
+            source = os.path.join(build_dir, SERVER_CLASS + '.java')
+            with open(source, 'w') as f:
+                f.write(SERVER_SOURCE)
+            renv = compiler._execute(executor,
+                                     ['javac', '-d', build_dir, source])
+            if renv['return_code']:
+                raise CompileServerError('Cannot compile the server: %s'
+                                         % renv['stdout'])
+            for name in os.listdir(build_dir):
+                if name.endswith('.class'):
+                    shutil.copy(os.path.join(build_dir, name), self.dir)
+        finally:
+            shutil.rmtree(build_dir)
+
+        # The server keeps the sandbox locked for its whole lifetime.
+        executor.__enter__()
+        self.executor = executor
+        self.process = compiler._popen(executor,
+                ['java', '-XX:-UsePerfData', '-Xmx%dk' % self.mem_limit,
+                 '-cp', self.dir, SERVER_CLASS],
+                cwd=self.dir, binds=[self.dir])
+        if self._readline(time.time() + ms2s(STARTUP_TIMEOUT)) != b'ready':
+            raise CompileServerError('Unexpected server greeting')
+        logger.info('Started javac server for %s (pid %d)', self.key,
+                    self.process.pid)
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+            self.process.wait()
+            self.process.stdin.close()
+            self.process.stdout.close()
+            self.process = None
+        if self.executor is not None:
+            self.executor.__exit__(None, None, None)
+            self.executor = None
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+
+    def _readline(self, deadline):
+        """Reads a line from the server waiting until ``deadline`` (as
+           returned by :func:`time.time`)."""
+        while b'\n' not in self._buffer:
+            self._fill(deadline)
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line
+
+    def _read(self, size, deadline):
+        while len(self._buffer) < size:
+            self._fill(deadline)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _fill(self, deadline):
+        fd = self.process.stdout.fileno()
+        ready, _, _ = select.select([fd], [], [],
+                                    max(0, deadline - time.time()))
+        if not ready:
+            raise CompileServerTimeout('Timeout while waiting for the server')
+        data = os.read(fd, 65536)
+        if not data:
+            raise CompileServerError('Server exited with code %s'
+                                     % self.process.poll())
+        self._buffer += data
+
+    def compile(self, args, jar, time_limit, real_time_limit,
+                output_limit=None):
+        """Compiles with ``javac args`` and packs the classes into ``jar``.
+
+           The current working directory is copied to a directory of the
+           server for the time of the compilation, paths inside it in
+           ``args``, ``jar`` and the output are translated.
+
+           Returns ``renv`` like the one of an executor, with
+           ``time_used`` exceeding ``time_limit`` ms if the compilation was
+           stopped because of it. Raises :exc:`CompileServerTimeout` if the
+           request is not finished within ``real_time_limit`` ms.
+        """
+        perf_timer = PerfTimer()
+        deadline = time.time() + ms2s(real_time_limit)
+        job_dir = tempcwd()
+        request_dir = tempfile.mkdtemp(dir=self.dir)
+        try:
+            server_dir = os.path.join(request_dir, 'job')
+            shutil.copytree(job_dir, server_dir, symlinks=True)
+            server_jar = _relocate(jar, job_dir, server_dir)
+            args = [_relocate(arg, job_dir, server_dir) for arg in args]
+            request = [server_jar, str(time_limit or 0), str(len(args))] \
+                    + args
+            if any('\n' in arg for arg in request):
+                raise CompileServerError('Arguments cannot contain newlines')
+
+            try:
+                self.process.stdin.write(
+                        ''.join(arg + '\n' for arg in request).encode('utf-8'))
+                self.process.stdin.flush()
+                return_code = int(self._readline(deadline))
+                time_used = int(self._readline(deadline))
+                self.exiting = self._readline(deadline) != b'0'
+                output = self._read(int(self._readline(deadline)), deadline)
+            except (IOError, OSError, ValueError) as e:
+                raise CompileServerError('Server communication failed: %s'
+                                         % e)
+            self.compilations += 1
+
+            if return_code == 0:
+                shutil.copy(server_jar, jar)
+        finally:
+            shutil.rmtree(request_dir, ignore_errors=True)
+
+        output = output.replace(server_dir.encode('utf-8'),
+                                job_dir.encode('utf-8'))
+        truncated = bool(output_limit) and len(output) > output_limit
+        return {
+            'return_code': return_code,
+            'stdout': output[:output_limit] if truncated else output,
+            'output_truncated': truncated,
+            'time_used': time_used,
+            'real_time_used': s2ms(perf_timer.elapsed),
+        }
+
+
+_servers = {}
+_failed = {}
+_servers_lock = threading.Lock()
+
+
+def _acquire(compiler, executor, mem_limit):
+    """Returns a started, locked server for the compiler's sandbox and
+       ``mem_limit``, or None if it is busy or cannot be started now."""
+    key = (compiler.sandbox or 'system', mem_limit)
+    with _servers_lock:
+        server = _servers.get(key)
+        if server is None:
+            if time.time() - _failed.get(key, 0) < RETRY_INTERVAL:
+                return None
+            server = _servers[key] = CompileServer(key, mem_limit)
+            server.lock.acquire()
+        elif not server.lock.acquire(False):
+            return None
+
+    if server.process is None:
+        try:
+            server.start(compiler, executor)
+        except Exception:
+            logger.warning('Cannot start javac server for %s', key,
+                           exc_info=True)
+            _failed[key] = time.time()
+            _discard(server)
+            return None
+    return server
+
+
+def _discard(server):
+    with _servers_lock:
+        if _servers.get(server.key) is server:
+            del _servers[server.key]
+    server.stop()
+    server.lock.release()
+
+
+def compile(compiler, executor, args, jar, time_limit, real_time_limit,
+            mem_limit, output_limit=None):
+    """Compiles using a server for the compiler's sandbox, with the limits
+       of a single ``javac`` run (``mem_limit`` is the heap size in KiB).
+
+       Exceeding the time limits is reported as a compilation failure.
+       Raises :exc:`CompileServerError` if the server is not available
+       or fails, in which case the caller should compile the usual way.
+    """
+    server = _acquire(compiler, executor, mem_limit)
+    if server is None:
+        raise CompileServerError('Server not available')
+
+    perf_timer = PerfTimer()
+    try:
+        renv = server.compile(args, jar, time_limit, real_time_limit,
+                              output_limit)
+    except CompileServerTimeout:
+        _discard(server)
+        return {
+            'return_code': 1,
+            'stdout': TIME_LIMIT_EXCEEDED,
+            'output_truncated': False,
+            'real_time_used': s2ms(perf_timer.elapsed),
+        }
+    except CompileServerError:
+        _discard(server)
+        raise
+
+    if time_limit and renv['time_used'] > time_limit:
+        renv['return_code'] = renv['return_code'] or 1
+        renv['stdout'] = TIME_LIMIT_EXCEEDED
+    if server.exiting or server.compilations >= MAX_COMPILATIONS:
+        _discard(server)
+    else:
+        server.lock.release()
+    return renv
+
+
+def shutdown():
+    """Stops all running servers."""
+    with _servers_lock:
+        servers = list(_servers.values())
+        _servers.clear()
+    for server in servers:
+        server.stop()
+
+atexit.register(shutdown)
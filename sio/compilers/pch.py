@@ -0,0 +1,157 @@
+"""Precompiled headers for C/C++ compilers.
+
+Most contest solutions include the same heavy header (``bits/stdc++.h``),
+which takes the majority of their compilation time. When enabled, compilers
+keep precompiled versions of such headers, one per toolchain version (the
+sandbox hash for sandboxed compilers) and set of compilation options.
+
+A cache entry is a directory with ``bits/stdc++.h.gch`` and a stub
+``bits/stdc++.h`` containing ``#include_next <bits/stdc++.h>``, which is
+put on the include path. If the precompiled header cannot be used (for
+example some macro is defined before the include), GCC silently uses the
+stub, which in turn includes the original header. Entries are made read-only
+once built and compilations using them see only them, bound read-only where
+the executor supports it.
+
+Precompiled headers are enabled by setting ``SIO_PRECOMPILED_HEADERS=1`` in
+the worker's environment or ``use_precompiled_headers`` in the job's
+``environ``. The cache is kept in ``SIO_PRECOMPILED_HEADERS_DIR``
+(``~/.sio-pch`` by default).
+"""
+from __future__ import absolute_import
+import errno
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+from sio.workers.util import rmtree, tempcwd
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('SIO_PRECOMPILED_HEADERS', '') not in ('', '0')
+CACHE_DIR = os.environ.get('SIO_PRECOMPILED_HEADERS_DIR',
+        os.path.expanduser(os.path.join('~', '.sio-pch')))
+
+#: Header precompiled for each language.
+HEADERS = {
+    'cpp': 'bits/stdc++.h',
+}
+
+_LANG_OPTIONS = {
+    'c': 'c-header',
+    'cpp': 'c++-header',
+}
+
+# Options which affect only linking, so they do not need to match.
+_LINK_OPTION_RE = re.compile(r'^(-l.*|-L.*|-Wl,.*|-s|-static)$')
+
+# Cache entries which could not be built in this process.
+_failed = set()
+
+
+def _includes(source, header):
+    pattern = r'^\s*#\s*include\s*[<"]%s[>"]' % re.escape(header)
+    with open(source, 'rb') as f:
+        return re.search(pattern.encode('ascii'), f.read(), re.MULTILINE) \
+                is not None
+
+
+def _hash(value):
+    return hashlib.sha1(repr(value).encode('utf-8')).hexdigest()[:16]
+
+
+def header_options(options):
+    """Filters out compiler ``options`` which do not affect headers."""
+    return [o for o in options if not _LINK_OPTION_RE.match(o)]
+
+
+def _build(compiler, executor, header, options, target):
+    build_dir = tempfile.mkdtemp(prefix='.build-',
+                                 dir=os.path.dirname(target))
+    try:
+        stub = os.path.join(build_dir, header)
+        os.makedirs(os.path.dirname(stub))
+        with open(stub, 'w') as f:
+            f.write('#include_next <%s>\n' % header)
+
+        source = os.path.join(build_dir, 'pch.h')
+        with open(source, 'w') as f:
+            f.write('#include <%s>\n' % header)
+
+        renv = compiler._execute(executor, [compiler.compiler,
+                '-x', _LANG_OPTIONS[compiler.lang]] + options +
+                [source, '-o', stub + '.gch'],
+                proot_options=['-b', build_dir])
+        if renv['return_code']:
+            raise RuntimeError(renv['stdout'])
+        os.unlink(source)
+        _make_read_only(build_dir)
+
+        try:
+            os.rename(build_dir, target)
+        except OSError as e:
+            # Someone else was faster
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+    finally:
+        if os.path.exists(build_dir):
+            rmtree(build_dir)
+
+
+def _make_read_only(directory):
+    for root, _, files in os.walk(directory, topdown=False):
+        for name in files:
+            os.chmod(os.path.join(root, name), 0o444)
+        os.chmod(root, 0o555)
+
+
+def _prune(toolchain_dir, current):
+    """Removes entries for other versions of the toolchain."""
+    for name in os.listdir(toolchain_dir):
+        if name != current:
+            try:
+                rmtree(os.path.join(toolchain_dir, name))
+            except OSError:
+                pass
+
+
+def include_dir(compiler, executor, options, version):
+    """Returns a directory to put on the include path, so that the
+       precompiled header is used, or ``None``.
+
+       The precompiled header is built (using ``executor``, which has to be
+       entered) if it is not cached for the given toolchain ``version``
+       and compiler ``options`` yet.
+    """
+    header = HEADERS.get(compiler.lang)
+    if header is None or version is None or \
+            not _includes(tempcwd(compiler.source_file), header):
+        return None
+
+    options = header_options(options)
+    toolchain_dir = os.path.join(CACHE_DIR, compiler.sandbox or 'system')
+    version_dir = os.path.join(toolchain_dir, _hash(version))
+    target = os.path.join(version_dir,
+                          _hash((compiler.compiler, header, options)))
+    if os.path.isdir(target):
+        return target
+    if target in _failed:
+        return None
+
+    try:
+        if not os.path.isdir(version_dir):
+            try:
+                os.makedirs(version_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            _prune(toolchain_dir, os.path.basename(version_dir))
+        _build(compiler, executor, header, options, target)
+    except Exception:
+        logger.warning('Cannot precompile %s with %s', header, options,
+                       exc_info=True)
+        _failed.add(target)
+        return None
+    return target
@@ -1,9 +1,14 @@
 from __future__ import absolute_import
 import os.path
 
+from sio.compilers import pch
 from sio.compilers.common import Compiler
+from sio.workers.sandbox import get_sandbox
 from sio.workers.util import tempcwd
 
+# Versions of system compilers, by compiler name
+_system_versions = {}
+
 
 class CStyleCompiler(Compiler):
     lang = 'c'
@@ -11,16 +16,43 @@ class CStyleCompiler(Compiler):
     # CStyleCompiler customization
     compiler = 'gcc'  # Compiler to use
     options = []  # Compiler options
+    pch_dir = None  # Precompiled header cache entry used, if any
+
+    def _toolchain_version(self, executor):
+        if self.sandbox is not None:
+            return get_sandbox('compiler-' + self.sandbox).version
+        if self.compiler not in _system_versions:
+            renv = self._execute(executor, [self.compiler, '--version'])
+            if renv['return_code']:
+                return None
+            _system_versions[self.compiler] = renv['stdout']
+        return _system_versions[self.compiler]
+
+    def _run_in_executor(self, executor):
+        self.pch_dir = None
+        if self.environ.get('use_precompiled_headers', pch.ENABLED):
+            self.pch_dir = pch.include_dir(self, executor,
+                    self.options + list(self.extra_compilation_args),
+                    self._toolchain_version(executor))
+        return super(CStyleCompiler, self)._run_in_executor(executor)
 
     def _make_cmdline(self, executor):
         cmdline = [self.compiler, tempcwd(self.source_file),
                     '-o', tempcwd(self.output_file)] + \
                     self.options + list(self.extra_compilation_args)
+        if self.pch_dir:
+            cmdline += ['-I', self.pch_dir]
 
         cmdline.extend(tempcwd(os.path.basename(source))
             for source in self.additional_sources)
         return cmdline
 
+    def _execute(self, executor, cmdline, **kwargs):
+        if self.pch_dir:
+            kwargs.setdefault('read_only_binds', [self.pch_dir])
+        return super(CStyleCompiler, self)._execute(executor, cmdline,
+                                                    **kwargs)
+
 
 class CCompiler(CStyleCompiler):
     compiler = 'gcc'
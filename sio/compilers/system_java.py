@@ -2,10 +2,15 @@
 from __future__ import absolute_import
 import os.path
 import glob
+import logging
 
-from sio.compilers.common import Compiler
+from sio.compilers import java_server
+from sio.compilers.common import Compiler, DEFAULT_COMPILER_TIME_LIMIT, \
+        DEFAULT_COMPILER_MEM_LIMIT, DEFAULT_COMPILER_OUTPUT_LIMIT
 from sio.workers.util import tempcwd
 
+logger = logging.getLogger(__name__)
+
 
 class JavaCompiler(Compiler):
     lang = 'java'
@@ -18,12 +23,22 @@ class JavaCompiler(Compiler):
         self.class_file = '%s.class' % self.class_name
         return '%s.java' % self.class_name
 
-    def _run_in_executor(self, executor):
-        javac = ['javac', '-J-Xss32M'] + list(self.extra_compilation_args) \
-                + [tempcwd(self.source_file)]
-        javac.extend(tempcwd(os.path.basename(source))
+    def _javac_args(self):
+        args = list(self.extra_compilation_args) + [tempcwd(self.source_file)]
+        args.extend(tempcwd(os.path.basename(source))
             for source in self.additional_sources)
+        return args
+
+    def _run_in_executor(self, executor):
+        if self.environ.get('java_compile_server', java_server.ENABLED) and \
+                not any(arg.startswith('-J')
+                        for arg in self.extra_compilation_args):
+            try:
+                return self._run_in_server(executor)
+            except java_server.CompileServerError as e:
+                logger.warning('Falling back to plain javac: %s', e)
 
+        javac = ['javac', '-J-Xss32M'] + self._javac_args()
         renv = self._execute(executor, javac)
         if renv['return_code']:
             return renv
@@ -35,10 +50,25 @@ class JavaCompiler(Compiler):
         renv2['stdout'] = renv['stdout'] + renv2['stdout']
         return renv2
 
+    def _run_in_server(self, executor):
+        time_limit = self.environ.get('compilation_time_limit',
+                                      DEFAULT_COMPILER_TIME_LIMIT)
+        real_time_limit = self.environ.get('compilation_real_time_limit',
+                                           2 * time_limit)
+        mem_limit = self.environ.get('compilation_mem_limit') \
+                or DEFAULT_COMPILER_MEM_LIMIT
+        return java_server.compile(self, executor, self._javac_args(),
+                tempcwd(self.output_file), time_limit, real_time_limit,
+                mem_limit, self.environ.get('compilation_output_limit',
+                                            DEFAULT_COMPILER_OUTPUT_LIMIT))
+
     def _execute(self, executor, cmdline, **kwargs):
         kwargs.setdefault('mem_limit', None)
         return super(JavaCompiler, self)._execute(executor, cmdline, **kwargs)
 
+    def _popen(self, executor, cmdline, **kwargs):
+        return executor.popen(cmdline, **kwargs)
+
     def _postprocess(self, renv):
         environ = super(JavaCompiler, self)._postprocess(renv)
         if environ['result_code'] == 'OK':
@@ -0,0 +1,103 @@
+"""Benchmark of C++ compilation latency with and without precompiled headers.
+
+Usage::
+
+    python -m sio.compilers.test.bench_pch [--sandboxed] [--runs N] [source]
+
+The default source is a typical contest solution including
+``bits/stdc++.h``. Sandboxed compilers need the sandbox to be available
+(it is downloaded on first use). The precompiled header is built before the
+measurement and its build time is reported separately.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import os.path
+import tempfile
+
+from sio.compilers import gcc, pch, system_gcc
+from sio.workers.util import PerfTimer, TemporaryCwd
+
+SOURCE = r'''
+#include <bits/stdc++.h>
+using namespace std;
+
+int main() {
+    int n;
+    cin >> n;
+    vector<long long> v(n);
+    for (auto& x : v) cin >> x;
+    sort(v.begin(), v.end());
+    map<long long, int> cnt;
+    for (auto x : v) ++cnt[x];
+    cout << cnt.size() << endl;
+    return 0;
+}
+'''
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _compile(compiler_class, source, use_pch):
+    with TemporaryCwd():
+        environ = {
+            'source_file': source,
+            'out_file': os.path.join(os.path.dirname(source), 'a.out'),
+            'use_filetracker': False,
+            'use_precompiled_headers': use_pch,
+        }
+        timer = PerfTimer()
+        environ = compiler_class().compile(environ)
+        elapsed = timer.elapsed
+    if environ['result_code'] != 'OK':
+        raise RuntimeError('Compilation failed: %s'
+                           % environ['compiler_output'])
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('source', nargs='?',
+                        help='C++ source file (default: built-in solution)')
+    parser.add_argument('--sandboxed', action='store_true',
+                        help='use the sandboxed compiler instead of g++ '
+                             'from the system')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='number of compilations in each mode')
+    args = parser.parse_args()
+
+    compiler_class = gcc.CPPCompiler if args.sandboxed \
+            else system_gcc.CPPCompiler
+    work_dir = tempfile.mkdtemp(prefix='sio_bench_pch_')
+    source = args.source and os.path.abspath(args.source)
+    if not source:
+        source = os.path.join(work_dir, 'solution.cpp')
+        with open(source, 'w') as f:
+            f.write(SOURCE)
+
+    print('Precompiled headers cache: %s' % pch.CACHE_DIR)
+    print('First compilation with precompiled headers (includes building '
+          'them if needed): %.3fs' % _compile(compiler_class, source, True))
+
+    results = {}
+    for use_pch in (False, True):
+        results[use_pch] = [_compile(compiler_class, source, use_pch)
+                            for _ in range(args.runs)]
+
+    for use_pch, label in ((False, 'without'), (True, 'with')):
+        times = results[use_pch]
+        print('Median compile latency %s precompiled headers: %.3fs '
+              '(min %.3fs, max %.3fs, %d runs)' % (label, _median(times),
+              min(times), max(times), len(times)))
+    print('Speedup: %.2fx' % (_median(results[False]) /
+                              _median(results[True])))
+
+
+if __name__ == '__main__':
+    main()
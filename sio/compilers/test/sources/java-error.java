@@ -0,0 +1,5 @@
+public class java_error {
+    public static void main(String[] args) {
+        System.out.println("Hello World from java")
+    }
+}
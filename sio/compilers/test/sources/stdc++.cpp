@@ -0,0 +1,9 @@
+#include <bits/stdc++.h>
+using namespace std;
+
+int main() {
+    vector<int> v = {5, 3, 9};
+    sort(v.begin(), v.end());
+    cout << "Hello World from " << v[0] << v[1] << v[2] << endl;
+    return 0;
+}
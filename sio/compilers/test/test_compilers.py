@@ -2,10 +2,13 @@ from __future__ import absolute_import
 import glob
 import os.path
 import stat
+import subprocess
 import sys
+import tempfile
 
-from nose.tools import ok_, eq_, timed
+from nose.tools import ok_, eq_, timed, assert_raises
 
+from sio.compilers import java_server
 from sio.compilers.job import run
 from sio.workers import ft
 from filetracker.dummy import DummyClient
@@ -13,7 +16,7 @@ from sio.compilers.common import DEFAULT_COMPILER_OUTPUT_LIMIT, \
         DEFAULT_COMPILER_TIME_LIMIT, DEFAULT_COMPILER_MEM_LIMIT
 from sio.workers.executors import UnprotectedExecutor, PRootExecutor
 from sio.workers.file_runners import get_file_runner
-from sio.workers.util import TemporaryCwd
+from sio.workers.util import TemporaryCwd, tempcwd
 
 # sio2-compilers tests
 #
@@ -323,3 +326,106 @@ def test_compilation_extremes():
 
     for compiler in compilers:
             yield _test, "0", compiler, '/extreme-4.9MB-static-exec.cpp'
+
+def test_java_compile_server():
+    def _test(message, compiler, source):
+        with TemporaryCwd():
+            upload_files()
+            compile_and_run({
+                'source_file': source,
+                'compiler': compiler,
+                'out_file': '/out',
+                'java_compile_server': True,
+                }, message)
+
+    def _test_error(compiler, source):
+        with TemporaryCwd():
+            upload_files()
+            compile_fail({
+                'source_file': source,
+                'compiler': compiler,
+                'out_file': '/out',
+                'java_compile_server': True,
+                }, b'error')
+
+    if NO_JAVA_TESTS:
+        return
+
+    compilers = ['system-']
+    if ENABLE_SANDBOXED_COMPILERS:
+        compilers += ['default-']
+
+    for compiler in compilers:
+        # Twice, so that the second compilation reuses the running server
+        for _ in range(2):
+            yield _test, 'Hello World from java', compiler + 'java', \
+                    '/simple.java'
+        yield _test_error, compiler + 'java', '/java-error.java'
+
+# Speaks the protocol of the javac compile server, see CompileServer.
+FAKE_COMPILE_SERVER = r'''
+import os, sys, time
+while True:
+    jar = sys.stdin.readline().rstrip('\n')
+    if not jar:
+        break
+    time_limit = int(sys.stdin.readline())
+    args = [sys.stdin.readline().rstrip('\n')
+            for _ in range(int(sys.stdin.readline()))]
+    if args[0] == 'sleep':
+        time.sleep(10)
+    # Files of the job have to be copied to the server's directory.
+    rc = int(not args[0].startswith(os.getcwd()))
+    if not rc:
+        with open(jar, 'w') as f:
+            f.write(open(args[0]).read())
+    output = '%s: %d ms\n' % (args[0], time_limit)
+    sys.stdout.write('%d\n0\n0\n%d\n%s' % (rc, len(output), output))
+    sys.stdout.flush()
+'''
+
+def test_java_compile_server_requests():
+    with TemporaryCwd():
+        server = java_server.CompileServer('test', DEFAULT_COMPILER_MEM_LIMIT)
+        server.dir = tempfile.mkdtemp()
+        server.process = subprocess.Popen(
+                [sys.executable, '-c', FAKE_COMPILE_SERVER],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                cwd=server.dir, preexec_fn=os.setpgrp)
+        try:
+            source = tempcwd('a.java')
+            with open(source, 'w') as f:
+                f.write('class a {}')
+            renv = server.compile([source], tempcwd('a.jar'), 1000, 5000)
+            eq_(renv['return_code'], 0)
+            eq_(renv['stdout'], ('%s: 1000 ms\n' % source).encode())
+            eq_(open(tempcwd('a.jar')).read(), 'class a {}')
+            eq_(os.listdir(server.dir), [])
+
+            assert_raises(java_server.CompileServerTimeout, server.compile,
+                          ['sleep'], tempcwd('a.jar'), 1000, 100)
+        finally:
+            server.stop()
+
+def test_precompiled_headers():
+    def _test(message, compiler, source):
+        with TemporaryCwd():
+            upload_files()
+            compile_and_run({
+                'source_file': source,
+                'compiler': compiler,
+                'out_file': '/out',
+                'use_precompiled_headers': True,
+                }, message)
+
+    compilers = ['system-']
+    if ENABLE_SANDBOXED_COMPILERS:
+        compilers += ['default-']
+
+    for compiler in compilers:
+        # The first compilation builds the header, the second one uses it
+        for _ in range(2):
+            yield _test, 'Hello World from 359', compiler + 'cpp', \
+                    '/stdc++.cpp'
+        yield _test, 'Hello World from cpp', compiler + 'cpp', '/simple.cpp'
+        yield _test, 'Hello World from c', compiler + 'c', '/simple.c'
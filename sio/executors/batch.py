@@ -0,0 +1,129 @@
+"""Running many tests of one program in a single job.
+
+Executors counting instructions (:class:`VCPUExecutor`,
+:class:`Sio2JailExecutor`) measure time independently of other processes
+running on the machine, so tests can be run in parallel without affecting
+the results. A batch job runs its tests in up to ``batch_parallelism``
+threads, each with its own working directory, and pins every tested program
+to its thread's CPU. Concurrent tests never share a CPU, and CPUs used by
+fewer tests of other batch jobs in the worker are preferred.
+"""
+from __future__ import absolute_import
+import logging
+import os
+import sys
+import threading
+
+import six
+
+from sio.executors import common
+from sio.workers import ft
+from sio.workers.util import TemporaryCwd, batch_parallelism, \
+        threadlocal_dir
+
+logger = logging.getLogger(__name__)
+
+
+# Number of tests of running batch jobs pinned to each CPU.
+_cpu_users = {}
+_cpu_lock = threading.Lock()
+
+
+def available_cpus():
+    """Returns a sorted list of CPUs this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    import multiprocessing
+    return list(range(multiprocessing.cpu_count()))
+
+
+def _reserve_cpus(count):
+    """Returns ``count`` (at most) distinct available CPUs, the least used
+       by other batch jobs first."""
+    with _cpu_lock:
+        cpus = sorted(available_cpus(),
+                      key=lambda cpu: _cpu_users.get(cpu, 0))[:count]
+        for cpu in cpus:
+            _cpu_users[cpu] = _cpu_users.get(cpu, 0) + 1
+    return cpus
+
+
+def _release_cpus(cpus):
+    with _cpu_lock:
+        for cpu in cpus:
+            _cpu_users[cpu] -= 1
+            if not _cpu_users[cpu]:
+                del _cpu_users[cpu]
+
+
+def _test_environ(environ, test):
+    test_environ = dict((key, value) for key, value in six.iteritems(environ)
+                        if key not in ('tests', 'batch_parallelism',
+                                       'timings'))
+    test_environ.update(test)
+    return test_environ
+
+
+def run(environ, executor_factory, use_sandboxes=True):
+    """Runs the program on all tests from ``environ['tests']``.
+
+       Each test is a dictionary of keys overriding those of ``environ``
+       (usually ``in_file``, ``hint_file``, ``out_file`` and limits) and is
+       run exactly like by :func:`sio.executors.common.run`, using
+       an executor created with ``executor_factory()``.
+
+       At most :func:`sio.workers.util.batch_parallelism` tests, and no more
+       than the number of available CPUs, are run at once, each pinned to
+       a different CPU. Each test gets the full ``exec_mem_limit``, so the
+       job needs that much memory for each of them.
+
+       ``environ['tests']`` is replaced by the list of resulting environs, in
+       the same order.
+    """
+    tests = environ['tests']
+    cpus = _reserve_cpus(batch_parallelism(environ))
+
+    results = [None] * len(tests)
+    errors = []
+    pending = iter(range(len(tests)))
+    lock = threading.Lock()
+    # Filetracker clients are per thread.
+    client = getattr(threadlocal_dir, 'ft_client_instance', None)
+    timings = getattr(threadlocal_dir, 'timings', None)
+
+    def _worker(cpu):
+        if client is not None:
+            ft.set_instance(client)
+        threadlocal_dir.timings = timings
+        while True:
+            with lock:
+                index = next(pending, None)
+                if index is None or errors:
+                    return
+            try:
+                with TemporaryCwd():
+                    results[index] = common.run(
+                            _test_environ(environ, tests[index]),
+                            executor_factory(), use_sandboxes=use_sandboxes,
+                            cpu_affinity=[cpu])
+            except Exception:
+                logger.error('Test %d of the batch failed', index,
+                             exc_info=True)
+                with lock:
+                    errors.append(sys.exc_info())
+                return
+
+    threads = [threading.Thread(target=_worker, args=(cpu,)) for cpu in cpus]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        _release_cpus(cpus)
+
+    if errors:
+        six.reraise(*errors[0])
+
+    environ['tests'] = results
+    return environ
@@ -1,27 +1,71 @@
 from __future__ import absolute_import
+import os
 import os.path
 import logging
+import threading
+from collections import OrderedDict
+from itertools import islice
 
+from sio.executors import memo, persistent_checker
 from sio.workers import ft
 from sio.workers.executors import UnprotectedExecutor, SandboxExecutor, \
-        ExecError, PRootExecutor
-from sio.workers.util import tempcwd
+        ExecError, get_chroot_executor
+from sio.workers.util import tempcwd, timed
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_CHECKER_TIME_LIMIT = 30000  # in ms
 DEFAULT_CHECKER_MEM_LIMIT = 256 * 2**10  # in KiB
 RESULT_STRING_LENGTH_LIMIT = 1024  # in bytes
+DEFAULT_CHECKER_OUTPUT_LIMIT_ACTION = 'drain'
+
+# Number of checker results remembered by the worker process, 0 (the
+# default) disables the cache.
+CACHE_SIZE = int(os.environ.get('SIO_CHECKER_CACHE_SIZE', 0))
 
 class CheckerError(Exception):
     pass
 
+class _ResultCache(object):
+    """Checker results for the most recently checked outputs.
+
+       Keys identify the checker with the files it gets, see
+       :func:`sio.executors.memo.check_key`. Shared by all threads.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            result = self._results.pop(key, None)
+            if result is not None:
+                self._results[key] = result
+                return dict(result)
+        return None
+
+    def put(self, key, result):
+        with self._lock:
+            self._results.pop(key, None)
+            self._results[key] = dict(result)
+            while len(self._results) > self.size:
+                self._results.popitem(False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+_cache = _ResultCache(CACHE_SIZE)
+
 def _run_in_executor(env, command, executor, **kwargs):
     with executor:
         return executor(command,
-            capture_output=True, split_lines=True,
+            capture_output=True, split_lines='lazy',
             mem_limit=DEFAULT_CHECKER_MEM_LIMIT,
             time_limit=DEFAULT_CHECKER_TIME_LIMIT,
+            output_limit_action=DEFAULT_CHECKER_OUTPUT_LIMIT_ACTION,
             environ=env, environ_prefix='checker_', **kwargs)
 
 def _run_diff(env):
@@ -29,13 +73,36 @@ def _run_diff(env):
             UnprotectedExecutor(), extra_ignore_errors=(1,))
     return renv['return_code'] and ['WA'] or ['OK']
 
+def _run_persistent_checker(env, use_sandboxes):
+    sandboxed = env.get('untrusted_checker', False) and use_sandboxes
+    if sandboxed:
+        executor_factory = lambda: get_chroot_executor('null-sandbox', env)
+    else:
+        executor_factory = UnprotectedExecutor
+    return persistent_checker.check(
+            [tempcwd('in'), tempcwd('out'), tempcwd('hint')], tempcwd('chk'),
+            executor_factory,
+            env.get('checker_time_limit', DEFAULT_CHECKER_TIME_LIMIT),
+            env.get('checker_mem_limit', DEFAULT_CHECKER_MEM_LIMIT),
+            key=(sandboxed, env.get('chroot_executor')))
+
 def _run_checker(env, use_sandboxes=False):
+    if env.get('persistent_checker'):
+        try:
+            output = _run_persistent_checker(env, use_sandboxes)
+            if output is not None:
+                return output
+        except persistent_checker.PersistentCheckerError as e:
+            logger.warning('Persistent checker failed, running it the usual '
+                           'way: %s', e)
+
     command = ['./chk', 'in', 'out', 'hint']
 
     def execute_checker(with_stderr=False):
         if env.get('untrusted_checker', False) and use_sandboxes:
             return _run_in_executor(env, command,
-                    PRootExecutor('null-sandbox'), ignore_return=True,
+                    get_chroot_executor('null-sandbox', env),
+                    ignore_return=True,
                     forward_stderr=with_stderr)
         else:
             return _run_in_executor(env, command, UnprotectedExecutor(),
@@ -63,36 +130,67 @@ def _limit_length(s):
         return s[:max(0, RESULT_STRING_LENGTH_LIMIT - len(suffix))] + suffix
     return s
 
+def _result(output):
+    # Only the first three lines of the output are meaningful.
+    output = list(islice(output, 3))
+    while len(output) < 3:
+        output.append('')
+    if output[0] in ('OK', b'OK'):
+        result = {'result_code': 'OK'}
+        if output[1]:
+            result['result_string'] = _limit_length(output[1])
+        result['result_percentage'] = float(output[2] or 100)
+    else:
+        result = {'result_code': 'WA'}
+        result['result_string'] = _limit_length(output[1])
+        result['result_percentage'] = 0
+    return result
+
 def run(environ, use_sandboxes=True):
     ft.download(environ, 'out_file', 'out', skip_if_exists=True)
     ft.download(environ, 'hint_file', 'hint', add_to_cache=True)
+    files = ['out', 'hint']
+    if environ.get('chk_file'):
+        ft.download(environ, 'in_file', 'in', skip_if_exists=True,
+                add_to_cache=True)
+        ft.download(environ, 'chk_file', 'chk', add_to_cache=True)
+        os.chmod(tempcwd('chk'), 0o700)
+        files += ['in', 'chk']
+
+    # Checkers are assumed to be deterministic, so the same output is
+    # checked only once (e.g. for duplicate submissions).
+    use_cache = _cache.size > 0 and environ.get('use_checker_cache', True)
+    use_memo = memo.enabled(environ)
+    key = None
+    if use_cache or use_memo:
+        key = memo.check_key(environ, [tempcwd(f) for f in files],
+                             use_sandboxes)
+        result = use_cache and _cache.get(key)
+        if not result and use_memo:
+            result = memo.load_check(key)
+            if result and use_cache:
+                _cache.put(key, result)
+        if result:
+            environ.update(result)
+            return environ
 
     try:
-        if environ.get('chk_file'):
-            ft.download(environ, 'in_file', 'in', skip_if_exists=True,
-                    add_to_cache=True)
-            ft.download(environ, 'chk_file', 'chk', add_to_cache=True)
-            os.chmod(tempcwd('chk'), 0o700)
-
-            output = _run_checker(environ, use_sandboxes)
-        elif use_sandboxes:
-            output = _run_compare(environ)
-        else:
-            output = _run_diff(environ)
+        with timed('checker'):
+            if environ.get('chk_file'):
+                output = _run_checker(environ, use_sandboxes)
+            elif use_sandboxes:
+                output = _run_compare(environ)
+            else:
+                output = _run_diff(environ)
     except (CheckerError, ExecError) as e:
         logger.error('Checker failed! %s', e)
         logger.error('Environ dump: %s', environ)
         raise SystemError(e)
 
-    while len(output) < 3:
-        output.append('')
-    if output[0] == 'OK':
-        environ['result_code'] = 'OK'
-        if output[1]:
-            environ['result_string'] = _limit_length(output[1])
-        environ['result_percentage'] = float(output[2] or 100)
-    else:
-        environ['result_code'] = 'WA'
-        environ['result_string'] = _limit_length(output[1])
-        environ['result_percentage'] = 0
+    result = _result(output)
+    if use_cache:
+        _cache.put(key, result)
+    if use_memo:
+        memo.store_check(key, result)
+    environ.update(result)
     return environ
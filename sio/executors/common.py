@@ -1,14 +1,18 @@
 from __future__ import absolute_import
+import logging
 import os
 from shutil import rmtree
 from zipfile import ZipFile, is_zipfile
 from sio.workers import ft
-from sio.workers.util import decode_fields, replace_invalid_UTF, tempcwd
+from sio.workers.util import decode_fields, replace_invalid_UTF, tempcwd, \
+        timed
 from sio.workers.file_runners import get_file_runner
 
-from sio.executors import checker
+from sio.executors import checker, memo
 import six
 
+logger = logging.getLogger(__name__)
+
 def _populate_environ(renv, environ):
     """Takes interesting fields from renv into environ"""
     for key in ('time_used', 'mem_used', 'num_syscalls'):
@@ -18,7 +22,7 @@ def _populate_environ(renv, environ):
 
 
 @decode_fields(['result_string'])
-def run(environ, executor, use_sandboxes=True):
+def run(environ, executor, use_sandboxes=True, **kwargs):
     """
     Common code for executors.
 
@@ -28,6 +32,8 @@ def run(environ, executor, use_sandboxes=True):
     :param: executor Executor instance used for executing commands.
     :param: use_sandboxes Enables safe checking output correctness.
                        See `sio.executors.checkers`. True by default.
+    :param: kwargs Additional arguments passed to the executor when running
+                   the program.
     """
     input_name = tempcwd('in')
 
@@ -55,14 +61,28 @@ def run(environ, executor, use_sandboxes=True):
                 raise Exception("Failed to open archive: " + six.text_type(e))
 
         with file_executor as fe:
-            with open(input_name, 'rb') as inf:
-                # Open output file in append mode to allow appending
-                # only to the end of the output file. Otherwise,
-                # a contestant's program could modify the middle of the file.
-                with open(tempcwd('out'), 'ab') as outf:
-                    renv = fe(tempcwd(exe_filename), [],
-                              stdin=inf, stdout=outf, ignore_errors=True,
-                              environ=environ, environ_prefix='exec_')
+            renv = memo_key = None
+            if memo.enabled(environ, executor):
+                memo_key = memo.exec_key(environ, executor,
+                                         tempcwd(exe_filename), input_name)
+                renv = memo.load_exec(memo_key, tempcwd('out'))
+                if renv is not None:
+                    logger.debug('Using memoized results of %s on %s',
+                                 environ['exe_file'], environ['in_file'])
+
+            if renv is None:
+                with open(input_name, 'rb') as inf, timed('exec'):
+                    # Open output file in append mode to allow appending
+                    # only to the end of the output file. Otherwise,
+                    # a contestant's program could modify the middle of
+                    # the file.
+                    with open(tempcwd('out'), 'ab') as outf:
+                        renv = fe(tempcwd(exe_filename), [],
+                                  stdin=inf, stdout=outf, ignore_errors=True,
+                                  environ=environ, environ_prefix='exec_',
+                                  **kwargs)
+                if memo_key and memo.memoizable(renv, environ):
+                    memo.store_exec(memo_key, renv, tempcwd('out'))
 
         _populate_environ(renv, environ)
 
@@ -4,7 +4,7 @@ import os
 import re
 
 from sio.workers import ft
-from sio.workers.executors import UnprotectedExecutor, PRootExecutor
+from sio.workers.executors import UnprotectedExecutor, get_chroot_executor
 from sio.workers.util import tempcwd
 
 logger = logging.getLogger(__name__)
@@ -12,6 +12,7 @@ logger = logging.getLogger(__name__)
 DEFAULT_INGEN_TIME_LIMIT = 600 * 1000  # in ms
 DEFAULT_INGEN_MEM_LIMIT = 256 * 2**10  # in KiB
 DEFAULT_INGEN_OUTPUT_LIMIT = 10 * 2**10  # in B
+DEFAULT_INGEN_OUTPUT_LIMIT_ACTION = 'drain'
 
 def _collect_and_upload(env, path, upload_path, re_string):
     names_re = re.compile(re_string)
@@ -29,6 +30,7 @@ def _run_in_executor(environ, command, executor, **kwargs):
             mem_limit=DEFAULT_INGEN_MEM_LIMIT,
             time_limit=DEFAULT_INGEN_TIME_LIMIT,
             output_limit=DEFAULT_INGEN_OUTPUT_LIMIT,
+            output_limit_action=DEFAULT_INGEN_OUTPUT_LIMIT_ACTION,
             environ=environ, environ_prefix='ingen_', **kwargs)
         if renv['return_code'] == 0:
             _collect_and_upload(renv, tempcwd(),
@@ -38,7 +40,7 @@ def _run_in_executor(environ, command, executor, **kwargs):
 def _run_ingen(environ, use_sandboxes=False):
     command = [tempcwd('ingen')]
     if use_sandboxes:
-        executor = PRootExecutor('null-sandbox')
+        executor = get_chroot_executor('null-sandbox', environ)
     else:
         executor = UnprotectedExecutor()
     return _run_in_executor(environ, command, executor, ignore_errors=True)
@@ -58,8 +60,9 @@ def run(environ):
                                should be uploaded in filetracker
 
        ``use_sandboxes``: if this key equals ``True``, the program is executed
-                        in the PRootExecutor, otherwise the UnsafeExecutor is
-                        used
+                        in the PRootExecutor (or the executor chosen by
+                        ``chroot_executor``), otherwise the UnsafeExecutor
+                        is used
 
        ``ingen_time_limit``: time limit in ms
                            (optional, the default is 10 mins)
@@ -70,6 +73,10 @@ def run(environ):
        ``ingen_output_limit``: output limit in B
                            (optional, the default is 10 KiB)
 
+       ``ingen_output_limit_action``: ``drain`` to discard the output over
+                           the limit or ``kill`` to kill the program
+                           (optional, the default is ``drain``)
+
        On success returns a new environ with a dictionary mapping collected
        files' names to their filetracker paths under ``collected_files``.
        Program's output is returned under the ``stdout`` key. The output is
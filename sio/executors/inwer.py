@@ -12,6 +12,7 @@ logger = logging.getLogger(__name__)
 DEFAULT_INWER_TIME_LIMIT = 300000  # in ms
 DEFAULT_INWER_MEM_LIMIT = 256 * 2**10  # in KiB
 DEFAULT_INWER_OUTPUT_LIMIT = 10 * 2**10  # in B
+DEFAULT_INWER_OUTPUT_LIMIT_ACTION = 'drain'
 
 def _run_in_executor(environ, command, executor, **kwargs):
     with executor:
@@ -21,6 +22,7 @@ def _run_in_executor(environ, command, executor, **kwargs):
                 mem_limit=DEFAULT_INWER_MEM_LIMIT,
                 time_limit=DEFAULT_INWER_TIME_LIMIT,
                 output_limit=DEFAULT_INWER_OUTPUT_LIMIT,
+                output_limit_action=DEFAULT_INWER_OUTPUT_LIMIT_ACTION,
                 environ=environ, environ_prefix='inwer_', **kwargs)
 
 def _run_inwer(environ, use_sandboxes=False):
@@ -53,6 +55,10 @@ def run(environ):
        ``inwer_output_limit``: output limit in B
                            (optional, the default is 10 KiB)
 
+       ``inwer_output_limit_action``: ``drain`` to discard the output over
+                           the limit or ``kill`` to kill the program
+                           (optional, the default is ``drain``)
+
        Returns a new environ, whose ``stdout`` key contains the program's
        output.
 
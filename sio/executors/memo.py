@@ -0,0 +1,260 @@
+"""Memoization of results of deterministic executors.
+
+Rejudging often runs the same program on the same tests with the same
+limits again. Executors counting instructions (see
+:attr:`sio.workers.executors.BaseExecutor.deterministic`) produce the same
+results then, so the worker may remember them and skip the execution.
+
+An execution is identified by the contents of the program and of its input,
+the executor type with its sandbox version and all ``exec_*`` keys of
+``environ``. For it, ``time_used``, ``mem_used``, ``num_syscalls``,
+``result_code``, ``result_string`` and the hash of the output are stored.
+Outputs are stored separately, once per content, as they are needed by the
+checker and for uploading ``out_file``. Results of checkers are memoized as
+well, identified by the contents of the output, the hint, the input and the
+checker, so a rejudge with an unchanged hint does not run the checker either.
+
+Memoization is enabled by setting ``SIO_EXEC_MEMO=1`` in the worker's
+environment. It may be overridden with ``use_exec_memo`` in the job's
+``environ``. The cache is kept in ``SIO_EXEC_MEMO_DIR`` (``~/.sio-exec-memo``
+by default) and limited to ``SIO_EXEC_MEMO_MAX_SIZE`` MiB (1024 by default);
+least recently used entries are removed first.
+"""
+from __future__ import absolute_import
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import six
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('SIO_EXEC_MEMO', '') not in ('', '0')
+CACHE_DIR = os.environ.get('SIO_EXEC_MEMO_DIR',
+        os.path.expanduser(os.path.join('~', '.sio-exec-memo')))
+MAX_SIZE = int(os.environ.get('SIO_EXEC_MEMO_MAX_SIZE', 1024)) * 2**20
+
+# Fraction of MAX_SIZE left after removing old entries.
+PRUNE_TARGET = 0.9
+
+EXEC_FIELDS = ('time_used', 'mem_used', 'num_syscalls', 'result_code',
+               'result_string')
+CHECK_FIELDS = ('result_code', 'result_string', 'result_percentage')
+
+# Results of executions which depend only on the program and its input.
+# Others, like ``SE``, may be caused by the state of the machine.
+MEMOIZABLE_RESULTS = ('OK', 'WA', 'RE', 'TLE', 'MLE', 'OLE')
+
+# Size of the cache as known to this process, None if not computed yet.
+_size = None
+_size_lock = threading.Lock()
+
+
+def enabled(environ, executor=None):
+    """Tells whether results for ``environ`` should be memoized, optionally
+       also checking if ``executor`` is deterministic."""
+    if not environ.get('use_exec_memo', ENABLED):
+        return False
+    return executor is None or getattr(executor, 'deterministic', False)
+
+
+def file_hash(filename):
+    """Returns the SHA-256 hash of the file contents."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _key(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True,
+            default=repr).encode('utf-8')).hexdigest()
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _prefixed(environ, prefix):
+    return dict((key, value) for key, value in six.iteritems(environ)
+                if key.startswith(prefix))
+
+
+def exec_key(environ, executor, exe_filename, input_filename):
+    """Returns the key identifying running the program from ``exe_filename``
+       on ``input_filename`` with ``executor``, which has to be entered."""
+    sandbox = getattr(executor, 'sandbox', None)
+    return _key(['exec', type(executor).__name__,
+                 sandbox and (sandbox.name, sandbox.version),
+                 file_hash(exe_filename), file_hash(input_filename),
+                 _prefixed(environ, 'exec_')])
+
+
+def check_key(environ, filenames, use_sandboxes):
+    """Returns the key identifying checking the output with the given
+       files (``out``, ``hint``, and ``chk`` with ``in`` if used)."""
+    return _key(['check', use_sandboxes,
+                 environ.get('untrusted_checker', False),
+                 [file_hash(filename) for filename in filenames],
+                 _prefixed(environ, 'checker_')])
+
+
+def memoizable(renv, environ):
+    """Tells whether the results of the execution do not depend on the load
+       of the machine."""
+    result_code = renv.get('result_code')
+    if result_code not in MEMOIZABLE_RESULTS:
+        return False
+    if result_code == 'TLE':
+        # Exceeding the time limit without using all of the (virtual) time
+        # means that the real time limit was hit.
+        time_limit = environ.get('exec_time_limit')
+        return time_limit is not None and \
+                renv.get('time_used', 0) >= time_limit
+    return True
+
+
+def _path(name):
+    return os.path.join(CACHE_DIR, name)
+
+
+def _touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def _load(key):
+    path = _path(key + '.json')
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    _touch(path)
+    return entry
+
+
+def _write(name, write):
+    """Atomically creates the cache file ``name`` filled by
+       ``write(file)``, returning its size."""
+    try:
+        os.makedirs(CACHE_DIR)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=CACHE_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        size = os.path.getsize(tmp)
+        os.rename(tmp, _path(name))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return size
+
+
+def _store(key, entry):
+    data = json.dumps(entry).encode('utf-8')
+    _account(_write(key + '.json', lambda f: f.write(data)))
+
+
+def load_exec(key, out_filename):
+    """Returns the memoized results of the execution and writes its output
+       to ``out_filename``, or returns ``None`` if not found."""
+    entry = _load(key)
+    if entry is None:
+        return None
+    blob = _path(entry['output'] + '.out')
+    try:
+        shutil.copyfile(blob, out_filename)
+    except (IOError, OSError):
+        return None
+    _touch(blob)
+    return dict((field, entry[field]) for field in EXEC_FIELDS
+                if field in entry)
+
+
+def store_exec(key, renv, out_filename):
+    """Memoizes the results of the execution with its output from
+       ``out_filename``."""
+    entry = dict((field, _text(renv[field])) for field in EXEC_FIELDS
+                 if field in renv)
+    entry['output'] = file_hash(out_filename)
+    blob = entry['output'] + '.out'
+    if os.path.exists(_path(blob)):
+        _touch(_path(blob))
+    else:
+        def _copy(f):
+            with open(out_filename, 'rb') as src:
+                shutil.copyfileobj(src, f)
+        _account(_write(blob, _copy))
+    _store(key, entry)
+
+
+def load_check(key):
+    """Returns the memoized results of the checker or ``None``."""
+    entry = _load(key)
+    if entry is None:
+        return None
+    return dict((field, entry[field]) for field in CHECK_FIELDS
+                if field in entry)
+
+
+def store_check(key, result):
+    """Memoizes the results of the checker."""
+    _store(key, dict((field, _text(result[field])) for field in CHECK_FIELDS
+                     if field in result))
+
+
+def _entries():
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if name.startswith('.tmp-'):
+            continue
+        try:
+            st = os.stat(_path(name))
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+    return entries
+
+
+def _account(size):
+    global _size
+    with _size_lock:
+        if _size is None:
+            _size = sum(entry[1] for entry in _entries())
+        else:
+            _size += size
+        if _size > MAX_SIZE:
+            _size = prune(int(MAX_SIZE * PRUNE_TARGET))
+
+
+def prune(max_size=0):
+    """Removes the least recently used entries until the cache takes at most
+       ``max_size`` bytes. Returns the resulting size."""
+    if not os.path.isdir(CACHE_DIR):
+        return 0
+    entries = sorted(_entries())
+    size = sum(entry[1] for entry in entries)
+    for _mtime, entry_size, name in entries:
+        if size <= max_size:
+            break
+        try:
+            os.unlink(_path(name))
+        except OSError:
+            continue
+        size -= entry_size
+    logger.debug('Execution memo pruned to %d bytes', size)
+    return size
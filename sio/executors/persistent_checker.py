@@ -0,0 +1,273 @@
+"""Persistent output checkers.
+
+Some checkers take long to start (they load a large dictionary or
+precompute something), which is repeated for every test of a problem. Such
+checkers may support the persistent protocol, in which a checker process is
+started once and checks many outputs.
+
+The checker is started as ``chk --persistent`` and has to print a line with
+``ready`` within a second, so it should do so before any lengthy
+initialization (which then counts towards the first check). Then it reads requests from its standard input: three lines
+with the paths of the input, the output and the hint. For each of them it
+prints exactly three lines of the usual verdict (see :ref:`output-checker`;
+missing lines have to be printed empty) and flushes its output. It should
+exit at the end of its input.
+
+The protocol is used for checkers with ``persistent_checker`` set in the
+job's ``environ``. At most ``SIO_PERSISTENT_CHECKERS`` (4 by default)
+checker processes are kept by the worker; the least recently used idle ones
+are stopped to make room for others. If the checker cannot be started, dies,
+does not answer within ``checker_time_limit`` or misbehaves, the output is
+checked by running the checker the usual way, and the persistent one is not
+retried for some time.
+
+Resource limits apply to the whole process, not to a single check: the memory
+limit is set with ``ulimit`` and there is no CPU time limit.
+"""
+from __future__ import absolute_import
+import atexit
+import errno
+import logging
+import os
+import select
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+from sio.executors import memo
+from sio.workers.executors import ulimit
+from sio.workers.util import ms2s
+
+logger = logging.getLogger(__name__)
+
+ARGUMENT = '--persistent'
+#: Maximum number of running checker processes.
+MAX_CHECKERS = int(os.environ.get('SIO_PERSISTENT_CHECKERS', 4))
+#: Number of checks after which the checker is restarted, so that it does
+#: not grow indefinitely.
+MAX_CHECKS = 10000
+#: Checkers which do not greet within this time are assumed not to support
+#: the protocol.
+STARTUP_TIMEOUT = 1000  # in ms
+#: Time for which a checker is not retried after it failed.
+RETRY_INTERVAL = 600  # in s
+#: Maximum length of a line of the checker's response.
+MAX_LINE_LENGTH = 64 * 2**10  # in bytes
+
+
+class PersistentCheckerError(RuntimeError):
+    pass
+
+
+class PersistentChecker(object):
+    """A single checker process.
+
+       Files to check are linked (or copied) to a private directory in the
+       system temporary directory. In sandboxes it is the only directory of
+       the worker visible to the checker, which outlives the job and must not
+       see files of other jobs.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.lock = threading.Lock()
+        self.checks = 0
+        self.last_used = time.time()
+        self.executor = None
+        self.process = None
+        self.dir = None
+        self._buffer = b''
+
+    def start(self, chk_filename, executor, mem_limit):
+        """Starts the checker from ``chk_filename`` in ``executor``."""
+        self.dir = tempfile.mkdtemp(prefix='sioworkers_checker_')
+        chk = os.path.join(self.dir, 'chk')
+        shutil.copy(chk_filename, chk)
+        os.chmod(chk, 0o700)
+
+        # The checker keeps the sandbox locked for its whole lifetime.
+        executor.__enter__()
+        self.executor = executor
+        self.process = executor.popen(
+                ulimit([chk, ARGUMENT], mem_limit=mem_limit), cwd=self.dir,
+                binds=[self.dir])
+        if self._readline(STARTUP_TIMEOUT) != b'ready':
+            raise PersistentCheckerError('Unexpected checker greeting')
+        logger.info('Started persistent checker %s (pid %d)', self.key,
+                    self.process.pid)
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+            self.process.wait()
+            self.process.stdin.close()
+            self.process.stdout.close()
+            self.process = None
+        if self.executor is not None:
+            self.executor.__exit__(None, None, None)
+            self.executor = None
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+
+    def _readline(self, timeout):
+        """Reads a line from the checker waiting at most ``timeout`` ms."""
+        while b'\n' not in self._buffer:
+            if len(self._buffer) > MAX_LINE_LENGTH:
+                raise PersistentCheckerError('Response line too long')
+            self._fill(timeout)
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line
+
+    def _fill(self, timeout):
+        fd = self.process.stdout.fileno()
+        ready, _, _ = select.select([fd], [], [], ms2s(timeout))
+        if not ready:
+            raise PersistentCheckerError('Timeout while waiting for the '
+                                         'checker')
+        data = os.read(fd, 65536)
+        if not data:
+            raise PersistentCheckerError('Checker closed its output')
+        self._buffer += data
+
+    def _stage(self, filename, name):
+        target = os.path.join(self.dir, name)
+        try:
+            os.link(filename, target)
+        except OSError:
+            shutil.copyfile(filename, target)
+        return target
+
+    def check(self, filenames, timeout):
+        """Checks the output with the checker. ``filenames`` are paths of
+           the input, the output and the hint.
+
+           Returns the three lines of the verdict. The answer has to come
+           within ``timeout`` ms.
+        """
+        self.checks += 1
+        self.last_used = time.time()
+        staged = []
+        try:
+            for filename, suffix in zip(filenames, ('in', 'out', 'hint')):
+                staged.append(self._stage(filename,
+                                          '%d.%s' % (self.checks, suffix)))
+            self.process.stdin.write(
+                    ''.join(path + '\n' for path in staged).encode('utf-8'))
+            self.process.stdin.flush()
+            return [self._readline(timeout) for _ in range(3)]
+        except (IOError, OSError) as e:
+            raise PersistentCheckerError('Checker communication failed: %s'
+                                         % e)
+        finally:
+            for path in staged:
+                os.unlink(path)
+
+
+_checkers = {}
+_failed = {}
+_checkers_lock = threading.Lock()
+
+
+def _evict():
+    """Stops the least recently used idle checker. Called with
+       ``_checkers_lock`` held, returns ``False`` if all are busy."""
+    idle = [checker for checkers in _checkers.values()
+            for checker in checkers if not checker.lock.locked()]
+    for checker in sorted(idle, key=lambda checker: checker.last_used):
+        if checker.lock.acquire(False):
+            _checkers[checker.key].remove(checker)
+            if not _checkers[checker.key]:
+                del _checkers[checker.key]
+            checker.stop()
+            checker.lock.release()
+            return True
+    return False
+
+
+def _acquire(key, chk_filename, executor_factory, mem_limit):
+    """Returns a started, locked checker for ``key``, or ``None`` if it
+       cannot be started now."""
+    with _checkers_lock:
+        if time.time() - _failed.get(key, 0) < RETRY_INTERVAL:
+            return None
+        for checker in _checkers.get(key, ()):
+            if checker.lock.acquire(False):
+                return checker
+        running = sum(len(checkers) for checkers in _checkers.values())
+        if running >= MAX_CHECKERS and not _evict():
+            return None
+        checker = PersistentChecker(key)
+        checker.lock.acquire()
+        _checkers.setdefault(key, []).append(checker)
+
+    try:
+        checker.start(chk_filename, executor_factory(), mem_limit)
+    except Exception:
+        logger.warning('Cannot start persistent checker %s', key,
+                       exc_info=True)
+        _discard(checker, failed=True)
+        return None
+    return checker
+
+
+def _discard(checker, failed=False):
+    with _checkers_lock:
+        checkers = _checkers.get(checker.key, [])
+        if checker in checkers:
+            checkers.remove(checker)
+            if not checkers:
+                del _checkers[checker.key]
+        if failed:
+            _failed[checker.key] = time.time()
+    checker.stop()
+    checker.lock.release()
+
+
+def check(filenames, chk_filename, executor_factory, timeout, mem_limit=None,
+          key=()):
+    """Checks the output using a persistent checker from ``chk_filename``.
+
+       ``filenames`` are paths of the input, the output and the hint.
+       A new checker is started with an executor created by
+       ``executor_factory()`` and memory limited to ``mem_limit`` KiB. ``key``
+       distinguishes checkers run differently from the same file.
+
+       Returns the three lines of the verdict or ``None`` if the checker is
+       not available now. Raises :exc:`PersistentCheckerError` if it fails.
+       In both cases the caller should run the checker the usual way.
+    """
+    key = (memo.file_hash(chk_filename),) + tuple(key)
+    checker = _acquire(key, chk_filename, executor_factory, mem_limit)
+    if checker is None:
+        return None
+
+    try:
+        verdict = checker.check(filenames, timeout)
+    except PersistentCheckerError:
+        _discard(checker, failed=True)
+        raise
+
+    if checker.checks >= MAX_CHECKS:
+        _discard(checker)
+    else:
+        checker.lock.release()
+    return verdict
+
+
+def shutdown():
+    """Stops all running checkers."""
+    with _checkers_lock:
+        checkers = [checker for checkers in _checkers.values()
+                    for checker in checkers]
+        _checkers.clear()
+    for checker in checkers:
+        checker.stop()
+
+atexit.register(shutdown)
@@ -1,6 +1,10 @@
-from sio.executors import common
+from sio.executors import batch, common
 from sio.workers.executors import Sio2JailExecutor
 
 
 def run(environ):
     return common.run(environ, Sio2JailExecutor())
+
+
+def run_batch(environ):
+    return batch.run(environ, Sio2JailExecutor)
@@ -1,6 +1,9 @@
 from __future__ import absolute_import
-from sio.executors import common
+from sio.executors import batch, common
 from sio.workers.executors import VCPUExecutor
 
 def run(environ):
     return common.run(environ, VCPUExecutor())
+
+def run_batch(environ):
+    return batch.run(environ, VCPUExecutor)
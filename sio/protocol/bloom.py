@@ -0,0 +1,71 @@
+"""Bloom filters, compact summaries of sets of strings.
+
+Workers advertise what they have cached (filetracker files and job types
+they ran) in one, so that sioworkersd may prefer them for tasks using the
+same files. A filter may claim that a string was added when it wasn't, but
+never the other way round.
+"""
+from __future__ import absolute_import
+import base64
+import hashlib
+import struct
+import zlib
+
+import six
+
+BITS = 2**16
+HASHES = 4
+
+
+def indexes(key, bits=BITS, hashes=HASHES):
+    """Returns the positions of bits set for ``key``. They may be computed
+       once and checked in many filters with
+       :meth:`BloomFilter.contains_indexes`."""
+    if isinstance(key, six.text_type):
+        key = key.encode('utf-8')
+    h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+def job_key(job_type):
+    """Returns the key standing for sandboxes used by jobs of the type."""
+    return 'job:' + job_type
+
+
+class BloomFilter(object):
+    def __init__(self, bits=BITS, hashes=HASHES, data=None):
+        assert bits > 0 and bits % 8 == 0
+        assert hashes > 0
+        self.bits = bits
+        self.hashes = hashes
+        if data is None:
+            self.data = bytearray(bits // 8)
+        else:
+            self.data = bytearray(data)
+            assert len(self.data) * 8 == bits
+
+    def add(self, key):
+        for i in indexes(key, self.bits, self.hashes):
+            self.data[i >> 3] |= 1 << (i & 7)
+
+    def contains_indexes(self, idx):
+        return all(self.data[i >> 3] & (1 << (i & 7)) for i in idx)
+
+    def __contains__(self, key):
+        return self.contains_indexes(indexes(key, self.bits, self.hashes))
+
+    def to_dict(self):
+        """Returns a JSON-serializable representation."""
+        return {'bits': self.bits, 'hashes': self.hashes,
+                'data': base64.b64encode(
+                    zlib.compress(bytes(self.data))).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, d):
+        """Inverse of :meth:`to_dict`. Raises ``ValueError`` if ``d`` is
+           malformed."""
+        try:
+            data = zlib.decompress(base64.b64decode(d['data']))
+            return cls(int(d['bits']), int(d['hashes']), data)
+        except (KeyError, TypeError, AssertionError, zlib.error) as e:
+            raise ValueError('Invalid Bloom filter: %r' % (e,))
@@ -0,0 +1,122 @@
+"""Detection of resources a worker may dedicate to tasks.
+
+CPUs are limited by the affinity mask and a cgroup CPU quota, RAM by the
+total memory and a cgroup memory limit. Limits of the worker's own cgroup
+(from ``/proc/self/cgroup``) and all its ancestors are considered; both
+cgroup v1 and v2 are understood, as mounted in the worker's namespace.
+"""
+from __future__ import absolute_import
+import math
+import multiprocessing
+import os
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+PROC_SELF_CGROUP = '/proc/self/cgroup'
+MEMINFO = '/proc/meminfo'
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _own_cgroup(controller):
+    """Returns the path of this process's cgroup in the hierarchy of
+       ``controller`` (``''`` for cgroup v2), as listed in
+       ``/proc/self/cgroup``. Defaults to the hierarchy root."""
+    for line in (_read(PROC_SELF_CGROUP) or '').splitlines():
+        parts = line.split(':', 2)
+        if len(parts) == 3 and controller in parts[1].split(','):
+            return parts[2]
+    return '/'
+
+
+def _cgroup_dirs(hierarchy, controller):
+    """Yields the directories of this process's cgroup and all its ancestors
+       in the ``hierarchy`` mounted under :data:`CGROUP_ROOT`."""
+    root = os.path.normpath(os.path.join(CGROUP_ROOT, hierarchy))
+    path = os.path.normpath(os.path.join(root,
+                                         _own_cgroup(controller).lstrip('/')))
+    if not (path + os.sep).startswith(root + os.sep):
+        path = root
+    while True:
+        yield path
+        if path == root:
+            return
+        path = os.path.dirname(path)
+
+
+def _tightest(limits):
+    limits = [limit for limit in limits if limit is not None]
+    return min(limits) if limits else None
+
+
+def _cpu_quota(path):
+    value = _read(os.path.join(path, 'cpu.max'))
+    if value:
+        quota, _, period = value.partition(' ')
+        if quota != 'max':
+            return int(quota) / float(period or 100000)
+    quota = _read(os.path.join(path, 'cpu.cfs_quota_us'))
+    period = _read(os.path.join(path, 'cpu.cfs_period_us'))
+    if quota and period and int(quota) > 0:
+        return int(quota) / float(period)
+    return None
+
+
+def _memory_limit_mb(path):
+    for name in ('memory.max', 'memory.limit_in_bytes'):
+        value = _read(os.path.join(path, name))
+        if value and value != 'max':
+            # cgroup v1 reports "no limit" as a huge number.
+            limit = int(value) // 2**20
+            if limit < 2**40:
+                return limit
+    return None
+
+
+def _cgroup_cpu_quota():
+    """Returns the number of CPUs allowed by the tightest cgroup quota of
+       this process or its ancestors, or None."""
+    return _tightest(_cpu_quota(path)
+                     for path in list(_cgroup_dirs('', ''))
+                     + list(_cgroup_dirs('cpu', 'cpu')))
+
+
+def _cgroup_memory_limit_mb():
+    """Returns the tightest cgroup memory limit of this process or its
+       ancestors in MiB, or None."""
+    return _tightest(_memory_limit_mb(path)
+                     for path in list(_cgroup_dirs('', ''))
+                     + list(_cgroup_dirs('memory', 'memory')))
+
+
+def detect_cpus():
+    """Returns the number of CPUs this process may use."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = multiprocessing.cpu_count()
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, int(math.ceil(quota)))
+    return max(cpus, 1)
+
+
+def detect_ram_mb(reserved_mb=0):
+    """Returns the RAM (in MiB) this process may use, less ``reserved_mb``
+       left for the system. At least 1 MiB is returned."""
+    total = None
+    for line in (_read(MEMINFO) or '').splitlines():
+        if line.startswith('MemTotal:'):
+            total = int(line.split()[1]) // 1024
+            break
+    limit = _cgroup_memory_limit_mb()
+    if total is None or (limit is not None and limit < total):
+        total = limit
+    if total is None:
+        raise RuntimeError('Unable to detect available RAM')
+    return max(total - reserved_mb, 1)
@@ -1,7 +1,9 @@
 from __future__ import absolute_import
+from collections import deque
 from twisted.protocols.basic import NetstringReceiver
 from twisted.internet import defer, reactor
 from twisted.logger import Logger
+from twisted.python.failure import Failure
 import six
 
 log = Logger()
@@ -9,6 +11,11 @@ log = Logger()
 import json
 from enum import Enum
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 if six.PY2:
     class State(Enum):
@@ -52,9 +59,35 @@ def makeRemoteException(msg, uid=None):
         return RemoteError(err=err, tb=msg.get('traceback'), uid=uid)
 
 
+def encode(msg):
+    """Serializes a message to ASCII-only JSON bytes, with :mod:`orjson` if
+       it is installed. Not all peers may handle raw UTF-8 yet."""
+    if orjson is not None:
+        try:
+            data = orjson.dumps(msg)
+        except TypeError:
+            # e.g. non-string keys, which json converts
+            pass
+        else:
+            # orjson cannot escape non-ASCII characters.
+            if data.isascii():
+                return data
+    return json.dumps(msg).encode("ascii")
+
+
+def decode(string):
+    """Inverse of :func:`encode`, also accepting UTF-8. Raises
+       ``ValueError`` on invalid JSON."""
+    if orjson is not None:
+        return orjson.loads(string)
+    return json.loads(string.decode('utf-8'))
+
+
 class WorkerRPC(NetstringReceiver):
     MAX_LENGTH = 2**20  # 1MB should be enough
     DEFAULT_TIMEOUT = 30
+    # Messages at least that long are decoded by decodeLarge().
+    OFFLOAD_THRESHOLD = 2**16
 
     def __init__(self, server=False, timeout=DEFAULT_TIMEOUT):
         self.requestID = 0
@@ -67,6 +100,9 @@ class WorkerRPC(NetstringReceiver):
         self.ready = defer.Deferred()
         self.defaultTimeout = timeout
         self.clientInfo = {}
+        # [decoded, message or Failure] of messages received while a large
+        # one is being decoded, in order of arrival.
+        self.incoming = deque()
 
     def connectionMade(self):
         self.state = State.connected
@@ -77,6 +113,7 @@ class WorkerRPC(NetstringReceiver):
 
     def connectionLost(self, reason):
         NetstringReceiver.connectionLost(self, reason)
+        self.incoming.clear()
         for (_, timer) in six.itervalues(self.pendingCalls):
             if not timer.called:
                 timer.cancel()
@@ -137,13 +174,42 @@ class WorkerRPC(NetstringReceiver):
         Should return a dict."""
         return {}
 
+    def decodeLarge(self, string):
+        """Decodes a message of at least ``OFFLOAD_THRESHOLD`` bytes.
+        Returns a Deferred, so that it may be done outside of the reactor
+        thread. Reimplement in derived class."""
+        return defer.maybeDeferred(decode, string)
+
     def stringReceived(self, string):
-        try:
+        if not self.incoming and len(string) < self.OFFLOAD_THRESHOLD:
             try:
-                msg = json.loads(string.decode())
+                msg = decode(string)
             except ValueError:
-                log.failure("Received message with invalid JSON. Terminating.")
-                raise
+                msg = Failure()
+            self._dispatch(msg)
+            return
+
+        # Messages are processed in order, so the following ones have
+        # to wait for the large one.
+        entry = [False, None]
+        self.incoming.append(entry)
+        if len(string) < self.OFFLOAD_THRESHOLD:
+            d = defer.maybeDeferred(decode, string)
+        else:
+            d = self.decodeLarge(string)
+
+        def _decoded(msg):
+            entry[:] = [True, msg]
+            while self.incoming and self.incoming[0][0]:
+                self._dispatch(self.incoming.popleft()[1])
+        d.addBoth(_decoded)
+
+    def _dispatch(self, msg):
+        try:
+            if isinstance(msg, Failure):
+                log.failure("Received message with invalid JSON. Terminating.",
+                            msg)
+                msg.raiseException()
             self._processMessage(msg)
         except ProtocolError:
             log.failure("Fatal protocol error. Terminating.")
@@ -168,7 +234,7 @@ class WorkerRPC(NetstringReceiver):
 
     def sendMsg(self, msg_type, **kwargs):
         kwargs['type'] = msg_type
-        self.sendString(json.dumps(kwargs).encode("ascii"))
+        self.sendString(encode(kwargs))
 
     def call(self, cmd, *args, **kwargs):
         """Call a remote function. Raises RemoteError if something goes wrong
@@ -187,9 +253,8 @@ class WorkerRPC(NetstringReceiver):
 
         def cb(ignore):
             self.pendingCalls[current_id] = (d, timer)
-            s = json.dumps({'type': 'call', 'id': current_id,
-                'method': cmd, 'args': args})
-            self.sendString(s.encode("ascii"))
+            self.sendString(encode({'type': 'call', 'id': current_id,
+                'method': cmd, 'args': args}))
         if self.state != State.established:
             # wait for connection
             self.ready.addCallback(cb)
@@ -1,10 +1,13 @@
 from __future__ import absolute_import
 from twisted.trial import unittest
 from twisted.test import proto_helpers
-from twisted.internet import protocol, reactor
+from twisted.internet import defer, protocol, reactor
 import json
+import os
+import shutil
+import tempfile
 
-from sio.protocol import rpc
+from sio.protocol import bloom, capacity, rpc, worker
 
 
 class TestClient(rpc.WorkerRPC):
@@ -70,6 +73,32 @@ class ServerTestCase(unittest.TestCase):
         ret = decode(self.tr.value())
         self.assertEqual(ret['result'], 15)
 
+    def test_server_large_message_order(self):
+        self._hello()
+        self.tr.clear()
+        decoding = []
+
+        def decodeLarge(string):
+            d = defer.Deferred()
+            decoding.append((d, string))
+            return d
+        self.proto.decodeLarge = decodeLarge
+        self.proto.OFFLOAD_THRESHOLD = 100
+        self.proto.dataReceived(encode({'type': 'call', 'method': 'mul3',
+                                        'args': ['x' * 100], 'id': 0}))
+        self.proto.dataReceived(encode({'type': 'call', 'method': 'mul3',
+                                        'args': [5], 'id': 1}))
+        self.assertEqual(self.tr.value(), b'')
+        d, string = decoding.pop()
+        d.callback(rpc.decode(string))
+        data = self.tr.value()
+        ids = []
+        while data:
+            length, _, data = data.partition(b':')
+            ids.append(json.loads(data[:int(length)].decode())['id'])
+            data = data[int(length) + 1:]
+        self.assertEqual(ids, [0, 1])
+
 
 class ClientTestCase(unittest.TestCase):
     def setUp(self):
@@ -133,3 +162,178 @@ class IntegrationTestCase(unittest.TestCase):
             return self.assertFailure(d, rpc.RemoteError)
         return creator.connectTCP('127.0.0.1', self.port.getHost().port).\
                 addCallback(cb)
+
+
+class WorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.factory = worker.WorkerFactory(concurrency=2,
+                                            available_ram_mb=1024)
+        self.proto = self.factory.buildProtocol(('127.0.0.1', 0))
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+        self.proto.dataReceived(encode(hello_ack_msg))
+        self.tr.clear()
+
+    def test_results_should_be_kept_until_acknowledged(self):
+        self.factory.keepResult('t1', {'pong': 1})
+        self.proto.dataReceived(encode({'type': 'call', 'id': 0,
+                'method': 'get_finished', 'args': []}))
+        self.assertEqual(decode(self.tr.value())['result'],
+                         [{'task_id': 't1', 'result': {'pong': 1}}])
+        self.proto.cmd_ack_finished(['t1'])
+        self.assertEqual(self.factory.finished, {})
+
+    def test_drain_should_announce_no_slots(self):
+        self.factory.running['t1'] = {'job_type': 'ping'}
+        self.factory.setDraining(True)
+        call = decode(self.tr.value())
+        self.assertEqual(call['method'], 'update_capacity')
+        self.assertEqual(call['args'],
+                         [{'concurrency': 0, 'available_ram_mb': 1024}])
+        self.assertEqual(self.proto.cmd_get_running(), ['t1'])
+        # Cancels the timeout of the call.
+        self.proto.connectionLost(None)
+
+    def test_cache_summary_should_be_sent_when_changed(self):
+        self.factory.announceCache()
+        self.assertEqual(self.tr.value(), b'')
+        self.factory.job_types.add('ping')
+        self.factory.announceCache()
+        call = decode(self.tr.value())
+        self.assertEqual(call['method'], 'update_cache')
+        cache = bloom.BloomFilter.from_dict(call['args'][0])
+        self.assertIn(bloom.job_key('ping'), cache)
+        # Cancels the timeout of the call.
+        self.proto.connectionLost(None)
+
+    def test_abandoned_tasks_should_take_slots(self):
+        self.factory.running['t1'] = {'job_type': 'ping'}
+        self.factory.running['t2'] = {'job_type': 'ping'}
+        self.assertEqual(self.proto.cmd_abandon(['t1', 'gone']),
+                         {'concurrency': 1, 'available_ram_mb': 1024})
+        self.assertEqual(self.proto.cmd_get_running(), ['t2'])
+
+    def test_finished_results_should_be_reported(self):
+        self.factory.keepResult('t1', {'pong': 1})
+        self.factory.reportFinished()
+        call = decode(self.tr.value())
+        self.assertEqual(call['method'], 'report_finished')
+        self.assertEqual(call['args'],
+                         [[{'task_id': 't1', 'result': {'pong': 1}}]])
+        self.proto.dataReceived(encode({'type': 'result', 'id': call['id'],
+                'result': None}))
+        self.assertEqual(self.factory.finished, {})
+
+
+class EncodingTestCase(unittest.TestCase):
+    msg = {'type': 'call', 'method': 'foo', 'args': [u'za\u017c\xf3\u0142\u0107']}
+
+    def _test_round_trip(self):
+        data = rpc.encode(self.msg)
+        self.assertEqual(data, json.dumps(self.msg).encode('ascii'))
+        self.assertEqual(rpc.decode(data), self.msg)
+        # Peers sending raw UTF-8 are understood.
+        self.assertEqual(rpc.decode(json.dumps(self.msg, ensure_ascii=False)
+                                    .encode('utf-8')), self.msg)
+
+    def test_non_ascii_round_trip(self):
+        self._test_round_trip()
+
+    def test_non_ascii_round_trip_without_orjson(self):
+        self.patch(rpc, 'orjson', None)
+        self._test_round_trip()
+
+
+class BloomFilterTestCase(unittest.TestCase):
+    def test_added_keys_should_be_found(self):
+        cache = bloom.BloomFilter()
+        for i in range(1000):
+            cache.add('/tests/%d.in' % i)
+        self.assertTrue(all('/tests/%d.in' % i in cache for i in range(1000)))
+        false_positives = sum('/tests/%d.out' % i in cache
+                              for i in range(1000))
+        self.assertLess(false_positives, 10)
+
+    def test_should_survive_serialization(self):
+        cache = bloom.BloomFilter(bits=1024, hashes=3)
+        cache.add(u'/exe/\u0105')
+        summary = json.loads(json.dumps(cache.to_dict()))
+        loaded = bloom.BloomFilter.from_dict(summary)
+        self.assertEqual((loaded.bits, loaded.hashes), (1024, 3))
+        self.assertIn(u'/exe/\u0105', loaded)
+        self.assertNotIn('/exe/b', loaded)
+        self.assertRaises(ValueError, bloom.BloomFilter.from_dict,
+                          dict(summary, bits=2048))
+
+
+class CapacityTestCase(unittest.TestCase):
+    def _write(self, path, content):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.patch(capacity, 'CGROUP_ROOT', os.path.join(self.root, 'cgroup'))
+        self.patch(capacity, 'MEMINFO', os.path.join(self.root, 'meminfo'))
+        self.patch(capacity, 'PROC_SELF_CGROUP',
+                   os.path.join(self.root, 'self_cgroup'))
+        self.patch(os, 'sched_getaffinity', lambda pid: set(range(8)))
+        self._write('meminfo', 'MemTotal:        8388608 kB\n'
+                               'MemFree:         1048576 kB\n')
+
+    def test_ram_without_cgroup_limit(self):
+        self.assertEqual(capacity.detect_ram_mb(512), 8192 - 512)
+
+    def test_cgroup_v2_limits(self):
+        self._write('cgroup/memory.max', str(2 * 2**30))
+        self._write('cgroup/cpu.max', '150000 100000')
+        self.assertEqual(capacity.detect_ram_mb(), 2048)
+        self.assertEqual(capacity.detect_cpus(), 2)
+
+    def test_cgroup_v1_limits(self):
+        self._write('cgroup/memory/memory.limit_in_bytes',
+                    str(2**63 - 4096))
+        self._write('cgroup/cpu/cpu.cfs_quota_us', '-1')
+        self._write('cgroup/cpu/cpu.cfs_period_us', '100000')
+        self.assertEqual(capacity.detect_ram_mb(), 8192)
+        self.assertEqual(capacity.detect_cpus(), 8)
+
+    def test_cgroup_v2_own_cgroup(self):
+        self._write('self_cgroup', '0::/system.slice/sioworkers.service\n')
+        # Limits of unrelated cgroups are ignored.
+        self._write('cgroup/other.slice/memory.max', str(2**30))
+        self._write('cgroup/other.slice/cpu.max', '100000 100000')
+        self._write('cgroup/system.slice/memory.max', str(4 * 2**30))
+        self._write('cgroup/system.slice/cpu.max', '300000 100000')
+        self._write('cgroup/system.slice/sioworkers.service/memory.max',
+                    'max')
+        self._write('cgroup/system.slice/sioworkers.service/cpu.max',
+                    '500000 100000')
+        self.assertEqual(capacity.detect_ram_mb(), 4096)
+        self.assertEqual(capacity.detect_cpus(), 3)
+
+    def test_cgroup_v1_own_cgroup(self):
+        self._write('self_cgroup', '12:memory:/workers/w1\n'
+                                   '4:cpu,cpuacct:/workers/w1\n'
+                                   '1:name=systemd:/init.scope\n'
+                                   '0::/init.scope\n')
+        self._write('cgroup/memory/workers/memory.limit_in_bytes',
+                    str(2**63 - 4096))
+        self._write('cgroup/memory/workers/w1/memory.limit_in_bytes',
+                    str(3 * 2**30))
+        self._write('cgroup/cpu/workers/cpu.cfs_quota_us', '200000')
+        self._write('cgroup/cpu/workers/cpu.cfs_period_us', '100000')
+        self._write('cgroup/cpu/workers/w1/cpu.cfs_quota_us', '-1')
+        self._write('cgroup/cpu/workers/w1/cpu.cfs_period_us', '100000')
+        self.assertEqual(capacity.detect_ram_mb(), 3072)
+        self.assertEqual(capacity.detect_cpus(), 2)
+
+    def test_cgroup_outside_namespace(self):
+        # Without a cgroup namespace the listed path may not be mounted.
+        self._write('self_cgroup', '0::/../../docker/abc\n')
+        self._write('cgroup/memory.max', str(2**30))
+        self.assertEqual(capacity.detect_ram_mb(), 1024)
@@ -1,10 +1,11 @@
 from __future__ import absolute_import
 from twisted.internet.protocol import ReconnectingClientFactory
-from twisted.internet import threads
-from sio.workers import runner
-from sio.protocol import rpc
+from twisted.internet import reactor, threads
+from sio.workers import ft, runner, sandbox
+from sio.protocol import bloom, capacity, rpc
 import platform
 from twisted.logger import Logger, LogLevel
+from twisted.python.failure import Failure
 import six
 
 log = Logger()
@@ -18,13 +19,27 @@ def _runner_wrap(env):
 class WorkerProtocol(rpc.WorkerRPC):
     def __init__(self):
         rpc.WorkerRPC.__init__(self, server=False)
-        self.running = {}
+
+    @property
+    def running(self):
+        # Tasks outlive connections.
+        return self.factory.running
+
+    def connectionMade(self):
+        rpc.WorkerRPC.connectionMade(self)
+        self.factory.connection = self
+
+    def connectionLost(self, reason):
+        rpc.WorkerRPC.connectionLost(self, reason)
+        if self.factory.connection is self:
+            self.factory.connection = None
 
     def getHelloData(self):
-        return {'name': self.factory.name,
-                'concurrency': self.factory.concurrency,
-                'available_ram_mb': self.factory.available_ram_mb,
-                'can_run_cpu_exec': self.factory.can_run_cpu_exec}
+        data = self.factory.getCapacity()
+        data.update({'name': self.factory.name,
+                     'can_run_cpu_exec': self.factory.can_run_cpu_exec,
+                     'cache': self.factory.getCacheSummary()})
+        return data
 
     def cmd_run(self, env):
         job_type = env['job_type']
@@ -41,6 +56,7 @@ class WorkerProtocol(rpc.WorkerRPC):
         task_id = env['task_id']
         log.info('running {job_type} {tid}', job_type=job_type, tid=task_id)
         self.running[task_id] = env
+        self.factory.job_types.add(job_type)
         d = threads.deferToThread(_runner_wrap, env)
 
         # Log errors, but pass them to sioworkersd anyway
@@ -52,13 +68,49 @@ class WorkerProtocol(rpc.WorkerRPC):
             del self.running[task_id]
             log.info('{tid} done.', tid=task_id)
             return x
+
+        def _keep_if_disconnected(x):
+            if task_id in self.factory.abandoned:
+                self.factory.abandoned.discard(task_id)
+                self.factory._announceCapacity()
+            elif self.factory.connection is not self:
+                self.factory.keepResult(task_id, x)
+                self.factory.reportFinished()
+            return x
         d.addBoth(_done)
         d.addErrback(_error)
+        d.addBoth(_keep_if_disconnected)
+        d.addBoth(self.factory.checkDrained)
         return d
 
     def cmd_get_running(self):
         # sets are not json-serializable
-        return list(self.running.keys())
+        return [task_id for task_id in self.running
+                if task_id not in self.factory.abandoned]
+
+    def cmd_abandon(self, task_ids):
+        """Forgets running tasks unknown to sioworkersd. They can't be
+        stopped, so their slots are freed once they finish and their results
+        are dropped. Returns the capacity reduced by them."""
+        for task_id in task_ids:
+            if task_id in self.running:
+                log.warn('abandoning {tid}', tid=task_id)
+                self.factory.abandoned.add(task_id)
+        return self.factory.getCapacity()
+
+    def cmd_get_finished(self):
+        """Returns results of tasks finished while disconnected, as
+        dictionaries with ``task_id`` and ``result`` or ``error``. They are
+        kept until acknowledged with ``ack_finished``."""
+        return self.factory.getFinished()
+
+    def cmd_ack_finished(self, task_ids):
+        self.factory.ackFinished(task_ids)
+
+    def cmd_drain(self):
+        """Stops accepting tasks and exits once the running ones are
+        finished."""
+        self.factory.drain()
 
 
 class WorkerFactory(ReconnectingClientFactory):
@@ -69,7 +121,13 @@ class WorkerFactory(ReconnectingClientFactory):
                  concurrency=1,
                  available_ram_mb=1024,
                  can_run_cpu_exec=False,
-                 name=None):
+                 name=None,
+                 reserved_ram_mb=512):
+        """``concurrency`` and ``available_ram_mb`` set to ``None`` are
+        detected (see :meth:`detectCapacity`)."""
+        self.detect_concurrency = concurrency is None
+        self.detect_ram = available_ram_mb is None
+        self.reserved_ram_mb = reserved_ram_mb
         self.concurrency = concurrency
         self.available_ram_mb = available_ram_mb
         self.can_run_cpu_exec = can_run_cpu_exec
@@ -77,3 +135,143 @@ class WorkerFactory(ReconnectingClientFactory):
             self.name = platform.node()
         else:
             self.name = name
+        # A draining worker finishes its tasks, but gets no new ones.
+        self.draining = False
+        # Whether to exit when draining is finished.
+        self.exit_when_drained = False
+        # Established connection to sioworkersd, if any.
+        self.connection = None
+        # Running tasks, by task_id.
+        self.running = {}
+        # Results of tasks which finished while disconnected, by task_id.
+        self.finished = {}
+        # Running tasks which sioworkersd didn't know after reconnecting.
+        self.abandoned = set()
+        # Job types run, their sandboxes are likely installed.
+        self.job_types = set()
+        # Last summary of the cache sent to sioworkersd.
+        self.cache_summary = None
+        self.detectCapacity()
+
+    def getCapacity(self):
+        """Returns the capacity announced to sioworkersd."""
+        if self.draining or any(self.running[task_id]['job_type'] ==
+                'cpu-exec' for task_id in self.abandoned):
+            concurrency = 0
+        else:
+            concurrency = max(self.concurrency - len(self.abandoned), 0)
+        return {'concurrency': concurrency,
+                'available_ram_mb': self.available_ram_mb}
+
+    def detectCapacity(self):
+        """Detects the values which were not given explicitly and announces
+        them if they changed, e.g. after the cgroup limits were changed."""
+        concurrency = self.concurrency
+        available_ram_mb = self.available_ram_mb
+        if self.detect_concurrency:
+            concurrency = capacity.detect_cpus()
+        if self.detect_ram:
+            available_ram_mb = capacity.detect_ram_mb(self.reserved_ram_mb)
+        self.setCapacity(concurrency, available_ram_mb)
+
+    def setCapacity(self, concurrency, available_ram_mb):
+        if (concurrency, available_ram_mb) == \
+                (self.concurrency, self.available_ram_mb):
+            return
+        log.info('Capacity: {concurrency} jobs, {ram} MiB of RAM',
+                 concurrency=concurrency, ram=available_ram_mb)
+        self.concurrency = concurrency
+        self.available_ram_mb = available_ram_mb
+        self._announceCapacity()
+
+    def setDraining(self, draining):
+        if draining != self.draining:
+            log.info('Draining' if draining else 'No longer draining')
+            self.draining = draining
+            if draining:
+                # Lets the sandboxes be upgraded once running jobs finish.
+                sandbox.drain_leases()
+            self._announceCapacity()
+
+    def getCacheSummary(self):
+        """Returns a Bloom filter (see :mod:`sio.protocol.bloom`) of
+        recently cached filetracker paths and job types run, as a dict."""
+        cache = bloom.BloomFilter()
+        for path in ft.recently_cached():
+            cache.add(path)
+        for job_type in self.job_types:
+            cache.add(bloom.job_key(job_type))
+        self.cache_summary = cache.to_dict()
+        return self.cache_summary
+
+    def announceCache(self):
+        """Sends the summary of the cache if it changed."""
+        if self.connection is None:
+            return
+        previous = self.cache_summary
+        if self.getCacheSummary() == previous:
+            return
+        d = self.connection.call('update_cache', self.cache_summary)
+        d.addErrback(lambda failure: log.failure(
+                'Failed to update cache summary', failure, LogLevel.warn))
+
+    def keepResult(self, task_id, result):
+        """Keeps the result (an environ or a Failure) of a task until
+        sioworkersd collects it."""
+        if isinstance(result, Failure):
+            self.finished[task_id] = {'error': {
+                    'kind': 'exception', 'data': repr(result),
+                    'traceback': result.getTraceback()}}
+        else:
+            self.finished[task_id] = {'result': result}
+
+    def getFinished(self):
+        return [dict(outcome, task_id=task_id)
+                for task_id, outcome in six.iteritems(self.finished)]
+
+    def ackFinished(self, task_ids):
+        for task_id in task_ids:
+            self.finished.pop(task_id, None)
+        self.checkDrained()
+
+    def reportFinished(self):
+        """Sends the kept results, if connected. A task which was started
+        before reconnecting finishes this way."""
+        if self.connection is None or not self.finished:
+            return
+        finished = self.getFinished()
+        d = self.connection.call('report_finished', finished)
+        d.addCallback(lambda _: self.ackFinished(
+                [outcome['task_id'] for outcome in finished]))
+        # They stay kept, to be collected after reconnecting.
+        d.addErrback(lambda failure: log.failure(
+                'Failed to report finished tasks', failure, LogLevel.warn))
+
+    def drain(self):
+        self.exit_when_drained = True
+        self.setDraining(True)
+        self.checkDrained()
+
+    def checkDrained(self, x=None):
+        """Disconnects and stops the reactor after draining, when the
+        results of all tasks are reported (in replies, which are sent
+        before a delayed disconnection)."""
+        if self.exit_when_drained and not self.running and \
+                not self.finished:
+            def _exit():
+                log.info('Drained, exiting')
+                self.stopTrying()
+                if self.connection is not None:
+                    self.connection.transport.loseConnection()
+                reactor.stop()
+            reactor.callLater(0, _exit)
+            self.exit_when_drained = False
+        return x
+
+    def _announceCapacity(self):
+        # The hello message of a new connection carries the capacity.
+        if self.connection is None:
+            return
+        d = self.connection.call('update_capacity', self.getCapacity())
+        d.addErrback(lambda failure: log.failure(
+                'Failed to update capacity', failure, LogLevel.warn))
@@ -0,0 +1,144 @@
+"""Benchmark of encoding results in the reactor thread and in a process pool
+(see :mod:`sio.sioworkersd.offload`).
+
+Usage::
+
+    python -m sio.sioworkersd.bench_offload [--groups N] [--tasks N]
+        [--processes 0,2,4] [--json-only]
+
+For each pool size, ``--groups`` results of groups of ``--tasks`` tasks are
+encoded like by ``returnToSio``, all submitted at once. Reported are the
+throughput, the CPU time of the reactor thread per result and the latency
+of the reactor: delays of a timer which should fire every millisecond,
+which is what workers and RPC clients experience meanwhile.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import json
+import time
+
+from twisted.internet import defer, reactor, task
+
+from sio.sioworkersd import offload
+
+TICK = 0.001  # in seconds
+
+
+def _thread_time():
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+    return time.clock()
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def make_group_result(index, tasks):
+    """Returns a result of a group similar to these of rejudged
+       submissions."""
+    jobs = {}
+    results = {}
+    for i in range(tasks):
+        name = 'test%d' % i
+        jobs[name] = {
+            'job_type': 'vcpu-exec',
+            'task_id': 'urn:uuid:%d-%d' % (index, i),
+            'exe_file': '/submissions/%d.e' % index,
+            'in_file': '/tests/%d/%s.in' % (index % 10, name),
+            'hint_file': '/tests/%d/%s.out' % (index % 10, name),
+            'exec_time_limit': 1000 + i,
+            'exec_mem_limit': 2**18,
+            'check_output': True,
+        }
+        results[name] = dict(jobs[name], result_code='OK',
+                             result_string='ok %d %d' % (index, i),
+                             time_used=i * 7 % 1000, mem_used=1024 + i,
+                             result_percentage=100,
+                             timings=[{'phase': phase, 'wall': i * 0.1,
+                                       'cpu': i * 0.01}
+                                      for phase in ('download', 'exec',
+                                                    'checker')])
+    return {'group_id': 'GROUP_%d' % index,
+            'return_url': 'http://localhost/return/%d' % index,
+            'workers_jobs': jobs,
+            'workers_jobs.results': results}
+
+
+def encode_json(env):
+    return json.dumps(env)
+
+
+@defer.inlineCallbacks
+def measure(pool, function, envs):
+    delays = []
+    last = [time.time()]
+
+    def _tick():
+        now = time.time()
+        delays.append(max(now - last[0] - TICK, 0))
+        last[0] = now
+    ticker = task.LoopingCall(_tick)
+    ticker.start(TICK, now=False)
+
+    start = time.time()
+    cpu = _thread_time()
+    yield defer.gatherResults([pool.run(function, env) for env in envs])
+    elapsed = time.time() - start
+    cpu = _thread_time() - cpu
+    # The timer may have not fired at all if the reactor was busy.
+    _tick()
+    ticker.stop()
+    defer.returnValue({
+        'throughput': len(envs) / elapsed,
+        'reactor_cpu': cpu / len(envs),
+        'latency_p99': _percentile(delays, 0.99),
+        'latency_max': max(delays),
+    })
+
+
+@defer.inlineCallbacks
+def run(args):
+    envs = [make_group_result(i, args.tasks) for i in range(args.groups)]
+    function = encode_json if args.json_only else offload.encode_result
+    print('%d results of %d tasks, %.1f KiB of JSON each' % (args.groups,
+          args.tasks, len(json.dumps(envs[0])) / 1024.))
+    for processes in args.processes:
+        pool = offload.ProcessPool(processes)
+        pool.start()
+        try:
+            # Warm up the processes.
+            yield pool.run(function, envs[0])
+            report = yield measure(pool, function, envs)
+        finally:
+            pool.stop()
+        print('%d processes: %.1f results/s, reactor CPU %.2fms/result, '
+              'reactor latency p99 %.1fms, max %.1fms' % (processes,
+              report['throughput'], 1000 * report['reactor_cpu'],
+              1000 * report['latency_p99'], 1000 * report['latency_max']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--groups', type=int, default=100,
+                        help='number of results to encode')
+    parser.add_argument('--tasks', type=int, default=100,
+                        help='number of tasks in a group')
+    parser.add_argument('--processes', default='0,1,2,4',
+                        type=lambda value: [int(n) for n in value.split(',')],
+                        help='comma-separated pool sizes to measure')
+    parser.add_argument('--json-only', action='store_true',
+                        help='measure only JSON encoding, without the '
+                             'multipart body')
+    args = parser.parse_args()
+
+    d = run(args)
+    d.addErrback(lambda failure: failure.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""Metrics of sioworkersd in the Prometheus text format.
+
+Metrics are plain counters updated where things happen, so that serving
+them (at ``/metrics`` of the RPC port) costs only formatting. They are
+defined in the modules which update them and registered in
+:data:`REGISTRY`::
+
+    TASKS = Counter('sioworkersd_tasks_total', 'Tasks received.',
+                    ['job_type'])
+    TASKS.labels('vcpu-exec').inc()
+
+This module does not depend on Twisted, so that schedulers may be
+instrumented as well.
+"""
+from __future__ import absolute_import
+import math
+
+import six
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#: Buckets (upper bounds, in seconds) used for histograms by default.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        if any(m.name == metric.name for m in self.metrics):
+            raise ValueError('Duplicate metric %s' % metric.name)
+        self.metrics.append(metric)
+
+    def render(self):
+        """Returns all metrics in the text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name,
+                    metric.documentation.replace('\\', r'\\')
+                                        .replace('\n', r'\n')))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend(metric.samples())
+        return ''.join(line + '\n' for line in lines)
+
+
+REGISTRY = Registry()
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def _escape(value):
+    return six.text_type(value).replace('\\', r'\\').replace('"', r'\"') \
+            .replace('\n', r'\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in zip(names, values))
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(),
+                 registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self.labels()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """Returns the child metric for the given label values."""
+        if len(values) != len(self.labelnames):
+            raise ValueError('%s expects labels %r' % (self.name,
+                                                       self.labelnames))
+        values = tuple(six.text_type(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def remove(self, *values):
+        self._children.pop(tuple(six.text_type(value) for value in values),
+                           None)
+
+    def clear(self):
+        self._children.clear()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        for values, child in sorted(six.iteritems(self._children)):
+            for line in child.samples(self.name, self.labelnames, values):
+                yield line
+
+    # Shortcuts for metrics without labels.
+    def __getattr__(self, name):
+        if name.startswith('_') or self.labelnames:
+            raise AttributeError(name)
+        return getattr(self.labels(), name)
+
+
+class _Value(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labelnames, values):
+        yield '%s%s %s' % (name, _format_labels(labelnames, values),
+                           _format_value(self.value))
+
+
+class _GaugeValue(_Value):
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    """A value which only goes up."""
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+
+class Gauge(_Metric):
+    """A value which may go up and down."""
+    type = 'gauge'
+
+    def _new_child(self):
+        return _GaugeValue()
+
+
+class _HistogramValue(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def samples(self, name, labelnames, values):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield '%s_bucket%s %s' % (name,
+                    _format_labels(labelnames + ('le',),
+                                   values + (_format_value(bound),)),
+                    _format_value(total))
+        labels = _format_labels(labelnames, values)
+        yield '%s_sum%s %s' % (name, labels, _format_value(self.sum))
+        yield '%s_count%s %s' % (name, labels, _format_value(self.count))
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, counted in ``buckets``."""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super(Histogram, self).__init__(name, documentation, labelnames,
+                                        registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
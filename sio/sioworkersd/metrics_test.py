@@ -0,0 +1,54 @@
+from __future__ import absolute_import
+import unittest
+
+from sio.sioworkersd import metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter_and_gauge_should_be_rendered(self):
+        counter = metrics.Counter('test_total', 'Some "things".',
+                                  registry=self.registry)
+        gauge = metrics.Gauge('test_gauge', 'Queue\nlength.', ['queue'],
+                              registry=self.registry)
+        counter.inc()
+        counter.inc(2)
+        gauge.labels('a').inc(5)
+        gauge.labels('a').dec()
+        gauge.labels('b"\\').set(1.5)
+        self.assertEqual(self.registry.render(),
+            '# HELP test_total Some "things".\n'
+            '# TYPE test_total counter\n'
+            'test_total 3.0\n'
+            '# HELP test_gauge Queue\\nlength.\n'
+            '# TYPE test_gauge gauge\n'
+            'test_gauge{queue="a"} 4.0\n'
+            'test_gauge{queue="b\\"\\\\"} 1.5\n')
+        gauge.remove('a')
+        self.assertNotIn('queue="a"', self.registry.render())
+
+    def test_histogram_should_count_cumulatively(self):
+        histogram = metrics.Histogram('test_seconds', 'Time.', ['kind'],
+                                      buckets=(1, 0.1),
+                                      registry=self.registry)
+        for value in (0.05, 0.5, 0.7, 3):
+            histogram.labels('x').observe(value)
+        self.assertEqual(self.registry.render().splitlines()[2:], [
+            'test_seconds_bucket{kind="x",le="0.1"} 1.0',
+            'test_seconds_bucket{kind="x",le="1.0"} 3.0',
+            'test_seconds_bucket{kind="x",le="+Inf"} 4.0',
+            'test_seconds_sum{kind="x"} 4.25',
+            'test_seconds_count{kind="x"} 4.0'])
+
+    def test_labels_should_be_checked(self):
+        gauge = metrics.Gauge('test_gauge', 'Gauge.', ['worker'],
+                              registry=self.registry)
+        with self.assertRaises(ValueError):
+            gauge.labels()
+        with self.assertRaises(AttributeError):
+            gauge.inc()
+        with self.assertRaises(ValueError):
+            metrics.Counter('test_gauge', 'Duplicate.',
+                            registry=self.registry)
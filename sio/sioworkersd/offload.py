@@ -0,0 +1,107 @@
+"""Offloading CPU-heavy work of sioworkersd to other processes.
+
+Everything in sioworkersd runs on a single reactor thread. Scheduling has to
+stay there, but pure functions of picklable data may run in a pool of
+processes, so that the reactor spends less time on them. Passing the data
+costs pickling it, which is several times cheaper than encoding it to JSON.
+
+The pool is started with ``--offload-processes N``. With 0 (the default)
+functions are called in the reactor thread, as before.
+
+See :mod:`sio.sioworkersd.bench_offload` for a benchmark.
+"""
+from __future__ import absolute_import
+import json
+import multiprocessing
+import signal
+import traceback
+
+import six
+from twisted.internet import defer, reactor
+from twisted.logger import Logger
+
+log = Logger()
+
+
+class OffloadError(Exception):
+    """Raised when an offloaded function fails, with its traceback, or
+       when it cannot be passed to the pool."""
+    pass
+
+
+def _init_process():
+    # Processes are forked from the reactor and inherit its signal handlers,
+    # which would make them ignore ``terminate()``. Ctrl-C is handled by
+    # the parent.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _call(function, args):
+    # Exceptions may not be picklable, so only the traceback is passed back.
+    try:
+        return True, function(*args)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+class ProcessPool(object):
+    def __init__(self, processes=0):
+        self.processes = processes
+        self._pool = None
+
+    def start(self):
+        """Forks the processes. Functions run before are called in the
+           reactor thread."""
+        if self.processes > 0 and self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes,
+                                              _init_process)
+            log.info('Started {n} offload processes', n=self.processes)
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def run(self, function, *args):
+        """Calls ``function(*args)`` in the pool. Returns a Deferred firing
+           with its result in the reactor thread. ``function`` has to be
+           defined at the top level of a module."""
+        if self._pool is None:
+            return defer.maybeDeferred(function, *args)
+
+        d = defer.Deferred()
+
+        def _done(result):
+            # Called in a thread of the pool.
+            success, value = result
+            if success:
+                reactor.callFromThread(d.callback, value)
+            else:
+                reactor.callFromThread(d.errback, OffloadError(value))
+
+        def _failed(exception):
+            # Called in a thread of the pool when the call or its result
+            # cannot be pickled.
+            reactor.callFromThread(d.errback, OffloadError(
+                    '%s: %s' % (type(exception).__name__, exception)))
+
+        kwargs = {'callback': _done}
+        if not six.PY2:
+            # Python 2 pools have no way of reporting such errors.
+            kwargs['error_callback'] = _failed
+        self._pool.apply_async(_call, (function, args), **kwargs)
+        return d
+
+
+#: Pool running functions in the reactor thread.
+inline = ProcessPool()
+
+
+def encode_result(env):
+    """Encodes ``env`` for returning it to SIO. Returns the body of the
+       request and a dictionary of its headers."""
+    from poster import encode
+    bodygen, headers = encode.multipart_encode({'data': json.dumps(env)})
+    return ''.join(bodygen), headers
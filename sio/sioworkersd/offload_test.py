@@ -0,0 +1,21 @@
+from __future__ import absolute_import
+import unittest
+
+from sio.sioworkersd import offload
+
+
+def _fail(message):
+    raise ValueError(message)
+
+
+class OffloadTest(unittest.TestCase):
+    def test_inline_pool_should_call_function(self):
+        results = []
+        offload.inline.run(divmod, 7, 2).addCallback(results.append)
+        self.assertEqual(results, [(3, 1)])
+
+    def test_call_should_pass_traceback_of_failure(self):
+        success, value = offload._call(_fail, ('broken',))
+        self.assertFalse(success)
+        self.assertIn('ValueError: broken', value)
+        self.assertEqual(offload._call(divmod, (7, 2)), (True, (3, 1)))
@@ -0,0 +1,53 @@
+"""Measuring how long the reactor thread is blocked.
+
+Everything in sioworkersd shares one reactor thread, so while it decodes a
+large message or syncs the database, no worker nor RPC client is served.
+:class:`ReactorMonitor` measures it as the delay of a periodic timer.
+"""
+from __future__ import absolute_import
+from twisted.application.service import Service
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+
+from sio.sioworkersd.metrics import Counter, Histogram
+
+log = Logger()
+
+REACTOR_LAG = Histogram('sioworkersd_reactor_lag_seconds',
+        'Delay of a periodic timer of the reactor.',
+        buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+REACTOR_STALLS = Counter('sioworkersd_reactor_stalls_total',
+        'Delays of the reactor longer than the stall threshold.')
+
+
+class ReactorMonitor(Service):
+    """Checks every ``interval`` seconds how late a timer fires. Delays of
+       at least ``threshold`` seconds are logged as stalls."""
+
+    def __init__(self, interval=0.1, threshold=0.5, clock=reactor):
+        self.interval = interval
+        self.threshold = threshold
+        self.clock = clock
+        self._last = None
+        self._timer = LoopingCall(self._tick)
+        self._timer.clock = clock
+
+    def startService(self):
+        Service.startService(self)
+        self._last = self.clock.seconds()
+        self._timer.start(self.interval, now=False)
+
+    def stopService(self):
+        if self._timer.running:
+            self._timer.stop()
+        return Service.stopService(self)
+
+    def _tick(self):
+        now = self.clock.seconds()
+        lag = max(now - self._last - self.interval, 0)
+        self._last = now
+        REACTOR_LAG.observe(lag)
+        if lag >= self.threshold:
+            REACTOR_STALLS.inc()
+            log.warn('Reactor was blocked for {lag:.3f}s', lag=lag)
@@ -0,0 +1,25 @@
+from __future__ import absolute_import
+import unittest
+
+from twisted.internet import task
+
+from sio.sioworkersd import reactormonitor
+
+
+class ReactorMonitorTest(unittest.TestCase):
+    def test_stalls_should_be_counted(self):
+        clock = task.Clock()
+        monitor = reactormonitor.ReactorMonitor(interval=0.1, threshold=0.5,
+                                                clock=clock)
+        lags = reactormonitor.REACTOR_LAG.labels()
+        stalls = reactormonitor.REACTOR_STALLS.labels()
+        count, lag_sum, stall_count = lags.count, lags.sum, stalls.value
+        monitor.startService()
+        clock.advance(0.1)
+        clock.advance(0.1)
+        # The reactor was blocked and the timer fired late.
+        clock.advance(2)
+        monitor.stopService()
+        self.assertEqual(lags.count - count, 3)
+        self.assertAlmostEqual(lags.sum - lag_sum, 1.9)
+        self.assertEqual(stalls.value - stall_count, 1)
@@ -1,3 +1,6 @@
+import six
+
+
 class Scheduler(object):
     """Abstract scheduler interface.
     """
@@ -9,6 +12,10 @@ class Scheduler(object):
         Used for debugging and displaying in admin panel."""
         raise NotImplementedError()
 
+    if six.PY3:
+        def __str__(self):
+            return self.__unicode__()
+
     def updateContest(self, contest_uid, priority, weight):
         """Update contest prioriy and weight in scheduler memory."""
         pass
@@ -21,6 +28,11 @@ class Scheduler(object):
         """Will be called when a worker disappears."""
         pass
 
+    def updateWorker(self, worker_id):
+        """Will be called when concurrency or RAM of a worker changes. It may
+        be lower than what its running tasks already use."""
+        pass
+
     def addTask(self, env):
         """Add a new task to queue."""
         raise NotImplementedError()
@@ -34,6 +46,28 @@ class Scheduler(object):
         (task_id, worker_id)."""
         raise NotImplementedError()
 
+    def getQueueSummary(self, top=0):
+        """Return a dictionary describing queued tasks, with a list of
+        ``contests`` which have some. Each of them is a dictionary with
+        ``contest_uid``, the number of ``queued`` tasks, ``queued_by_priority``
+        (a list of pairs (task priority, number of tasks)) and ``top``, the
+        ``top`` tasks to be scheduled first (see :meth:`getQueuedTasks`).
+
+        It should take time proportional to the size of the result, not to
+        the number of queued tasks."""
+        raise NotImplementedError()
+
+    def getQueuedTasks(self, contest_uid, offset=0, limit=100):
+        """Return a page of tasks of the contest waiting for a worker, in
+        the order they will be scheduled. Tasks are dictionaries with at
+        least ``task_id``."""
+        raise NotImplementedError()
+
+    def getWaitingRealCpuTasks(self, offset=0, limit=100):
+        """Return a page of real-cpu tasks which have been scheduled, but
+        wait for a free worker, like :meth:`getQueuedTasks`."""
+        return []
+
 
 def getDefaultSchedulerClassName():
     return 'sio.sioworkersd.scheduler.prioritizing.PrioritizingScheduler'
@@ -43,17 +43,38 @@ judged exclusively on a worker (at most one at a time).
 Virtual-cpu task is non cpu-exec job. Most often it is judged on virtual
 cpu. It can be judged on any worker (any-cpu or vcpu-only).
 Virtual-cpu tasks can be judged simultaneously on one worker.
+
+Among equally suitable workers, those which advertise having the task's
+files cached and having run its job type (see :mod:`sio.protocol.bloom`)
+are preferred.
+
+Virtual-cpu tasks with the same ``affinity_key`` (e.g. tests of one
+submission, see ``group_affinity`` of
+:class:`sio.sioworkersd.taskmanager.TaskManager`) are packed onto workers
+already running some of them, if any of these has a free slot and enough
+RAM. This only affects the choice of a worker, not of a task, so it doesn't
+change the order in which contests and tasks are judged.
 """
 
 from __future__ import absolute_import
 from collections import OrderedDict
+from itertools import islice
 from random import Random
 from sortedcontainers import SortedList, SortedSet
 
+from sio.protocol import bloom
+from sio.sioworkersd.metrics import Gauge
 from sio.sioworkersd.scheduler import Scheduler
-from sio.sioworkersd.utils import get_required_ram_for_job
+from sio.sioworkersd.utils import get_cache_keys, get_required_ram_for_job
 import six
 
+QUEUED_TASKS = Gauge('sioworkersd_scheduler_queued_tasks',
+        'Tasks in queues of the prioritizing scheduler.', ['queue'])
+
+# At most that many equally suitable workers are compared by their caches
+# for a real-cpu task.
+CACHE_LOOKUP_WORKERS = 16
+
 
 class _WaitingTasksQueue(object):
     """A FIFO queue of tasks that keeps track of RAM limits.
@@ -77,6 +98,9 @@ class _WaitingTasksQueue(object):
     def __len__(self):
         return len(self._dict)
 
+    def __iter__(self):
+        return iter(self._dict)
+
     def __nonzero__(self):
         return bool(self._dict)
 
@@ -85,10 +109,12 @@ class _WaitingTasksQueue(object):
     def add(self, task):
         self._dict[task] = True
         self._tasks_required_ram.add(task.required_ram_mb)
+        QUEUED_TASKS.labels('waiting-real-cpu').inc()
 
     def remove(self, task):
         del self._dict[task]
         self._tasks_required_ram.discard(task.required_ram_mb)
+        QUEUED_TASKS.labels('waiting-real-cpu').dec()
 
     def left(self):
         if self._dict:
@@ -99,6 +125,7 @@ class _WaitingTasksQueue(object):
     def popleft(self):
         task = self._dict.popitem(False)[0]
         self._tasks_required_ram.discard(task.required_ram_mb)
+        QUEUED_TASKS.labels('waiting-real-cpu').dec()
         return task
 
     def getTasksRequiredRam(self):
@@ -112,15 +139,13 @@ class WorkerInfo(object):
     """
 
     def __init__(self, wid, wdata):
-        assert wdata.concurrency > 0
-        assert wdata.available_ram_mb > 0
         assert wdata.is_running_cpu_exec is False
         assert len(wdata.tasks) == 0
         # Immutable data
         self.id = wid
-        self.concurrency = wdata.concurrency
-        self.total_ram_mb = wdata.available_ram_mb
         self.cpu_enabled = wdata.can_run_cpu_exec
+        # Capacity, may be changed with update().
+        self.update(wdata)
 
         # Mutable data
         # Whether this worker is currently running real-cpu task.
@@ -130,13 +155,22 @@ class WorkerInfo(object):
         # Amount of RAM that can be potentially used by current tasks.
         self.used_ram_mb = 0
 
+    def update(self, wdata):
+        """Takes the new capacity of the worker. Must not be called while
+        the worker is in a queue."""
+        # A draining worker has no slots.
+        assert wdata.concurrency >= 0
+        assert wdata.available_ram_mb > 0
+        self.concurrency = wdata.concurrency
+        self.total_ram_mb = wdata.available_ram_mb
+
     # for Python 3 compatibility
     def __lt__(self, other):
         return self.id < other.id
 
     def getQueueName(self):
         if (self.is_running_real_cpu
-                or self.running_tasks == self.concurrency):
+                or self.running_tasks >= self.concurrency):
             return None
         elif self.cpu_enabled:
             return 'any-cpu'
@@ -161,7 +195,7 @@ class WorkerInfo(object):
         if self.is_running_real_cpu:
             return 0
         else:
-            return self.concurrency - self.running_tasks
+            return max(self.concurrency - self.running_tasks, 0)
 
     def attachTask(self, task):
         assert self.running_tasks < self.concurrency
@@ -205,6 +239,10 @@ class TaskInfo(object):
         self.required_ram_mb = get_required_ram_for_job(env)
         self.priority = env.get('task_priority', 0)
         self.contest = contest
+        self.affinity_key = env.get('affinity_key')
+        self.cache_keys = get_cache_keys(env)
+        # Computed once for all workers' filters with default parameters.
+        self.cache_indexes = [bloom.indexes(key) for key in self.cache_keys]
         TaskInfo.sequence_counter += 1
         self.sequence_number = TaskInfo.sequence_counter
         # Mutable data
@@ -229,6 +267,8 @@ class ContestInfo(object):
         # Mutable data
         self.priority = priority
         self.weight = weight
+        # Map: task priority -> number of queued tasks
+        self.queued = {}
 
 
 class TasksQueues(object):
@@ -331,6 +371,8 @@ class PrioritizingScheduler(Scheduler):
 
         # Worker scheduling data
         self.workers = {}  # Map: worker_id -> worker
+        # Map: affinity key -> {worker: number of its tasks assigned to it}
+        self.affinity = {}
         # Queues of workers which are not full (free or partially free).
         self.workers_queues = {
             'vcpu-only': SortedSet(),
@@ -362,9 +404,17 @@ class PrioritizingScheduler(Scheduler):
     def __unicode__(self):
         """Admin-friendly text representation of the queue.
 
-           Used for debugging and displaying in the admin panel.
+           Used for debugging and displaying in the admin panel. Only the
+           numbers of tasks are given, see :meth:`getQueueSummary` for
+           details.
         """
-        return six.text_type((self.tasks_queues, self.waiting_real_cpu_tasks))
+        queues = self.tasks_queues
+        return u'%d queued tasks (%d virtual-cpu) from %d contests, ' \
+                u'%d real-cpu tasks waiting for a worker' % (
+                sum(len(q) for q in six.itervalues(queues['both'].queues)),
+                sum(len(q) for q in
+                    six.itervalues(queues['virtual-cpu'].queues)),
+                len(queues['both'].queues), len(self.waiting_real_cpu_tasks))
 
     # Worker scheduling
 
@@ -392,22 +442,44 @@ class PrioritizingScheduler(Scheduler):
         del self.workers[worker_id]
         self._removeWorkerFromQueue(worker)
 
+    def updateWorker(self, worker_id):
+        """Will be called when concurrency or RAM of a worker changes."""
+        worker = self.workers[worker_id]
+        self._removeWorkerFromQueue(worker)
+        worker.update(self.manager.getWorkers()[worker_id])
+        self._insertWorkerToQueue(worker)
+
     def _getAnyCpuQueueSize(self):
         return len(self.workers_queues['any-cpu'])
 
+    def _getCacheHits(self, worker, task):
+        """Returns how many of the task's cache keys the worker has, as far
+        as its Bloom filter tells. The cost is bounded by the number of keys
+        times the number of hashes."""
+        cache = self.manager.getWorkers()[worker.id].cache
+        if cache is None:
+            return 0
+        if (cache.bits, cache.hashes) == (bloom.BITS, bloom.HASHES):
+            return sum(1 for idx in task.cache_indexes
+                       if cache.contains_indexes(idx))
+        return sum(1 for key in task.cache_keys if key in cache)
+
     def _getBestWorkerForVirtualCpuTask(
-            self, queue, task_ram, prefer_busy=False):
+            self, queue, task, prefer_busy=False):
         """Selects a worker from the queue best suited for a given task.
 
         The algorithm used picks a worker such that
         getAvailableRam() / getAvailableVcpuSlots() is the closest
-        possible to task RAM limit between all viable workers.
+        possible to task RAM limit between all viable workers. Ties are
+        broken by cache hits (see _getCacheHits).
 
         If prefer_busy flag is set to True, partially busy workers are given
         higher priority than completely empty ones.
 
         Returns None if there are no viable workers.
         """
+        task_ram = task.required_ram_mb
+
         def suitability(worker):
             worker_optimal_ram = (
                     worker.getAvailableRam() / worker.getAvailableVcpuSlots())
@@ -419,14 +491,29 @@ class PrioritizingScheduler(Scheduler):
                 return -difference
 
         assigned_worker = None
+        assigned_suitability = None
+        # Computed lazily, only on ties.
+        assigned_hits = None
         for worker in queue:
             # getAvailableVcpuSlots() should never be 0 in normal conditions
             # because fully busy workers shouldn't be added to queues.
             if (worker.getAvailableRam() >= task_ram
                     and worker.getAvailableVcpuSlots() > 0):
+                worker_suitability = suitability(worker)
                 if (assigned_worker is None
-                        or suitability(worker) > suitability(assigned_worker)):
+                        or worker_suitability > assigned_suitability):
                     assigned_worker = worker
+                    assigned_suitability = worker_suitability
+                    assigned_hits = None
+                elif (worker_suitability == assigned_suitability
+                        and task.cache_keys):
+                    if assigned_hits is None:
+                        assigned_hits = self._getCacheHits(
+                                assigned_worker, task)
+                    hits = self._getCacheHits(worker, task)
+                    if hits > assigned_hits:
+                        assigned_worker = worker
+                        assigned_hits = hits
 
         # Performance note: the execution time is linear in relation to
         # the worker queue size. This should not be a problem, but it's
@@ -435,16 +522,32 @@ class PrioritizingScheduler(Scheduler):
 
         return assigned_worker
 
-    def _getBestVcpuOnlyWorkerForVirtualCpuTask(self, task_ram):
-        """Returns a vcpu-only worker suitable for a task with given RAM limit.
+    def _getPackedWorkerForVirtualCpuTask(
+            self, queue, task, prefer_busy=False):
+        """Like _getBestWorkerForVirtualCpuTask, but first considers only
+        the workers running tasks with the same affinity key.
+
+        The cost of this is linear in the number of such workers.
+        """
+        packed = self.affinity.get(task.affinity_key)
+        if packed:
+            worker = self._getBestWorkerForVirtualCpuTask(
+                    sorted(w for w in packed if w in queue), task,
+                    prefer_busy)
+            if worker is not None:
+                return worker
+        return self._getBestWorkerForVirtualCpuTask(queue, task, prefer_busy)
+
+    def _getBestVcpuOnlyWorkerForVirtualCpuTask(self, task):
+        """Returns a vcpu-only worker suitable for a given task.
 
         If there are no suitable workers (each worker is fully used, or
         doesn't have enough RAM available), returns None.
         """
-        return self._getBestWorkerForVirtualCpuTask(
-            self.workers_queues['vcpu-only'], task_ram)
+        return self._getPackedWorkerForVirtualCpuTask(
+            self.workers_queues['vcpu-only'], task)
 
-    def _getBestAnyCpuWorkerForVirtualCpuTask(self, task_ram):
+    def _getBestAnyCpuWorkerForVirtualCpuTask(self, task):
         """Returns any-cpu worker suitable for running given virtual-cpu task.
 
         If there are no suitable workers (each worker is fully used, or
@@ -453,10 +556,10 @@ class PrioritizingScheduler(Scheduler):
         In this algorithm we prefer workers which are partially used, see
         _scheduleOnce for details.
         """
-        return self._getBestWorkerForVirtualCpuTask(
-            self.workers_queues['any-cpu'], task_ram, prefer_busy=True)
+        return self._getPackedWorkerForVirtualCpuTask(
+            self.workers_queues['any-cpu'], task, prefer_busy=True)
 
-    def _getBestAnyCpuWorkerForRealCpuTask(self, task_ram):
+    def _getBestAnyCpuWorkerForRealCpuTask(self, task):
         """Returns any-cpu worker suitable for running a given real-cpu task.
 
         The worker must be completely empty and have enough RAM (more than
@@ -468,14 +571,31 @@ class PrioritizingScheduler(Scheduler):
         # just enough for the task. To pick this worker, linear search is
         # performed on all free workers. Binary search could be used instead,
         # but it isn't necessary faster for small queue sizes.
+        task_ram = task.required_ram_mb
+        best = None
         for worker in self.workers_queues['any-cpu']:
             if worker.running_tasks > 0:
                 # All workers are partially busy.
-                return None
+                break
             if worker.getAvailableRam() >= task_ram:
-                return worker
-
-        return None
+                best = worker
+                break
+        if best is None or not task.cache_keys:
+            return best
+
+        # Prefer a worker with the task's files among the following ones
+        # with the same amount of RAM.
+        queue = self.workers_queues['any-cpu']
+        start = queue.index(best)
+        best_hits = self._getCacheHits(best, task)
+        for worker in queue.islice(start + 1, start + CACHE_LOOKUP_WORKERS):
+            if (worker.running_tasks > 0
+                    or worker.getAvailableRam() != best.getAvailableRam()):
+                break
+            hits = self._getCacheHits(worker, task)
+            if hits > best_hits:
+                best, best_hits = worker, hits
+        return best
 
     # Task scheduling
 
@@ -493,18 +613,31 @@ class PrioritizingScheduler(Scheduler):
             contest.weight = weight
 
     def _addTaskToQueues(self, task):
+        queued = task.contest.queued
+        queued[task.priority] = queued.get(task.priority, 0) + 1
         if not task.real_cpu:
             self.tasks_queues['virtual-cpu'].addTask(task)
+            QUEUED_TASKS.labels('virtual-cpu').inc()
         self.tasks_queues['both'].addTask(task)
+        QUEUED_TASKS.labels('both').inc()
 
     def _removeTaskFromQueues(self, task):
+        queued = task.contest.queued
+        queued[task.priority] -= 1
+        if not queued[task.priority]:
+            del queued[task.priority]
         if not task.real_cpu:
             self.tasks_queues['virtual-cpu'].delTask(task)
+            QUEUED_TASKS.labels('virtual-cpu').dec()
         self.tasks_queues['both'].delTask(task)
+        QUEUED_TASKS.labels('both').dec()
 
     def _attachTaskToWorker(self, task, worker):
         assert task.assigned_worker is None
         task.assigned_worker = worker
+        if task.affinity_key is not None:
+            packed = self.affinity.setdefault(task.affinity_key, {})
+            packed[worker] = packed.get(worker, 0) + 1
 
         self._removeWorkerFromQueue(worker)
         worker.attachTask(task)
@@ -523,6 +656,8 @@ class PrioritizingScheduler(Scheduler):
         assert task_id in self.tasks
         task = self.tasks.pop(task_id)
         if task.assigned_worker:
+            if task.affinity_key is not None:
+                self._detachAffinity(task)
             self._removeWorkerFromQueue(task.assigned_worker)
             task.assigned_worker.detachTask(task)
             self._insertWorkerToQueue(task.assigned_worker)
@@ -531,6 +666,14 @@ class PrioritizingScheduler(Scheduler):
         else:
             self._removeTaskFromQueues(task)
 
+    def _detachAffinity(self, task):
+        packed = self.affinity[task.affinity_key]
+        packed[task.assigned_worker] -= 1
+        if not packed[task.assigned_worker]:
+            del packed[task.assigned_worker]
+            if not packed:
+                del self.affinity[task.affinity_key]
+
     def _getNumberOfBlockedAnyCpuWorkers(self):
         """Returns the number of any cpu workers that are "blocked".
 
@@ -597,7 +740,7 @@ class PrioritizingScheduler(Scheduler):
             vcpu_task = self.tasks_queues['virtual-cpu'].chooseTask()
             if vcpu_task:
                 vcpu_worker = self._getBestVcpuOnlyWorkerForVirtualCpuTask(
-                    vcpu_task.required_ram_mb)
+                    vcpu_task)
                 if vcpu_worker:
                     self._removeTaskFromQueues(vcpu_task)
                     self._attachTaskToWorker(vcpu_task, vcpu_worker)
@@ -610,7 +753,7 @@ class PrioritizingScheduler(Scheduler):
         waiting_rcpu_task = self.waiting_real_cpu_tasks.left()
         if waiting_rcpu_task:
             rcpu_worker = self._getBestAnyCpuWorkerForRealCpuTask(
-                waiting_rcpu_task.required_ram_mb)
+                waiting_rcpu_task)
             if rcpu_worker:
                 self.waiting_real_cpu_tasks.popleft()
                 self._attachTaskToWorker(waiting_rcpu_task, rcpu_worker)
@@ -639,7 +782,7 @@ class PrioritizingScheduler(Scheduler):
             task = self.tasks_queues['both'].chooseTask()
             if not task.real_cpu:
                 worker = self._getBestAnyCpuWorkerForVirtualCpuTask(
-                    task.required_ram_mb)
+                    task)
                 # It's possible that no worker has enough RAM for this task.
                 # In this case, we do nothing and simply wait until some worker
                 # (possibly vcpu-only) is now available.
@@ -649,7 +792,7 @@ class PrioritizingScheduler(Scheduler):
                     return task.id, worker.id
             else:
                 worker = self._getBestAnyCpuWorkerForRealCpuTask(
-                    task.required_ram_mb)
+                    task)
                 if worker:
                     self._removeTaskFromQueues(task)
                     self._attachTaskToWorker(task, worker)
@@ -676,3 +819,55 @@ class PrioritizingScheduler(Scheduler):
                 break
             result.append(association)
         return result
+
+    # Queue inspection
+
+    @staticmethod
+    def _describeTask(task):
+        return {'task_id': task.id,
+                'real_cpu': task.real_cpu,
+                'priority': task.priority,
+                'required_ram_mb': task.required_ram_mb}
+
+    @staticmethod
+    def _page(queue, offset, limit):
+        # Tasks with the highest priority are at the end of the queue.
+        stop = max(len(queue) - offset, 0)
+        return [PrioritizingScheduler._describeTask(task) for task in
+                queue.islice(max(stop - limit, 0), stop, reverse=True)]
+
+    def getQueueSummary(self, top=0):
+        """Returns numbers of queued tasks per contest and task priority
+           with ``top`` tasks of each contest, and the number of real-cpu
+           tasks waiting for a worker.
+        """
+        contests = []
+        for contest, queue in six.iteritems(self.tasks_queues['both'].queues):
+            contests.append({
+                'contest_uid': contest.uid,
+                'priority': contest.priority,
+                'weight': contest.weight,
+                'queued': len(queue),
+                'queued_by_priority': sorted(six.iteritems(contest.queued),
+                                             reverse=True),
+                'top': self._page(queue, 0, top),
+            })
+        contests.sort(key=lambda c: (-c['priority'], -c['queued']))
+        return {
+            'queued': sum(c['queued'] for c in contests),
+            'queued_virtual_cpu': sum(len(q) for q in six.itervalues(
+                    self.tasks_queues['virtual-cpu'].queues)),
+            'waiting_real_cpu': len(self.waiting_real_cpu_tasks),
+            'contests': contests,
+        }
+
+    def getQueuedTasks(self, contest_uid, offset=0, limit=100):
+        contest = self.contests.get(contest_uid)
+        queue = self.tasks_queues['both'].queues.get(contest)
+        if queue is None:
+            return []
+        return self._page(queue, offset, limit)
+
+    def getWaitingRealCpuTasks(self, offset=0, limit=100):
+        return [self._describeTask(task) for task in
+                islice(self.waiting_real_cpu_tasks, offset, offset + limit)]
@@ -2,6 +2,7 @@ from __future__ import absolute_import
 import random
 import unittest
 
+from sio.protocol import bloom
 from sio.sioworkersd.scheduler import prioritizing
 import six
 from six.moves import range
@@ -256,6 +257,76 @@ class PrioritizingSchedulerTest(unittest.TestCase):
         # Third task should be blocked.
         six.assertCountEqual(self, [(1, 1), (2, 1)], scheduled_tasks)
 
+    def test_should_prefer_workers_with_cached_files(self):
+        cache = bloom.BloomFilter()
+        cache.add('/exe/a')
+        manager = WorkerManagerStub(
+            {'id': 1, 'concurrency': 2, 'ram': 8192, 'is_real_cpu': True},
+            {'id': 2, 'concurrency': 2, 'ram': 8192, 'is_real_cpu': True,
+             'cache': cache},
+            {'id': 3, 'concurrency': 2, 'ram': 8192, 'is_real_cpu': False},
+            {'id': 4, 'concurrency': 2, 'ram': 8192, 'is_real_cpu': False,
+             'cache': cache})
+        scheduler = prioritizing.PrioritizingScheduler(manager)
+        for i in range(1, 5):
+            scheduler.addWorker(i)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+
+        add_task_to_scheduler(scheduler, 1, is_real_cpu=False,
+                              exe_file='/exe/a')
+        self.assertEqual(scheduler.schedule(), [(1, 4)])
+        add_task_to_scheduler(scheduler, 2, is_real_cpu=True,
+                              exe_file='/exe/a')
+        self.assertEqual(scheduler.schedule(), [(2, 2)])
+
+    def test_should_pack_tasks_with_the_same_affinity_key(self):
+        manager = WorkerManagerStub(
+            {'id': 1, 'concurrency': 2, 'ram': 1024, 'is_real_cpu': False},
+            {'id': 2, 'concurrency': 4, 'ram': 1024, 'is_real_cpu': False})
+        scheduler = prioritizing.PrioritizingScheduler(manager)
+        scheduler.addWorker(1)
+        scheduler.addWorker(2)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+
+        add_task_to_scheduler(scheduler, 1, is_real_cpu=False, ram=256,
+                              affinity_key='a')
+        self.assertEqual(scheduler.schedule(), [(1, 2)])
+        # Worker 1 would suit it better without affinity.
+        add_task_to_scheduler(scheduler, 2, is_real_cpu=False, ram=512,
+                              affinity_key='a')
+        self.assertEqual(scheduler.schedule(), [(2, 2)])
+        # Not enough RAM left on worker 2.
+        add_task_to_scheduler(scheduler, 3, is_real_cpu=False, ram=512,
+                              affinity_key='a')
+        self.assertEqual(scheduler.schedule(), [(3, 1)])
+
+        for i in range(1, 4):
+            scheduler.delTask(i)
+        self.assertEqual(scheduler.affinity, {})
+
+    def test_should_follow_concurrency_updates_of_workers(self):
+        vcpu_only_worker = {
+            'id': 1, 'concurrency': 2, 'ram': 8192, 'is_real_cpu': False}
+        manager = WorkerManagerStub(vcpu_only_worker)
+        scheduler = prioritizing.PrioritizingScheduler(manager)
+        scheduler.addWorker(1)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+        for i in range(1, 5):
+            add_task_to_scheduler(scheduler, i, is_real_cpu=False, ram=256)
+
+        six.assertCountEqual(self, [(1, 1), (2, 1)], scheduler.schedule())
+
+        # Draining, with tasks still running.
+        manager.getWorkers()[1].concurrency = 0
+        scheduler.updateWorker(1)
+        self.assertEqual(scheduler.schedule(), [])
+        scheduler.delTask(1)
+        self.assertEqual(scheduler.schedule(), [])
+
+        manager.getWorkers()[1].concurrency = 3
+        scheduler.updateWorker(1)
+        six.assertCountEqual(self, [(3, 1), (4, 1)], scheduler.schedule())
+
     def test_should_assign_vcpu_tasks_to_any_cpu_workers_if_no_others(self):
         any_cpu_worker = {'id': 1, 'is_real_cpu': True}
 
@@ -409,6 +480,46 @@ class PrioritizingSchedulerTest(unittest.TestCase):
         # Now it should be OK.
         self.assertEqual(len(scheduled_tasks), 2)
 
+    def test_queue_summary_should_count_tasks_per_contest_and_priority(self):
+        scheduler = prioritizing.PrioritizingScheduler(WorkerManagerStub(
+            {'id': 1, 'concurrency': 2, 'is_real_cpu': True}))
+        scheduler.addWorker(1)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=1)
+        scheduler.updateContest(contest_uid=2, priority=20, weight=1)
+
+        for i in range(5):
+            add_task_to_scheduler(scheduler, i, contest_uid=1,
+                                  is_real_cpu=False, priority=i % 2)
+        add_task_to_scheduler(scheduler, 5, contest_uid=2,
+                              is_real_cpu=False, priority=1)
+        add_task_to_scheduler(scheduler, 6, contest_uid=2)
+
+        summary = scheduler.getQueueSummary(top=2)
+        self.assertEqual(summary['queued'], 7)
+        self.assertEqual(summary['queued_virtual_cpu'], 6)
+        self.assertEqual(summary['waiting_real_cpu'], 0)
+        self.assertEqual([c['contest_uid'] for c in summary['contests']],
+                         [2, 1])
+        self.assertEqual(summary['contests'][1]['queued_by_priority'],
+                         [(1, 2), (0, 3)])
+        self.assertEqual([t['task_id'] for t in
+                          summary['contests'][1]['top']], [1, 3])
+        self.assertEqual([t['task_id'] for t in
+                          scheduler.getQueuedTasks(1, offset=2, limit=2)],
+                         [0, 2])
+        self.assertEqual(scheduler.getQueuedTasks(3), [])
+
+        # Contest 2 goes first: task 5 runs and task 6 waits for the worker
+        # to become empty.
+        self.assertEqual(scheduler.schedule(), [(5, 1)])
+        summary = scheduler.getQueueSummary()
+        self.assertEqual(summary['queued'], 5)
+        self.assertEqual(summary['waiting_real_cpu'], 1)
+        self.assertEqual([t['task_id'] for t in
+                          scheduler.getWaitingRealCpuTasks()], [6])
+        self.assertEqual(summary['contests'][0]['top'], [])
+        self.assertIn('5 queued tasks', six.text_type(scheduler))
+
 
 class WorkerManagerStub(object):
     class WorkerDataStub(object):
@@ -418,6 +529,7 @@ class WorkerManagerStub(object):
             self.can_run_cpu_exec = wdata.get('is_real_cpu', False)
             self.is_running_cpu_exec = False
             self.tasks = []
+            self.cache = wdata.get('cache')
 
     def __init__(self, *workers):
         self.workerData = {
@@ -488,13 +600,19 @@ def add_task_to_scheduler(scheduler,
                           contest_uid=1,
                           is_real_cpu=True,
                           ram=256,
-                          priority=0):
+                          priority=0,
+                          exe_file=None,
+                          affinity_key=None):
     env = {
         'task_id': id,
-        'contest_uid': 1,
+        'contest_uid': contest_uid,
         'job_type': 'cpu-exec' if is_real_cpu else 'vcpu-exec',
         'exec_mem_limit': ram * 1024,
         'task_priority': priority,
     }
+    if exe_file is not None:
+        env['exe_file'] = exe_file
+    if affinity_key is not None:
+        env['affinity_key'] = affinity_key
 
     scheduler.addTask(env)
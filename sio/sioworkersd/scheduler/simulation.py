@@ -0,0 +1,413 @@
+"""Simulation of a scheduler on a recorded or synthetic workload.
+
+Usage::
+
+    python -m sio.sioworkersd.scheduler.simulation [options] [trace]
+
+Task groups from the trace are submitted at their times to the scheduler,
+which assigns tasks to simulated workers, like
+:class:`sio.sioworkersd.taskmanager.TaskManager` does: ``schedule()`` is
+called after each submission and after each finished task. Tasks take
+the time given in the trace, the time flows only in the simulation, so long
+workloads are simulated quickly. Workers report the same statistics as
+:class:`sio.sioworkersd.workermanager.WorkerManager`.
+
+A trace has one task group per line, as a JSON object sorted by ``time``
+(in seconds)::
+
+    {"time": 0.5, "contest_uid": "c1", "contest_priority": 0,
+     "contest_weight": 10, "tasks": [{"task_id": "g1-t1",
+     "job_type": "vcpu-exec", "task_priority": 0, "exec_mem_limit": 65536,
+     "duration": 1.2}, ...]}
+
+Keys of tasks other than ``duration`` are passed to the scheduler as their
+environments. Without a trace, a synthetic workload is generated (see
+:func:`generate_trace`), which may be saved with ``--save-trace``.
+
+The report contains:
+
+* latency of ``schedule()`` calls (wall clock time),
+* utilization of worker slots, overall and while some tasks were waiting
+  (a real-cpu task occupies all slots of its worker),
+* waiting times of real-cpu and virtual-cpu tasks,
+* contest fairness: for each assignment, every waiting contest with the
+  highest priority is owed a share proportional to its weight; the ratios
+  of received to owed assignments are summarized with Jain's index (1 means
+  perfectly fair).
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import heapq
+import importlib
+import json
+import sys
+import time
+from random import Random
+
+from sio.sioworkersd.scheduler import getDefaultSchedulerClassName
+from sio.sioworkersd.utils import get_workers_ram_stats
+import six
+
+
+class SimulatedWorker(object):
+    """Worker data, with the same attributes as
+       :class:`sio.sioworkersd.workermanager.Worker`."""
+
+    def __init__(self, concurrency, available_ram_mb, can_run_cpu_exec):
+        self.info = {'concurrency': concurrency,
+                     'available_ram_mb': available_ram_mb,
+                     'can_run_cpu_exec': can_run_cpu_exec}
+        self.tasks = set()
+        self.is_running_cpu_exec = False
+        self.concurrency = concurrency
+        self.available_ram_mb = available_ram_mb
+        self.can_run_cpu_exec = can_run_cpu_exec
+        self.cache = None
+
+    def busySlots(self):
+        if self.is_running_cpu_exec:
+            return self.concurrency
+        return len(self.tasks)
+
+
+class SimulatedManager(object):
+    """Worker manager for the scheduler, keeping simulated workers."""
+
+    def __init__(self):
+        self.workerData = {}
+        self.minAnyCpuWorkerRam = None
+        self.maxAnyCpuWorkerRam = None
+        self.minVcpuOnlyWorkerRam = None
+        self.maxVcpuOnlyWorkerRam = None
+
+    def getWorkers(self):
+        return self.workerData
+
+    def addWorker(self, worker_id, worker):
+        self.workerData[worker_id] = worker
+        (self.minAnyCpuWorkerRam, self.maxAnyCpuWorkerRam,
+         self.minVcpuOnlyWorkerRam, self.maxVcpuOnlyWorkerRam) = \
+                get_workers_ram_stats(self.workerData)
+
+    def delWorker(self, worker_id):
+        del self.workerData[worker_id]
+        (self.minAnyCpuWorkerRam, self.maxAnyCpuWorkerRam,
+         self.minVcpuOnlyWorkerRam, self.maxVcpuOnlyWorkerRam) = \
+                get_workers_ram_stats(self.workerData)
+
+    def updateWorker(self, worker_id, concurrency, available_ram_mb):
+        wd = self.workerData[worker_id]
+        wd.concurrency = wd.info['concurrency'] = concurrency
+        wd.available_ram_mb = wd.info['available_ram_mb'] = available_ram_mb
+        (self.minAnyCpuWorkerRam, self.maxAnyCpuWorkerRam,
+         self.minVcpuOnlyWorkerRam, self.maxVcpuOnlyWorkerRam) = \
+                get_workers_ram_stats(self.workerData)
+
+    def runOnWorker(self, worker_id, task):
+        """Checks the assignment like the real manager and starts the task."""
+        wd = self.workerData[worker_id]
+        if wd.is_running_cpu_exec:
+            raise RuntimeError(
+                    'Tried to send task to worker running cpu-exec job')
+        if len(wd.tasks) >= wd.concurrency:
+            raise RuntimeError('Tried to send task to fully loaded worker')
+        if task['job_type'] == 'cpu-exec':
+            if wd.tasks:
+                raise RuntimeError('Tried to send cpu-exec job to busy worker')
+            if not wd.can_run_cpu_exec:
+                raise RuntimeError("Tried to send cpu-exec job to worker "
+                                   "which isn't allowed to run them.")
+            wd.is_running_cpu_exec = True
+        wd.tasks.add(task['task_id'])
+
+    def finish(self, worker_id, task_id):
+        wd = self.workerData[worker_id]
+        wd.tasks.discard(task_id)
+        wd.is_running_cpu_exec = False
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def _summary(values):
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else 0.0,
+        'p50': _percentile(values, 0.5),
+        'p90': _percentile(values, 0.9),
+        'p99': _percentile(values, 0.99),
+        'max': max(values) if values else 0.0,
+    }
+
+
+class Simulation(object):
+    """Runs ``scheduler_class`` on task groups from ``trace`` with workers
+       given as a list of ``(concurrency, ram_mb, can_run_cpu_exec)``."""
+
+    def __init__(self, trace, workers, scheduler_class):
+        self.trace = trace
+        self.manager = SimulatedManager()
+        self.scheduler = scheduler_class(self.manager)
+        for i, (concurrency, ram, can_run_cpu_exec) in enumerate(workers):
+            self.manager.addWorker('worker%d' % i,
+                    SimulatedWorker(concurrency, ram, can_run_cpu_exec))
+            self.scheduler.addWorker('worker%d' % i)
+        self.total_slots = sum(w[0] for w in workers)
+
+        self.now = 0.0
+        self._events = []
+        self._sequence = 0
+        self._tasks = {}  # task_id -> (env, duration, arrival time)
+        self._contests = {}  # contest_uid -> (priority, weight)
+        self._waiting = {}  # contest_uid -> number of waiting tasks
+
+        self._latencies = []
+        self._busy_time = 0.0
+        self._backlogged_time = 0.0
+        self._backlogged_busy_time = 0.0
+        self._waits = {'real-cpu': [], 'virtual-cpu': []}
+        self._owed = {}
+        self._received = {}
+
+    def _push(self, when, kind, data):
+        self._sequence += 1
+        heapq.heappush(self._events, (when, self._sequence, kind, data))
+
+    def _advance(self, when):
+        elapsed = when - self.now
+        busy = sum(w.busySlots()
+                   for w in six.itervalues(self.manager.workerData))
+        self._busy_time += busy * elapsed
+        if any(six.itervalues(self._waiting)):
+            self._backlogged_time += elapsed
+            self._backlogged_busy_time += busy * elapsed
+        self.now = when
+
+    def _submit(self, group):
+        contest_uid = group.get('contest_uid')
+        priority = group.get('contest_priority', 0)
+        weight = group.get('contest_weight', 1)
+        self._contests[contest_uid] = (priority, weight)
+        self.scheduler.updateContest(contest_uid, priority, weight)
+        for task in group['tasks']:
+            env = dict((key, value) for key, value in six.iteritems(task)
+                       if key != 'duration')
+            env['contest_uid'] = contest_uid
+            self._tasks[env['task_id']] = (env, task['duration'], self.now)
+            self._waiting[contest_uid] = self._waiting.get(contest_uid, 0) + 1
+            self.scheduler.addTask(env)
+
+    def _account_fairness(self, contest_uid):
+        waiting = [uid for uid, count in six.iteritems(self._waiting)
+                   if count]
+        top = max(self._contests[uid][0] for uid in waiting)
+        if self._contests[contest_uid][0] != top:
+            return
+        competing = [uid for uid in waiting if self._contests[uid][0] == top]
+        total_weight = float(sum(self._contests[uid][1]
+                                 for uid in competing))
+        for uid in competing:
+            self._owed[uid] = self._owed.get(uid, 0.0) + \
+                    self._contests[uid][1] / total_weight
+        self._received[contest_uid] = self._received.get(contest_uid, 0) + 1
+
+    def _schedule(self):
+        start = time.time()
+        jobs = self.scheduler.schedule()
+        self._latencies.append(time.time() - start)
+        for task_id, worker_id in jobs:
+            env, duration, arrival = self._tasks[task_id]
+            self.manager.runOnWorker(worker_id, env)
+            self._account_fairness(env['contest_uid'])
+            self._waiting[env['contest_uid']] -= 1
+            kind = 'real-cpu' if env['job_type'] == 'cpu-exec' \
+                    else 'virtual-cpu'
+            self._waits[kind].append(self.now - arrival)
+            self._push(self.now + duration, 'done', (task_id, worker_id))
+
+    def run(self):
+        """Runs the simulation until all tasks are finished and returns
+           the report, see :meth:`report`."""
+        for group in self.trace:
+            self._push(group['time'], 'submit', group)
+        while self._events:
+            when, _, kind, data = heapq.heappop(self._events)
+            self._advance(when)
+            if kind == 'submit':
+                self._submit(data)
+            else:
+                task_id, worker_id = data
+                self.manager.finish(worker_id, task_id)
+                del self._tasks[task_id]
+                self.scheduler.delTask(task_id)
+            self._schedule()
+        if self._tasks:
+            raise RuntimeError('%d tasks were never scheduled'
+                               % len(self._tasks))
+        return self.report()
+
+    def report(self):
+        """Returns a dictionary with the results of the simulation.
+
+           Times are in seconds: ``schedule_latency`` of the real clock,
+           others of the simulated one.
+        """
+        ratios = dict((uid, self._received.get(uid, 0) / owed)
+                      for uid, owed in six.iteritems(self._owed) if owed)
+        values = list(ratios.values())
+        squares = sum(r * r for r in values)
+        capacity = self.total_slots * self.now
+        backlogged_capacity = self.total_slots * self._backlogged_time
+        return {
+            'makespan': self.now,
+            'schedule_calls': len(self._latencies),
+            'schedule_latency': _summary(self._latencies),
+            'utilization': self._busy_time / capacity if capacity else 0.0,
+            'backlogged_utilization': self._backlogged_busy_time
+                    / backlogged_capacity if backlogged_capacity else 0.0,
+            'real_cpu_wait': _summary(self._waits['real-cpu']),
+            'virtual_cpu_wait': _summary(self._waits['virtual-cpu']),
+            'fairness_index': sum(values) ** 2 / (len(values) * squares)
+                    if squares else 1.0,
+            'contest_shares': dict((six.text_type(uid), ratio)
+                                   for uid, ratio in six.iteritems(ratios)),
+        }
+
+
+def generate_trace(seed=0, groups=500, contests=5, tests=(5, 40),
+                   cpu_exec_ratio=0.1, duration=(0.05, 2.0),
+                   mem_limits=(64, 256, 512), interval=1.0):
+    """Generates task groups like submissions judged in a few contests.
+
+       Each group is a submission with a random number of ``tests`` (a
+       range) of one problem: all of them are ``cpu-exec`` with probability
+       ``cpu_exec_ratio``, have one of ``mem_limits`` (in MiB) and take
+       random ``duration`` (a range, in seconds). Submissions arrive on
+       average every ``interval`` seconds. Contests have random priorities
+       and weights.
+    """
+    random = Random(seed)
+    contest_info = [('contest%d' % i, random.choice((0, 0, 0, 1)),
+                     random.randint(1, 10)) for i in range(contests)]
+    trace = []
+    now = 0.0
+    for group in range(groups):
+        now += random.expovariate(1.0 / interval)
+        contest_uid, priority, weight = random.choice(contest_info)
+        job_type = 'cpu-exec' if random.random() < cpu_exec_ratio \
+                else 'vcpu-exec'
+        mem_limit = random.choice(mem_limits) * 1024
+        task_priority = random.randint(0, 2)
+        trace.append({
+            'time': now,
+            'contest_uid': contest_uid,
+            'contest_priority': priority,
+            'contest_weight': weight,
+            'tasks': [{
+                'task_id': 'g%d-t%d' % (group, test),
+                'job_type': job_type,
+                'task_priority': task_priority,
+                'exec_mem_limit': mem_limit,
+                'duration': random.uniform(*duration),
+            } for test in range(random.randint(*tests))],
+        })
+    return trace
+
+
+def load_trace(f):
+    """Reads a trace from file object ``f``."""
+    return [json.loads(line) for line in f if line.strip()]
+
+
+def save_trace(trace, f):
+    for group in trace:
+        f.write(json.dumps(group, sort_keys=True) + '\n')
+
+
+def import_scheduler(name):
+    module_name, class_name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def format_report(report):
+    lines = [
+        'Simulated time: %.1fs, schedule() calls: %d'
+                % (report['makespan'], report['schedule_calls']),
+        'schedule() latency: p50 %.3fms, p90 %.3fms, p99 %.3fms, '
+        'max %.3fms' % tuple(1000 * report['schedule_latency'][key]
+                             for key in ('p50', 'p90', 'p99', 'max')),
+        'Slot utilization: %.1f%% (%.1f%% while tasks were waiting)'
+                % (100 * report['utilization'],
+                   100 * report['backlogged_utilization']),
+    ]
+    for name, key in (('Real-cpu', 'real_cpu_wait'),
+                      ('Virtual-cpu', 'virtual_cpu_wait')):
+        wait = report[key]
+        lines.append('%s tasks wait: mean %.2fs, p90 %.2fs, max %.2fs '
+                     '(%d tasks)' % (name, wait['mean'], wait['p90'],
+                                     wait['max'], wait['count']))
+    lines.append('Contest fairness index: %.3f' % report['fairness_index'])
+    for uid, ratio in sorted(report['contest_shares'].items()):
+        lines.append('  %s: %.2f of its share' % (uid, ratio))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('trace', nargs='?',
+                        help='trace file (default: generate a workload)')
+    parser.add_argument('--scheduler', default=getDefaultSchedulerClassName(),
+                        help='scheduler class')
+    parser.add_argument('--workers', type=int, default=10,
+                        help='number of workers')
+    parser.add_argument('--cpu-workers', type=int, default=2,
+                        help='number of workers which can run cpu-exec jobs')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='concurrency of each worker')
+    parser.add_argument('--ram', type=int, default=4096,
+                        help='RAM of each worker in MiB')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the generated workload')
+    parser.add_argument('--groups', type=int, default=500,
+                        help='number of generated task groups')
+    parser.add_argument('--contests', type=int, default=5,
+                        help='number of generated contests')
+    parser.add_argument('--cpu-exec-ratio', type=float, default=0.1,
+                        help='fraction of generated cpu-exec groups')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='mean time between generated groups in seconds')
+    parser.add_argument('--save-trace', metavar='FILE',
+                        help='save the workload to FILE')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    if args.trace:
+        with open(args.trace) as f:
+            trace = load_trace(f)
+    else:
+        trace = generate_trace(seed=args.seed, groups=args.groups,
+                               contests=args.contests,
+                               cpu_exec_ratio=args.cpu_exec_ratio,
+                               interval=args.interval)
+    if args.save_trace:
+        with open(args.save_trace, 'w') as f:
+            save_trace(trace, f)
+
+    workers = [(args.concurrency, args.ram, i < args.cpu_workers)
+               for i in range(args.workers)]
+    report = Simulation(trace, workers,
+                        import_scheduler(args.scheduler)).run()
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
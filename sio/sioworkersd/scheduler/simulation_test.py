@@ -0,0 +1,82 @@
+from __future__ import absolute_import
+import unittest
+
+from six.moves import StringIO
+
+from sio.sioworkersd.scheduler import simulation
+from sio.sioworkersd.scheduler.prioritizing import PrioritizingScheduler
+
+WORKERS = [(4, 4096, True), (4, 4096, False), (2, 2048, False)]
+
+
+def create_group(time, contest_uid, tasks, priority=0, weight=1,
+                 job_type='vcpu-exec', duration=1.0):
+    return {
+        'time': time,
+        'contest_uid': contest_uid,
+        'contest_priority': priority,
+        'contest_weight': weight,
+        'tasks': [{'task_id': '%s-%s-%d' % (contest_uid, time, i),
+                   'job_type': job_type,
+                   'duration': duration} for i in range(tasks)],
+    }
+
+
+class SimulationTest(unittest.TestCase):
+    def test_generated_workload_should_be_fully_judged(self):
+        trace = simulation.generate_trace(groups=50)
+        report = simulation.Simulation(trace, WORKERS,
+                                       PrioritizingScheduler).run()
+        tasks = sum(len(group['tasks']) for group in trace)
+        self.assertEqual(report['real_cpu_wait']['count'] +
+                         report['virtual_cpu_wait']['count'], tasks)
+        self.assertGreater(report['utilization'], 0)
+        self.assertLessEqual(report['utilization'], 1)
+        self.assertLessEqual(report['fairness_index'], 1)
+        self.assertGreaterEqual(report['makespan'], trace[-1]['time'])
+
+    def test_trace_should_survive_saving_and_loading(self):
+        trace = simulation.generate_trace(groups=10, seed=42)
+        f = StringIO()
+        simulation.save_trace(trace, f)
+        f.seek(0)
+        self.assertEqual(simulation.load_trace(f), trace)
+
+    def test_single_slot_should_be_fully_utilized(self):
+        trace = [create_group(0, 'c1', 10)]
+        report = simulation.Simulation(trace, [(1, 4096, True)],
+                                       PrioritizingScheduler).run()
+        self.assertEqual(report['makespan'], 10)
+        self.assertEqual(report['utilization'], 1)
+        self.assertEqual(report['virtual_cpu_wait']['max'], 9)
+
+    def test_real_cpu_task_should_occupy_whole_worker(self):
+        trace = [create_group(0, 'c1', 2, job_type='cpu-exec')]
+        report = simulation.Simulation(trace, [(2, 4096, True)],
+                                       PrioritizingScheduler).run()
+        self.assertEqual(report['makespan'], 2)
+        self.assertEqual(report['utilization'], 1)
+        self.assertEqual(report['real_cpu_wait']['max'], 1)
+
+    def test_contests_should_get_shares_by_weight(self):
+        trace = [create_group(0, 'light', 200, weight=1),
+                 create_group(0, 'heavy', 200, weight=3)]
+        report = simulation.Simulation(trace, [(1, 4096, True)],
+                                       PrioritizingScheduler).run()
+        self.assertGreater(report['fairness_index'], 0.95)
+
+    def test_higher_priority_contest_should_wait_less(self):
+        trace = [create_group(0, 'low', 20, priority=0),
+                 create_group(0, 'high', 20, priority=1)]
+        report = simulation.Simulation(trace, [(1, 4096, True)],
+                                       PrioritizingScheduler).run()
+        self.assertEqual(report['fairness_index'], 1)
+        self.assertEqual(report['contest_shares']['high'], 1)
+
+    def test_manager_should_reject_invalid_assignments(self):
+        manager = simulation.SimulatedManager()
+        manager.addWorker('w', simulation.SimulatedWorker(2, 4096, False))
+        self.assertEqual(manager.minVcpuOnlyWorkerRam, 4096)
+        self.assertIsNone(manager.minAnyCpuWorkerRam)
+        with self.assertRaises(RuntimeError):
+            manager.runOnWorker('w', {'task_id': 1, 'job_type': 'cpu-exec'})
@@ -26,6 +26,7 @@ class Worker(object):
         self.tasks = tasks
         self.is_running_cpu_exec = False
         self.count_cpu_exec = 0
+        self.cache = None
         self.concurrency = int(info.get('concurrency', 1))
         # These old tests don't account for RAM, so we just put a large value.
         self.available_ram_mb = 8192
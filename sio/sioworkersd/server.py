@@ -2,10 +2,15 @@ from __future__ import absolute_import
 from twisted.internet.protocol import ServerFactory
 from twisted.internet import defer
 from sio.protocol import rpc
+from sio.sioworkersd import offload
+from sio.sioworkersd.metrics import Counter
 from twisted.logger import Logger
 
 log = Logger()
 
+LARGE_MESSAGES = Counter('sioworkersd_large_messages_total',
+        'Messages from workers decoded by the offload pool.')
+
 
 class DuplicateWorker(Exception):
     """A worker connected twice"""
@@ -20,6 +25,8 @@ class WorkerServer(rpc.WorkerRPC):
         self.ready.addCallback(self.established)
         self.name = None
         self.uniqueID = None
+        # Capacity announced before the worker was registered.
+        self.pendingCapacity = None
 
     def established(self, ignore=None):
         addr = self.transport.getPeer()
@@ -30,6 +37,23 @@ class WorkerServer(rpc.WorkerRPC):
                 addr=addr, name=self.name)
         return self.factory.workerConnected(self)
 
+    def cmd_update_capacity(self, info):
+        """Called by the worker when its concurrency or RAM changed."""
+        self.factory.manager.reportCapacity(self, info)
+
+    def cmd_update_cache(self, summary):
+        """Called by the worker with a new summary of its cache."""
+        self.factory.manager.updateWorkerCache(self.name, summary)
+
+    def cmd_report_finished(self, finished):
+        """Called by the worker with results of tasks which it started
+        before reconnecting (see ``get_finished`` of the worker)."""
+        self.factory.manager.deliverResults(self.name, finished)
+
+    def decodeLarge(self, string):
+        LARGE_MESSAGES.inc()
+        return self.factory.offload.run(rpc.decode, string)
+
     def connectionLost(self, reason):
         rpc.WorkerRPC.connectionLost(self, reason)
         self.factory.workerDisconnected(self)
@@ -40,8 +64,9 @@ class WorkerServerFactory(ServerFactory):
     protocol = WorkerServer
     workers = {}
 
-    def __init__(self, manager):
+    def __init__(self, manager, offload_pool=offload.inline):
         self.manager = manager
+        self.offload = offload_pool
         self.ignore_set = set()
 
     @defer.inlineCallbacks
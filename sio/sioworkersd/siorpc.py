@@ -2,13 +2,18 @@ from __future__ import absolute_import
 import json
 from functools import wraps
 from twisted.web.xmlrpc import XMLRPC
-from twisted.web import server
+from twisted.web import resource, server
 from uuid import uuid4
 from twisted.logger import Logger
 import six
 
+from sio.sioworkersd import metrics
+
 log = Logger()
 
+# Maximum number of tasks returned by a single queue inspection call.
+MAX_PAGE_SIZE = 1000
+
 def escape_arguments(func):
     def unpack(a):
         try:
@@ -43,9 +48,36 @@ class SIORPC(XMLRPC):
                 'is_running_cpu_exec': v.is_running_cpu_exec})
         return ret
 
+    def xmlrpc_drain_worker(self, name):
+        """Stops sending tasks to the worker, which then finishes its
+        running tasks, reports them and exits (to be restarted e.g. by
+        supervisor)."""
+        d = self.workerm.drainWorker(name)
+        d.addCallback(lambda _: True)
+        return d
+
     def xmlrpc_get_queue(self):
+        """Returns a short text summary of the queue."""
         return self.taskm.getQueue()
 
+    def xmlrpc_get_queue_summary(self, top=10):
+        """Returns numbers of queued tasks per contest and task priority,
+           with ``top`` tasks of each contest to be scheduled first."""
+        return self.taskm.getQueueSummary(min(int(top), MAX_PAGE_SIZE))
+
+    @escape_arguments
+    def xmlrpc_get_queued_tasks(self, contest_uid, offset=0, limit=100):
+        """Returns a page of tasks of the contest waiting for a worker, in
+           the order they will be scheduled. ``contest_uid`` is a pair
+           ``[oioioi_instance, contest_id]``."""
+        return self.taskm.getQueuedTasks(tuple(contest_uid), int(offset),
+                                         min(int(limit), MAX_PAGE_SIZE))
+
+    def xmlrpc_get_waiting_real_cpu_tasks(self, offset=0, limit=100):
+        """Returns a page of real-cpu tasks waiting for a free worker."""
+        return self.taskm.getWaitingRealCpuTasks(int(offset),
+                min(int(limit), MAX_PAGE_SIZE))
+
     def _prepare_group(self, env):
         tasks = env['workers_jobs']
         group_id = 'GROUP_' + uuid4().urn
@@ -68,6 +100,21 @@ class SIORPC(XMLRPC):
         return self.taskm.addTaskGroup(env)
 
 
+class MetricsResource(resource.Resource):
+    """Serves :mod:`sio.sioworkersd.metrics` for Prometheus."""
+    isLeaf = True
+
+    def __init__(self, registry=metrics.REGISTRY):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type',
+                          metrics.CONTENT_TYPE.encode('ascii'))
+        return self.registry.render().encode('utf-8')
+
+
 def makeSite(workerm, taskm):
     p = SIORPC(workerm, taskm)
+    p.putChild(b'metrics', MetricsResource())
     return server.Site(p)
@@ -11,10 +11,11 @@ import json
 import six
 from six import StringIO
 from six.moves import range
-from poster import encode
 import time
 from operator import itemgetter
 from sio.protocol.rpc import RemoteError
+from sio.sioworkersd import offload
+from sio.sioworkersd.metrics import Counter, Gauge, Histogram
 from sio.sioworkersd.utils import get_required_ram_for_job
 from sio.sioworkersd.workermanager import WorkerGone
 from twisted.logger import Logger, LogLevel
@@ -38,6 +39,38 @@ DB_SYNC_INTERVAL_IN_SEC = 10
 # failure.
 DB_SYNC_RESTART_INTERVAL_IN_SEC = 60 * 60
 
+# Histogram buckets for task latencies, in seconds.
+TASK_LATENCY_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600)
+
+QUEUED_TASKS = Gauge('sioworkersd_queued_tasks',
+        'Tasks waiting for a worker.', ['contest'])
+TASK_QUEUE_TIME = Histogram('sioworkersd_task_queue_seconds',
+        'Time from queueing a task to starting it on a worker.',
+        ['job_type'], buckets=TASK_LATENCY_BUCKETS)
+TASK_RUN_TIME = Histogram('sioworkersd_task_run_seconds',
+        'Time from starting a task on a worker to its completion.',
+        ['job_type'], buckets=TASK_LATENCY_BUCKETS)
+SCHEDULE_DURATION = Histogram('sioworkersd_schedule_duration_seconds',
+        'Time spent in schedule() of the scheduler.',
+        buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+RETURN_RETRIES = Counter('sioworkersd_return_retries_total',
+        'Repeated attempts of returning results to SIO.')
+RETURN_FAILURES = Counter('sioworkersd_return_failures_total',
+        'Results which could not be returned to SIO.')
+JOB_PHASE_TIME = Histogram('sioworkersd_job_phase_seconds',
+        'Wall time of phases of jobs, as reported by workers.', ['phase'],
+        buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60))
+JOB_PHASE_CPU_TIME = Histogram('sioworkersd_job_phase_cpu_seconds',
+        'CPU time of workers (without child processes) spent in phases of '
+        'jobs.', ['phase'],
+        buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60))
+DB_SYNC_DURATION = Histogram('sioworkersd_db_sync_duration_seconds',
+        'Time of syncing the task database to disk.')
+
+
+def _contest_label(env):
+    return '%s:%s' % tuple(env['contest_uid'])
+
 
 class MultiException(Exception):
     def __init__(self, desc, excs):
@@ -56,7 +89,7 @@ class DBWrapper(object):
         # For better performance we are allowing some tasks to be executed
         # multiple times in case of server failure. Hence, we are skipping
         # specific database sync and doing it later with LoopingCall.
-        self.db_sync_task = LoopingCall(self.db.sync)
+        self.db_sync_task = LoopingCall(self.sync)
 
     def start_periodic_sync(self):
         def restart_db_sync_task(failure, task):
@@ -69,6 +102,11 @@ class DBWrapper(object):
                          .addErrback(restart_db_sync_task,
                                      task=self.db_sync_task)
 
+    def sync(self):
+        start = time.time()
+        self.db.sync()
+        DB_SYNC_DURATION.observe(time.time() - start)
+
     def get_items(self):
         return [json.loads(self.db[k]) for k in self.db.keys()]
 
@@ -77,22 +115,31 @@ class DBWrapper(object):
         job.update(dict_update)
         self.db[job_id] = json.dumps(job)
         if sync:
-            self.db.sync()
+            self.sync()
 
     def delete(self, job_id, sync=False):
         # Check self.db_sync_task to know why sync is False by default
         del self.db[job_id]
         if sync:
-            self.db.sync()
+            self.sync()
 
 
 class TaskManager(Service):
-    def __init__(self, db_filename, workerm, sched, max_task_ram_mb):
+    def __init__(self, db_filename, workerm, sched, max_task_ram_mb,
+                 offload_pool=offload.inline, group_affinity=False):
+        """With ``group_affinity``, tasks of a group without an explicit
+        ``affinity_key`` get their ``exe_file`` or group id as one, so that
+        the scheduler may run them on the same worker."""
         self.workerm = workerm
+        self.group_affinity = group_affinity
+        self.offload = offload_pool
         self.database = DBWrapper(db_filename)
         self.scheduler = sched
         self.max_task_ram_mb = max_task_ram_mb
         self.inProgress = {}
+        # Times of queueing and starting tasks, for metrics.
+        self.queuedAt = {}
+        self.startedAt = {}
         # If a connection pool and/or keepalive is necessary
         # in the future, add it here.
         self.agent = client.Agent(reactor)
@@ -122,6 +169,7 @@ class TaskManager(Service):
                                    count=job['retry_cnt'])
         self.workerm.notifyOnNewWorker(self._newWorker)
         self.workerm.notifyOnLostWorker(self._lostWorker)
+        self.workerm.notifyOnUpdatedWorker(self._updatedWorker)
         self._tryExecute()
 
     def _newWorker(self, name):
@@ -132,13 +180,20 @@ class TaskManager(Service):
         self.scheduler.delWorker(name)
         self._tryExecute()
 
+    def _updatedWorker(self, name):
+        self.scheduler.updateWorker(name)
+        self._tryExecute()
+
     def _tryExecute(self, x=None):
         # Note: this function might be called _very_ often, which might be
         # a performance problem for complex schedulers, especially during
         # rejudges. A solution exists, but it is a bit complex.
+        start = time.time()
         jobs = self.scheduler.schedule()
+        SCHEDULE_DURATION.observe(time.time() - start)
         for (task_id, worker) in jobs:
             task = self.inProgress[task_id]
+            self._taskStarted(task.env)
             d = self.workerm.runOnWorker(worker, task.env)
 
             def _retry_on_disconnect(failure, task_id=task_id, task=task):
@@ -152,6 +207,8 @@ class TaskManager(Service):
                 # someone could write a scheduler that requires this
                 self.scheduler.delTask(task_id)
                 self.scheduler.addTask(task.env)
+                del self.startedAt[task_id]
+                self._taskQueued(task.env)
 
             # chain manually - we don't want to errback d when retrying
             d.addCallbacks(task.d.callback, _retry_on_disconnect)
@@ -159,6 +216,40 @@ class TaskManager(Service):
         # as a (transparent) callback
         return x
 
+    def _taskQueued(self, env):
+        self.queuedAt[env['task_id']] = time.time()
+        QUEUED_TASKS.labels(_contest_label(env)).inc()
+
+    def _taskDequeued(self, env):
+        label = _contest_label(env)
+        queued = QUEUED_TASKS.labels(label)
+        queued.dec()
+        # Contests come and go, so their series are not kept forever.
+        if queued.value <= 0:
+            QUEUED_TASKS.remove(label)
+
+    def _taskStarted(self, env):
+        now = time.time()
+        TASK_QUEUE_TIME.labels(env['job_type']).observe(
+                now - self.queuedAt.pop(env['task_id']))
+        self._taskDequeued(env)
+        self.startedAt[env['task_id']] = now
+
+    def _taskFinished(self, env, result):
+        if isinstance(result, dict):
+            for timing in result.get('timings', ()):
+                JOB_PHASE_TIME.labels(timing['phase']).observe(
+                        timing['wall'] / 1000.)
+                JOB_PHASE_CPU_TIME.labels(timing['phase']).observe(
+                        timing['cpu'] / 1000.)
+        tid = env['task_id']
+        if tid in self.startedAt:
+            TASK_RUN_TIME.labels(env['job_type']).observe(
+                    time.time() - self.startedAt.pop(tid))
+        elif tid in self.queuedAt:
+            del self.queuedAt[tid]
+            self._taskDequeued(env)
+
     def _taskDone(self, x, tid):
         if isinstance(x, Failure):
             self.inProgress[tid].env['error'] = {
@@ -180,6 +271,7 @@ class TaskManager(Service):
             # or `self.database` itself.
         if self.inProgress[tid].env.get('group_id') != tid:
             self.scheduler.delTask(tid)
+            self._taskFinished(self.inProgress[tid].env, x)
         del self.inProgress[tid]
         log.info("Task {tid} finished.", tid=tid)
         self._tryExecute()
@@ -198,6 +290,15 @@ class TaskManager(Service):
     def getQueue(self):
         return six.text_type(self.scheduler)
 
+    def getQueueSummary(self, top=0):
+        return self.scheduler.getQueueSummary(top)
+
+    def getQueuedTasks(self, contest_uid, offset=0, limit=100):
+        return self.scheduler.getQueuedTasks(contest_uid, offset, limit)
+
+    def getWaitingRealCpuTasks(self, offset=0, limit=100):
+        return self.scheduler.getWaitingRealCpuTasks(offset, limit)
+
     def _addGroup(self, group_env):
         singleTasks = []
         idMap = {}
@@ -208,8 +309,12 @@ class TaskManager(Service):
             group_env.get('contest_weight', 1))
         for k, v in six.iteritems(group_env['workers_jobs']):
             v['contest_uid'] = contest_uid
+            if self.group_affinity:
+                v.setdefault('affinity_key',
+                             v.get('exe_file') or group_env['group_id'])
             idMap[v['task_id']] = k
             self.scheduler.addTask(v)
+            self._taskQueued(v)
             singleTasks.append(self._deferTask(v))
         self.inProgress[group_env['group_id']] = Task(group_env, None)
         d = defer.DeferredList(singleTasks, consumeErrors=True)
@@ -278,15 +383,12 @@ class TaskManager(Service):
         if not tid:
             tid = env['group_id']
 
-        bodygen, hdr = encode.multipart_encode({
-                        'data': json.dumps(env)})
-        body = ''.join(bodygen)
-
-        headers = Headers({'User-Agent': ['sioworkersd']})
-        for k, v in six.iteritems(hdr):
-            headers.addRawHeader(k, v)
+        def do_return(encoded):
+            body, hdr = encoded
+            headers = Headers({'User-Agent': ['sioworkersd']})
+            for k, v in six.iteritems(hdr):
+                headers.addRawHeader(k, v)
 
-        def do_return():
             # This looks a bit too complicated for just POSTing a string,
             # but there seems to be no other way. Blame Twisted.
 
@@ -309,7 +411,16 @@ class TaskManager(Service):
                     raise RuntimeError('Failed to return task')
             d.addCallback(_response)
             return d
-        ret = do_return()
+
+        # Encoding large results takes a while, so it may be done by
+        # another process.
+        encoded = []
+
+        def _send(x):
+            encoded.append(x)
+            return do_return(x)
+        ret = self.offload.run(offload.encode_result, env)
+        ret.addCallback(_send)
 
         def _updateCount(x, n):
             self.database.update(tid, {'retry_cnt': n}, sync=False)
@@ -320,16 +431,21 @@ class TaskManager(Service):
             return x  # Transparent callback
 
         def retry(err, retry_cnt):
+            if not encoded:
+                log.failure('Failed to encode {tid}', err, tid=tid)
+                return
             if retry_cnt >= MAX_RETRIES_OF_RESULT_RETURNING:
+                RETURN_FAILURES.inc()
                 log.error('Failed to return {tid} {count} times, giving up.',
                           tid=tid, count=retry_cnt)
                 return
             log.warn('Returning {tid} to url {url} failed, retrying[{n}]...',
                      tid=tid, url=url, n=retry_cnt)
             log.failure('error was:', err, LogLevel.info)
+            RETURN_RETRIES.inc()
             d = deferLater(reactor,
                            RETRY_DELAY_OF_RESULT_RETURNING[retry_cnt],
-                           do_return)
+                           do_return, encoded[0])
             d.addBoth(_updateCount, n=retry_cnt)
             d.addErrback(retry, retry_cnt + 1)
             return d
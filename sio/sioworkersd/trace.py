@@ -0,0 +1,365 @@
+"""Recording and replaying of what the scheduler sees.
+
+When ``sioworkersd`` is run with ``--trace-file``, the scheduler is wrapped
+in :class:`TracingScheduler`, which writes every call it gets (``addWorker``,
+``delWorker``, ``updateWorker``, ``updateContest``, ``addTask``,
+``delTask``) and every
+assignment made by ``schedule()`` to a trace, one JSON object per line::
+
+    {"time": 1500000000.25, "event": "addTask", "env": {...}}
+    {"time": 1500000000.25, "event": "schedule", "duration": 0.0001,
+     "jobs": [["task_id", "worker_id"]]}
+
+Only the keys of task environments which matter for scheduling are kept
+(see :data:`SCHEDULING_KEYS`). Task durations follow from the times of
+``schedule`` and ``delTask`` events. The trace is rotated like logs:
+``FILE`` is renamed to ``FILE.1`` (and so on) when it exceeds the size
+limit. Writes are buffered and flushed at most every second.
+
+The recorded calls can be replayed against any scheduler class::
+
+    python -m sio.sioworkersd.trace [--scheduler CLASS] [--simulate] FILE...
+
+Files are given in chronological order (e.g. ``FILE.2 FILE.1 FILE``). By
+default the calls are repeated in the recorded order, reporting latency of
+``schedule()`` and the slowest moments. With ``--simulate`` the recorded task
+groups and durations are turned into a workload for
+:mod:`sio.sioworkersd.scheduler.simulation`, which shows how the scheduler
+would have handled the traffic.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+from sio.sioworkersd.scheduler import getDefaultSchedulerClassName
+import six
+
+#: Keys of task environments needed by schedulers.
+SCHEDULING_KEYS = ('task_id', 'job_type', 'contest_uid', 'task_priority',
+                   'check_output', 'batch_parallelism')
+
+#: Time after which buffered events are written to the file, in seconds.
+FLUSH_INTERVAL = 1.0
+
+
+def scheduling_env(env):
+    """Returns the part of task environment ``env`` used by schedulers."""
+    result = dict((key, env[key]) for key in SCHEDULING_KEYS if key in env)
+    for key, value in six.iteritems(env):
+        if key.endswith('_mem_limit'):
+            result[key] = value
+    if isinstance(env.get('tests'), list):
+        result['tests'] = [scheduling_env(test) for test in env['tests']]
+    return result
+
+
+class TraceRecorder(object):
+    """Writes events to ``filename``, keeping up to ``backup_count`` old
+       files of at most ``max_bytes`` each."""
+
+    def __init__(self, filename, max_bytes=64 * 2**20, backup_count=5,
+                 clock=time.time):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.clock = clock
+        self._file = None
+        self._size = 0
+        self._last_flush = 0
+        self._open()
+
+    def _open(self):
+        self._file = io.open(self.filename, 'ab')
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            source = '%s.%d' % (self.filename, i)
+            if os.path.exists(source):
+                os.rename(source, '%s.%d' % (self.filename, i + 1))
+        if self.backup_count:
+            os.rename(self.filename, self.filename + '.1')
+        else:
+            os.unlink(self.filename)
+        self._open()
+
+    def record(self, event, **data):
+        now = self.clock()
+        data['time'] = now
+        data['event'] = event
+        line = (json.dumps(data, sort_keys=True, default=repr) + '\n') \
+                .encode('utf-8')
+        if self._size and self._size + len(line) > self.max_bytes:
+            self._rotate()
+        self._file.write(line)
+        self._size += len(line)
+        if now - self._last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self._file.flush()
+        self._last_flush = self.clock()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class TracingScheduler(object):
+    """Scheduler wrapper recording calls to ``scheduler`` with
+       ``recorder``. Other attributes are taken from the wrapped
+       scheduler."""
+
+    def __init__(self, scheduler, recorder):
+        self.scheduler = scheduler
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.scheduler, name)
+
+    def __unicode__(self):
+        return six.text_type(self.scheduler)
+
+    __str__ = __unicode__
+
+    def updateContest(self, contest_uid, priority, weight):
+        self.recorder.record('updateContest', contest_uid=contest_uid,
+                             priority=priority, weight=weight)
+        self.scheduler.updateContest(contest_uid, priority, weight)
+
+    def addWorker(self, worker_id):
+        worker = self.scheduler.manager.getWorkers()[worker_id]
+        self.recorder.record('addWorker', worker_id=worker_id,
+                             concurrency=worker.concurrency,
+                             available_ram_mb=worker.available_ram_mb,
+                             can_run_cpu_exec=worker.can_run_cpu_exec)
+        self.scheduler.addWorker(worker_id)
+
+    def delWorker(self, worker_id):
+        self.recorder.record('delWorker', worker_id=worker_id)
+        self.scheduler.delWorker(worker_id)
+
+    def updateWorker(self, worker_id):
+        worker = self.scheduler.manager.getWorkers()[worker_id]
+        self.recorder.record('updateWorker', worker_id=worker_id,
+                             concurrency=worker.concurrency,
+                             available_ram_mb=worker.available_ram_mb)
+        self.scheduler.updateWorker(worker_id)
+
+    def addTask(self, env):
+        self.recorder.record('addTask', env=scheduling_env(env))
+        self.scheduler.addTask(env)
+
+    def delTask(self, task_id):
+        self.recorder.record('delTask', task_id=task_id)
+        self.scheduler.delTask(task_id)
+
+    def schedule(self):
+        start = time.time()
+        jobs = self.scheduler.schedule()
+        if jobs:
+            self.recorder.record('schedule', duration=time.time() - start,
+                                 jobs=jobs)
+        return jobs
+
+
+def _hashable(value):
+    # Contest ids are tuples, which become lists in JSON.
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+def read_trace(filenames):
+    """Reads events from trace files given in chronological order."""
+    events = []
+    for filename in filenames:
+        with io.open(filename, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                if 'contest_uid' in event:
+                    event['contest_uid'] = _hashable(event['contest_uid'])
+                if 'env' in event and 'contest_uid' in event['env']:
+                    event['env']['contest_uid'] = \
+                            _hashable(event['env']['contest_uid'])
+                events.append(event)
+    return events
+
+
+def replay(events, scheduler_class, slowest=10):
+    """Feeds recorded calls to a new ``scheduler_class`` instance, calling
+       ``schedule()`` after each of them, like the task manager does.
+
+       Tasks are assigned to workers as the replayed scheduler decides and
+       finish when they finished in the recording. Tasks running on a worker
+       which disappears are queued again.
+
+       Returns a report with ``schedule()`` latency summary and ``slowest``
+       calls, with the recorded time and the number of waiting tasks.
+    """
+    from sio.sioworkersd.scheduler.simulation import SimulatedManager, \
+            SimulatedWorker, _summary
+
+    manager = SimulatedManager()
+    scheduler = scheduler_class(manager)
+    envs = {}
+    assigned = {}  # task_id -> worker_id
+    latencies = []
+    calls = []
+    for event in events:
+        kind = event['event']
+        if kind == 'updateContest':
+            scheduler.updateContest(event['contest_uid'], event['priority'],
+                                    event['weight'])
+        elif kind == 'addWorker':
+            manager.addWorker(event['worker_id'], SimulatedWorker(
+                    event['concurrency'], event['available_ram_mb'],
+                    event['can_run_cpu_exec']))
+            scheduler.addWorker(event['worker_id'])
+        elif kind == 'delWorker':
+            worker_id = event['worker_id']
+            for task_id in list(manager.getWorkers()[worker_id].tasks):
+                manager.finish(worker_id, task_id)
+                del assigned[task_id]
+                scheduler.delTask(task_id)
+                scheduler.addTask(envs[task_id])
+            manager.delWorker(worker_id)
+            scheduler.delWorker(worker_id)
+        elif kind == 'updateWorker':
+            manager.updateWorker(event['worker_id'], event['concurrency'],
+                                 event['available_ram_mb'])
+            scheduler.updateWorker(event['worker_id'])
+        elif kind == 'addTask':
+            envs[event['env']['task_id']] = event['env']
+            scheduler.addTask(event['env'])
+        elif kind == 'delTask':
+            task_id = event['task_id']
+            if task_id in assigned:
+                manager.finish(assigned.pop(task_id), task_id)
+            envs.pop(task_id, None)
+            scheduler.delTask(task_id)
+        else:
+            continue
+
+        start = time.time()
+        jobs = scheduler.schedule()
+        elapsed = time.time() - start
+        for task_id, worker_id in jobs:
+            manager.runOnWorker(worker_id, envs[task_id])
+            assigned[task_id] = worker_id
+        latencies.append(elapsed)
+        calls.append((elapsed, event['time'], len(envs) - len(assigned)))
+
+    calls.sort(reverse=True)
+    return {
+        'schedule_calls': len(latencies),
+        'schedule_latency': _summary(latencies),
+        'slowest': [{'duration': duration, 'time': when, 'waiting': waiting}
+                    for duration, when, waiting in calls[:slowest]],
+    }
+
+
+def to_simulation(events):
+    """Converts recorded events to a workload for
+       :class:`sio.sioworkersd.scheduler.simulation.Simulation`.
+
+       Returns a pair ``(trace, workers)``. Tasks added at the same moment
+       for the same contest form a group; tasks which never finished are
+       skipped. Workers are all workers seen in the recording.
+    """
+    start = events[0]['time'] if events else 0
+    contests = {}
+    started = {}
+    durations = {}
+    for event in events:
+        if event['event'] == 'schedule':
+            for task_id, _ in event['jobs']:
+                started[task_id] = event['time']
+        elif event['event'] == 'delTask' and event['task_id'] in started:
+            durations[event['task_id']] = \
+                    event['time'] - started.pop(event['task_id'])
+
+    trace = []
+    workers = {}
+    for event in events:
+        kind = event['event']
+        if kind == 'updateContest':
+            contests[event['contest_uid']] = (event['priority'],
+                                              event['weight'])
+        elif kind == 'addWorker':
+            workers[event['worker_id']] = (event['concurrency'],
+                                           event['available_ram_mb'],
+                                           event['can_run_cpu_exec'])
+        elif kind == 'addTask':
+            env = event['env']
+            if env['task_id'] not in durations:
+                continue
+            contest_uid = env.get('contest_uid')
+            when = event['time'] - start
+            if not trace or trace[-1]['time'] != when or \
+                    trace[-1]['contest_uid'] != contest_uid:
+                priority, weight = contests.get(contest_uid, (0, 1))
+                trace.append({'time': when, 'contest_uid': contest_uid,
+                              'contest_priority': priority,
+                              'contest_weight': weight, 'tasks': []})
+            task = dict(env, duration=durations[env['task_id']])
+            task.pop('contest_uid', None)
+            trace[-1]['tasks'].append(task)
+    return trace, [workers[worker_id] for worker_id in sorted(workers)]
+
+
+def main(argv=None):
+    from sio.sioworkersd.scheduler.simulation import Simulation, \
+            format_report, import_scheduler
+
+    parser = argparse.ArgumentParser(
+            description='Replays recorded scheduler calls.')
+    parser.add_argument('files', nargs='+',
+                        help='trace files in chronological order')
+    parser.add_argument('--scheduler', default=getDefaultSchedulerClassName(),
+                        help='scheduler class')
+    parser.add_argument('--simulate', action='store_true',
+                        help='simulate the recorded workload instead of '
+                             'repeating the calls')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    events = read_trace(args.files)
+    scheduler_class = import_scheduler(args.scheduler)
+    if args.simulate:
+        trace, workers = to_simulation(events)
+        report = Simulation(trace, workers, scheduler_class).run()
+    else:
+        report = replay(events, scheduler_class)
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    elif args.simulate:
+        print(format_report(report))
+    else:
+        latency = report['schedule_latency']
+        print('schedule() calls: %d, latency: p50 %.3fms, p90 %.3fms, '
+              'p99 %.3fms, max %.3fms' % ((report['schedule_calls'],) +
+              tuple(1000 * latency[key]
+                    for key in ('p50', 'p90', 'p99', 'max'))))
+        print('Slowest calls:')
+        for call in report['slowest']:
+            print('  %.3fms at %s with %d tasks waiting' % (
+                  1000 * call['duration'],
+                  time.strftime('%Y-%m-%d %H:%M:%S',
+                                time.localtime(call['time'])),
+                  call['waiting']))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+from sio.sioworkersd import trace
+from sio.sioworkersd.scheduler import simulation
+from sio.sioworkersd.scheduler.prioritizing import PrioritizingScheduler
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'trace')
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _record(self):
+        recorder = trace.TraceRecorder(self.filename, clock=self.clock)
+        manager = simulation.SimulatedManager()
+        scheduler = trace.TracingScheduler(PrioritizingScheduler(manager),
+                                           recorder)
+        manager.addWorker('w1', simulation.SimulatedWorker(2, 4096, True))
+        scheduler.addWorker('w1')
+        scheduler.updateContest(('sio', 1), 1, 2)
+        for i in range(3):
+            scheduler.addTask({'task_id': 't%d' % i, 'job_type': 'vcpu-exec',
+                               'contest_uid': ('sio', 1), 'task_priority': 0,
+                               'exec_mem_limit': 2**16,
+                               'file_to_ignore': 'x' * 100})
+        jobs = scheduler.schedule()
+        for task_id, worker_id in jobs:
+            manager.runOnWorker(worker_id, {'task_id': task_id,
+                                            'job_type': 'vcpu-exec'})
+        self.clock.now += 2
+        manager.finish('w1', 't0')
+        scheduler.delTask('t0')
+        manager.runOnWorker('w1', {'task_id': 't2', 'job_type': 'vcpu-exec'})
+        self.assertEqual(scheduler.schedule(), [('t2', 'w1')])
+        self.clock.now += 1
+        for task_id in ('t1', 't2'):
+            manager.finish('w1', task_id)
+            scheduler.delTask(task_id)
+        scheduler.delWorker('w1')
+        recorder.close()
+        return jobs
+
+    def test_events_should_be_recorded(self):
+        jobs = self._record()
+        self.assertEqual(len(jobs), 2)
+        events = trace.read_trace([self.filename])
+        self.assertEqual([event['event'] for event in events],
+                ['addWorker', 'updateContest', 'addTask', 'addTask',
+                 'addTask', 'schedule', 'delTask', 'schedule', 'delTask',
+                 'delTask', 'delWorker'])
+        self.assertEqual(events[0]['available_ram_mb'], 4096)
+        self.assertEqual(events[1]['contest_uid'], ('sio', 1))
+        self.assertEqual(events[2]['env'], {'task_id': 't0',
+                'job_type': 'vcpu-exec', 'contest_uid': ('sio', 1),
+                'task_priority': 0, 'exec_mem_limit': 2**16})
+
+    def test_trace_should_be_replayed(self):
+        self._record()
+        events = trace.read_trace([self.filename])
+        report = trace.replay(events, PrioritizingScheduler)
+        self.assertEqual(report['schedule_calls'], 9)
+        self.assertEqual(len(report['slowest']), 9)
+
+        workload, workers = trace.to_simulation(events)
+        self.assertEqual(workers, [(2, 4096, True)])
+        self.assertEqual(len(workload), 1)
+        self.assertEqual([task['duration'] for task in workload[0]['tasks']],
+                         [2, 3, 1])
+        self.assertEqual(workload[0]['contest_weight'], 2)
+        report = simulation.Simulation(workload, workers,
+                                       PrioritizingScheduler).run()
+        self.assertEqual(report['makespan'], 3)
+
+    def test_trace_should_be_rotated(self):
+        recorder = trace.TraceRecorder(self.filename, max_bytes=200,
+                                       backup_count=2, clock=self.clock)
+        for i in range(20):
+            recorder.record('delTask', task_id='t%d' % i)
+        recorder.close()
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['trace', 'trace.1', 'trace.2'])
+        events = trace.read_trace([self.filename + '.2',
+                                   self.filename + '.1', self.filename])
+        self.assertLess(len(events), 20)
+        self.assertEqual(events[-1]['task_id'], 't19')
+        for name in os.listdir(self.dir):
+            self.assertLessEqual(
+                    os.path.getsize(os.path.join(self.dir, name)), 200)
@@ -10,9 +10,10 @@ from twisted.internet import defer, interfaces, reactor, protocol, task
 from twisted.application.service import Application
 from zope.interface import implementer
 
-from sio.sioworkersd import workermanager, taskmanager, server
+from sio.sioworkersd import offload, workermanager, taskmanager, server
 from sio.sioworkersd.scheduler.prioritizing import PrioritizingScheduler
 from sio.sioworkersd.utils import get_required_ram_for_job
+from sio.workers.util import DEFAULT_BATCH_PARALLELISM
 from sio.protocol import rpc
 
 # debug
@@ -39,6 +40,7 @@ def _wrap_into_group_env(env):
 class TestWithDB(unittest.TestCase):
     """Abstract class for testing sioworkersd parts that need a database."""
     SAVED_TASKS = []
+    RESUME_TIMEOUT = 0
 
     def __init__(self, *args):
         super(TestWithDB, self).__init__(*args)
@@ -59,7 +61,7 @@ class TestWithDB(unittest.TestCase):
 
     def _prepare_svc(self):
         self.app = Application('test')
-        self.wm = workermanager.WorkerManager()
+        self.wm = workermanager.WorkerManager(self.RESUME_TIMEOUT)
         self.sched = PrioritizingScheduler(self.wm)
         self.taskm = taskmanager.TaskManager(self.db_path, self.wm, self.sched, max_task_ram_mb=2048)
 
@@ -104,6 +106,20 @@ class TaskManagerTest(TestWithDB):
                          'contest_uid': (None, None)}))
         return d
 
+    def test_queued_tasks_of_finished_contests_are_not_reported(self):
+        def _queue(_):
+            envs = [{'task_id': tid, 'job_type': 'ping',
+                     'contest_uid': ('c', 1)} for tid in ('t1', 't2')]
+            for env in envs:
+                self.taskm._taskQueued(env)
+            self.taskm._taskStarted(envs[0])
+            self.assertEqual(
+                    taskmanager.QUEUED_TASKS.labels('c:1').value, 1)
+            self.taskm._taskFinished(envs[1], None)
+            self.assertNotIn(('c:1',),
+                             taskmanager.QUEUED_TASKS._children)
+        return self._prepare_svc().addCallback(_queue)
+
 
 @implementer(interfaces.ITransport)
 class MockTransport(object):
@@ -120,6 +136,9 @@ class TestWorker(server.WorkerServer):
         self.wm = None
         self.transport = MockTransport()
         self.running = []
+        self.finished = []
+        # None if abandon is not supported
+        self.abandoned = None
         if not clientInfo:
             self.name = 'test_worker'
             self.clientInfo = {
@@ -144,6 +163,21 @@ class TestWorker(server.WorkerServer):
                 return defer.Deferred()
         elif method == 'get_running':
             return self.running
+        elif method == 'get_finished':
+            return defer.succeed(self.finished)
+        elif method == 'ack_finished':
+            acked = set(a[0])
+            self.finished = [f for f in self.finished
+                             if f['task_id'] not in acked]
+            return defer.succeed(None)
+        elif method == 'abandon':
+            if self.abandoned is None:
+                return defer.fail(rpc.NoSuchMethodError())
+            self.abandoned.extend(a[0])
+            return defer.succeed({
+                'concurrency': self.clientInfo['concurrency'] -
+                        len(self.abandoned),
+                'available_ram_mb': self.clientInfo['available_ram_mb']})
 
 
 class WorkerManagerTest(TestWithDB):
@@ -239,6 +273,116 @@ class WorkerManagerTest(TestWithDB):
         self.wm.workerLost(self.worker_proto)
         return self.assertFailure(d, workermanager.WorkerGone)
 
+    def test_gone_after_resume_timeout(self):
+        self.wm.resume_timeout = 0.1
+        self.wm.notifyOnUpdatedWorker(lambda _: None)
+        d = self.wm.runOnWorker('test_worker',
+                _fill_env({'task_id': 'hang', 'job_type': 'cpu-exec'}))
+        self.wm.workerLost(self.worker_proto)
+        self.assertFalse(d.called)
+        self.assertFalse(self.notifyLostWorkerCalled)
+        return self.assertFailure(d, workermanager.WorkerGone)
+
+    @defer.inlineCallbacks
+    def test_resume(self):
+        self.wm.resume_timeout = 10
+        self.wm.notifyOnUpdatedWorker(lambda _: None)
+        d1 = self.wm.runOnWorker('test_worker',
+                _fill_env({'task_id': 'hang1', 'job_type': 'vcpu-exec'}))
+        d2 = self.wm.runOnWorker('test_worker',
+                _fill_env({'task_id': 'hang2', 'job_type': 'vcpu-exec'}))
+        self.wm.workerLost(self.worker_proto)
+        self.assertEqual(self.wm.workerData['test_worker'].concurrency, 0)
+
+        w2 = TestWorker()
+        w2.finished = [{'task_id': 'hang1', 'result': {'foo': 'bar'}},
+                       {'task_id': 'unknown', 'result': {}}]
+        yield self.wm.newWorker('unique2', w2)
+        self.assertEqual(w2.finished, [])
+        self.assertEqual((yield d1), {'foo': 'bar'})
+        yield self.assertFailure(d2, workermanager.WorkerGone)
+        self.assertEqual(self.wm.disconnected, {})
+        self.assertEqual(self.wm.workerData['test_worker'].concurrency, 2)
+
+    @defer.inlineCallbacks
+    def test_resume_running(self):
+        self.wm.resume_timeout = 10
+        self.wm.notifyOnUpdatedWorker(lambda _: None)
+        d1 = self.wm.runOnWorker('test_worker',
+                _fill_env({'task_id': 'hang1', 'job_type': 'vcpu-exec'}))
+        d2 = self.wm.runOnWorker('test_worker',
+                _fill_env({'task_id': 'hang2', 'job_type': 'vcpu-exec'}))
+        self.wm.workerLost(self.worker_proto)
+
+        w2 = TestWorker()
+        w2.running = ['hang1', 'unknown']
+        w2.abandoned = []
+        yield self.wm.newWorker('unique2', w2)
+        self.assertEqual(w2.abandoned, ['unknown'])
+        yield self.assertFailure(d2, workermanager.WorkerGone)
+        self.assertFalse(d1.called)
+        self.assertEqual(self.wm.disconnected, {})
+        self.assertIs(self.wm.workers['test_worker'], w2)
+        wd = self.wm.workerData['test_worker']
+        self.assertEqual(wd.tasks, set(['hang1']))
+        self.assertEqual(wd.concurrency, 1)
+
+        self.wm.deliverResults('test_worker',
+                [{'task_id': 'hang1', 'result': {'foo': 'bar'}}])
+        self.assertEqual((yield d1), {'foo': 'bar'})
+        self.assertEqual(wd.tasks, set())
+
+    @defer.inlineCallbacks
+    def test_resumed_task_timeout(self):
+        self.patch(workermanager, 'TASK_TIMEOUT', 0.1)
+        self.wm.resume_timeout = 10
+        self.wm.notifyOnUpdatedWorker(lambda _: None)
+        d = self.wm.runOnWorker('test_worker',
+                _fill_env({'task_id': 'hang1', 'job_type': 'vcpu-exec'}))
+        self.wm.workerLost(self.worker_proto)
+
+        w2 = TestWorker()
+        w2.running = ['hang1']
+        yield self.wm.newWorker('unique2', w2)
+        self.assertIn('hang1', self.wm.resumedTimeouts)
+        yield self.assertFailure(d, rpc.TimeoutError)
+        self.assertEqual(self.wm.resumedTimeouts, {})
+        self.assertFalse(w2.transport.connected)
+
+    @defer.inlineCallbacks
+    def test_capacity_reported_while_connecting(self):
+        self.wm.resume_timeout = 10
+        self.wm.notifyOnUpdatedWorker(lambda _: None)
+        d = self.wm.runOnWorker('test_worker',
+                _fill_env({'task_id': 'hang1', 'job_type': 'vcpu-exec'}))
+        self.wm.workerLost(self.worker_proto)
+
+        w2 = TestWorker()
+        w2.running = defer.Deferred()
+        connected = self.wm.newWorker('unique2', w2)
+        self.wm.reportCapacity(w2, {'concurrency': 1})
+        # The disconnected worker gets no slots.
+        self.assertEqual(self.wm.workerData['test_worker'].concurrency, 0)
+        w2.running.callback(['hang1'])
+        yield connected
+        self.assertEqual(self.wm.workerData['test_worker'].concurrency, 1)
+        self.wm.reportCapacity(w2, {'concurrency': 2})
+        self.assertEqual(self.wm.workerData['test_worker'].concurrency, 2)
+
+        self.wm.deliverResults('test_worker',
+                [{'task_id': 'hang1', 'result': {'foo': 'bar'}}])
+        self.assertEqual((yield d), {'foo': 'bar'})
+
+    def test_abandon(self):
+        w2 = TestWorker({'name': 'name2', 'concurrency': 2,
+                         'available_ram_mb': 4096, 'can_run_cpu_exec': True})
+        w2.running = ['asdf']
+        w2.abandoned = []
+        d = self.wm.newWorker('unique2', w2)
+        self.assertTrue(d.called)
+        self.assertEqual(w2.abandoned, ['asdf'])
+        self.assertEqual(self.wm.workerData['name2'].concurrency, 1)
+
     def test_duplicate(self):
         w2 = TestWorker()
         d = self.wm.newWorker('unique2', w2)
@@ -440,6 +584,22 @@ class IntegrationTest(TestWithDB):
         return self._wrap_test(cb, {}, set())
 
 
+class ProcessPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = offload.ProcessPool(1)
+        self.pool.start()
+        self.addCleanup(self.pool.stop)
+
+    def test_run(self):
+        d = self.pool.run(divmod, 7, 2)
+        d.addCallback(self.assertEqual, (3, 1))
+        return d
+
+    def test_unpicklable_arguments_should_fail(self):
+        d = self.pool.run(divmod, lambda: 7, 2)
+        return self.assertFailure(d, offload.OffloadError)
+
+
 class TestUtils(unittest.TestCase):
     def test_required_ram_exec(self):
         env = {'task_id': 'asdf', 'job_type': 'cpu-exec'}
@@ -474,6 +634,19 @@ class TestUtils(unittest.TestCase):
         env['compile_mem_limit'] = 768 * 1024
         self.assertEqual(get_required_ram_for_job(env), 768)
 
+    def test_required_ram_batch_exec(self):
+        env = {'task_id': 'asdf', 'job_type': 'vcpu-batch-exec',
+               'tests': [{}, {'exec_mem_limit': 128 * 1024}],
+               'batch_parallelism': 2}
+        self.assertEqual(get_required_ram_for_job(env), 256)
+        env['batch_parallelism'] = 1
+        self.assertEqual(get_required_ram_for_job(env), 128)
+        # The same default as used by workers.
+        del env['batch_parallelism']
+        env['tests'] = [{}] * 10
+        self.assertEqual(get_required_ram_for_job(env),
+                         DEFAULT_BATCH_PARALLELISM * 64)
+
     def test_required_ram_default(self):
         env = {'task_id': 'asdf', 'job_type': 'abc'}
         self.assertEqual(get_required_ram_for_job(env), 256)
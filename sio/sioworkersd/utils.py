@@ -1,3 +1,8 @@
+import six
+
+from sio.protocol import bloom
+from sio.workers.util import batch_parallelism
+
 # Default ram requirements in KiB
 # This is in KiB because oioioi apparently mostly uses KiB,
 # while sioworkersd uses MiB.
@@ -12,16 +17,26 @@ DEFAULT_RAM_REQUIREMENTS = {
 }
 
 
+def _get_required_ram_for_exec(env):
+    required_ram = env.get('exec_mem_limit',
+        DEFAULT_RAM_REQUIREMENTS['exec'])
+    # We need to make sure that we have enough ram for a checker as well.
+    if env.get('check_output'):
+        required_ram = max(required_ram, env.get('checker_mem_limit',
+                DEFAULT_RAM_REQUIREMENTS['checker']))
+    return required_ram
+
+
 # Returns ram required for specific job in MiB
 def get_required_ram_for_job(env):
     job_type = env['job_type']
-    if job_type.endswith('exec'):
-        required_ram = env.get('exec_mem_limit',
-            DEFAULT_RAM_REQUIREMENTS['exec'])
-        # We need to make sure that we have enough ram for a checker as well.
-        if env.get('check_output'):
-            required_ram = max(required_ram, env.get('checker_mem_limit',
-                    DEFAULT_RAM_REQUIREMENTS['checker']))
+    if job_type.endswith('batch-exec'):
+        # Tests are run in parallel, each with its own memory limit.
+        per_test = max(_get_required_ram_for_exec(dict(env, **test))
+                for test in env.get('tests') or [{}])
+        required_ram = batch_parallelism(env) * per_test
+    elif job_type.endswith('exec'):
+        required_ram = _get_required_ram_for_exec(env)
     else:
         required_ram = env.get(job_type + '_mem_limit',
                 DEFAULT_RAM_REQUIREMENTS.get(job_type,
@@ -29,3 +44,39 @@ def get_required_ram_for_job(env):
 
     # Convert KiB to MiB
     return required_ram / 1024
+
+
+# Files which workers download to their filetracker cache
+CACHED_FILES = ('exe_file', 'in_file', 'hint_file', 'chk_file')
+
+
+def get_cache_keys(env):
+    """Returns keys of worker cache summaries (see
+       :mod:`sio.protocol.bloom`) which are useful for the task."""
+    keys = [env[key] for key in CACHED_FILES if env.get(key)]
+    keys.append(bloom.job_key(env['job_type']))
+    return keys
+
+
+def get_workers_ram_stats(workers):
+    """Returns minimum and maximum RAM (in MiB) of any-cpu workers and of
+       vcpu-only workers, as a tuple of four values (``None`` when there are
+       no workers of the kind).
+
+       ``workers`` is a dictionary of worker data, like
+       :meth:`sio.sioworkersd.workermanager.WorkerManager.getWorkers`.
+    """
+    any_cpus_ram = [
+        worker.available_ram_mb
+        for _, worker in six.iteritems(workers)
+        if worker.can_run_cpu_exec]
+
+    vcpu_onlys_ram = [
+        worker.available_ram_mb
+        for _, worker in six.iteritems(workers)
+        if not worker.can_run_cpu_exec]
+
+    return (min(any_cpus_ram) if any_cpus_ram else None,
+            max(any_cpus_ram) if any_cpus_ram else None,
+            min(vcpu_onlys_ram) if vcpu_onlys_ram else None,
+            max(vcpu_onlys_ram) if vcpu_onlys_ram else None)
@@ -1,15 +1,31 @@
 from __future__ import absolute_import
-from sio.sioworkersd import server
-from sio.protocol.rpc import TimeoutError
+from sio.protocol.bloom import BloomFilter
+from sio.sioworkersd import offload, server
+from sio.protocol.rpc import NoSuchMethodError, TimeoutError, \
+        makeRemoteException
+from sio.sioworkersd.metrics import Gauge
+from sio.sioworkersd.utils import get_required_ram_for_job, \
+        get_workers_ram_stats
 from twisted.application import service
 from twisted.internet import reactor, defer
 from twisted.logger import Logger
-import six
 
 log = Logger()
 
 TASK_TIMEOUT = 60 * 60
 
+WORKER_SLOTS = Gauge('sioworkersd_worker_slots',
+        'Number of tasks a worker can run at the same time.', ['worker'])
+WORKER_BUSY_SLOTS = Gauge('sioworkersd_worker_busy_slots',
+        'Slots of a worker taken by running tasks (all of them while it '
+        'runs a cpu-exec job).', ['worker'])
+WORKER_RUNNING_TASKS = Gauge('sioworkersd_worker_running_tasks',
+        'Tasks running on a worker.', ['worker'])
+WORKER_RAM = Gauge('sioworkersd_worker_ram_mb',
+        'RAM (in MiB) a worker can dedicate to tasks.', ['worker'])
+WORKER_USED_RAM = Gauge('sioworkersd_worker_used_ram_mb',
+        'RAM (in MiB) required by tasks running on a worker.', ['worker'])
+
 
 class WorkerGone(Exception):
     """Worker disconnected while executing task."""
@@ -25,29 +41,60 @@ class Worker(object):
         job, and (because such jobs are exclusive) can't run any other job
     ``concurrency``: number of tasks that worker can handle at the same time
     ``available_ram_mb``: total amount of RAM that worker can dedicate to tasks
+    ``cache``: :class:`sio.protocol.bloom.BloomFilter` of what the worker
+        has cached, or None if it didn't tell
     """
     def __init__(self, info, tasks, is_running_cpu_exec):
-        self.info = info
+        # The summary of the cache is not shown with the rest of info.
+        self.info = dict(info)
+        self.updateCache(self.info.pop('cache', None))
         self.tasks = tasks
         self.is_running_cpu_exec = is_running_cpu_exec
-        self.concurrency = info['concurrency']
-        self.available_ram_mb = info['available_ram_mb']
         self.can_run_cpu_exec = info['can_run_cpu_exec']
         # These arguments should have been already parsed with json.loads
-        assert isinstance(self.concurrency, int)
-        assert isinstance(self.available_ram_mb, int)
         assert isinstance(self.can_run_cpu_exec, bool)
+        self.updateCapacity(info)
+
+    def updateCapacity(self, info):
+        """Sets ``concurrency`` and ``available_ram_mb`` from ``info``.
+        Concurrency of a draining worker is 0."""
+        concurrency = info['concurrency']
+        available_ram_mb = info['available_ram_mb']
+        assert isinstance(concurrency, int) and concurrency >= 0
+        assert isinstance(available_ram_mb, int) and available_ram_mb > 0
+        self.concurrency = concurrency
+        self.available_ram_mb = available_ram_mb
+        self.info.update(concurrency=concurrency,
+                         available_ram_mb=available_ram_mb)
+
+    def updateCache(self, summary):
+        """Sets ``cache`` from its dictionary form."""
+        self.cache = None if summary is None \
+                else BloomFilter.from_dict(summary)
 
 
 class WorkerManager(service.MultiService):
-    def __init__(self):
+    """Keeps connected workers and runs tasks on them.
+
+    When a worker running tasks disconnects, its tasks fail with
+    :exc:`WorkerGone` after ``resume_timeout`` seconds, unless it reconnects
+    earlier and reports their results (see :meth:`newWorker`).
+    """
+    def __init__(self, resume_timeout=0):
         service.MultiService.__init__(self)
+        self.resume_timeout = resume_timeout
         self.workers = {}
         self.workerData = {}
+        # Timeouts of disconnected workers whose tasks may still finish,
+        # by worker name. Their data stays in workerData, with no slots.
+        self.disconnected = {}
         self.deferreds = {}
+        # Timeouts of tasks adopted by resumed workers, by task id.
+        self.resumedTimeouts = {}
         self.serverFactory = None
         self.newWorkerCallback = None
         self.lostWorkerCallback = None
+        self.updatedWorkerCallback = None
 
         # Various worker statistics, check out _updateWorkerStats().
         self.minAnyCpuWorkerRam = None
@@ -55,8 +102,8 @@ class WorkerManager(service.MultiService):
         self.minVcpuOnlyWorkerRam = None
         self.maxVcpuOnlyWorkerRam = None
 
-    def makeFactory(self):
-        f = server.WorkerServerFactory(self)
+    def makeFactory(self, offload_pool=offload.inline):
+        f = server.WorkerServerFactory(self, offload_pool)
         self.serverFactory = f
         return f
 
@@ -70,6 +117,11 @@ class WorkerManager(service.MultiService):
             raise ValueError()
         self.lostWorkerCallback = callback
 
+    def notifyOnUpdatedWorker(self, callback):
+        if not callable(callback):
+            raise ValueError()
+        self.updatedWorkerCallback = callback
+
     @defer.inlineCallbacks
     def newWorker(self, uid, proto):
         log.info('New worker {w} uid={uid}', w=proto.name, uid=uid)
@@ -79,12 +131,7 @@ class WorkerManager(service.MultiService):
             log.warn('WARNING: Worker {w} connected twice and was dropped',
                     w=name)
             raise server.DuplicateWorker()
-        running = yield proto.call('get_running', timeout=5)
-        # if running is non-empty the worker is executing something
-        if running:
-            log.warn('Rejecting worker {w} because it is running tasks',
-                    w=name)
-            raise server.WorkerRejected()
+        running = set((yield proto.call('get_running', timeout=5)))
         # if information received from worker doesn't meet expectations
         # reject it
         try:
@@ -93,24 +140,173 @@ class WorkerManager(service.MultiService):
             log.warn('Rejecting worker {w} because it sent invalid ({e})'
                     ' client info: {d}', w=name, e=e, d=proto.clientInfo)
             raise server.WorkerRejected()
+
+        # Tasks of a worker which reconnected in time are adopted. Others
+        # are unknown (e.g. sioworkersd was restarted) and the worker
+        # abandons them.
+        held = self.workerData[name].tasks \
+                if name in self.disconnected else set()
+        adopted = running & held
+        abandoned = running - adopted
+        if abandoned:
+            try:
+                capacity = yield proto.call('abandon', sorted(abandoned),
+                        timeout=5)
+            except NoSuchMethodError:
+                log.warn('Rejecting worker {w} because it is running tasks',
+                        w=name)
+                raise server.WorkerRejected()
+            log.warn('Worker {w} abandoned unknown tasks {tids}',
+                    w=name, tids=sorted(abandoned))
+            # They take slots until they finish. The worker announces them
+            # freed then.
+            worker.updateCapacity(capacity)
+            # Capacity announced earlier is older than the returned one.
+            proto.pendingCapacity = None
+
+        if name in self.disconnected:
+            try:
+                finished = yield proto.call('get_finished', timeout=5)
+            except NoSuchMethodError:
+                finished = []
+            self.deliverResults(name, finished)
+            if finished:
+                yield proto.call('ack_finished',
+                        [outcome['task_id'] for outcome in finished],
+                        timeout=5)
+        if proto.pendingCapacity is not None:
+            try:
+                worker.updateCapacity(dict(worker.info,
+                                           **proto.pendingCapacity))
+            except Exception as e:
+                log.warn('Worker {w} sent invalid ({e}) capacity: {d}',
+                        w=name, e=e, d=proto.pendingCapacity)
+            proto.pendingCapacity = None
+        # It may have timed out meanwhile.
+        if name in self.disconnected:
+            if adopted:
+                self._resumeWorker(name, proto, worker, adopted)
+                return
+            self._forgetWorker(name)
+
         self.workers[name] = proto
         self.workerData[name] = worker
 
+        WORKER_SLOTS.labels(name).set(worker.concurrency)
+        WORKER_BUSY_SLOTS.labels(name).set(0)
+        WORKER_RUNNING_TASKS.labels(name).set(0)
+        WORKER_RAM.labels(name).set(worker.available_ram_mb)
+        WORKER_USED_RAM.labels(name).set(0)
         self._updateWorkerStats()
         if self.newWorkerCallback:
             self.newWorkerCallback(name)
 
+    def updateWorker(self, name, info):
+        """Changes capacity of a connected worker (see
+        :meth:`Worker.updateCapacity`)."""
+        wd = self.workerData[name]
+        try:
+            wd.updateCapacity(dict(wd.info, **info))
+        except Exception as e:
+            log.warn('Worker {w} sent invalid ({e}) capacity: {d}',
+                    w=name, e=e, d=info)
+            raise
+        log.info('Worker {w} now has {c} slots and {r} MiB of RAM',
+                w=name, c=wd.concurrency, r=wd.available_ram_mb)
+        WORKER_SLOTS.labels(name).set(wd.concurrency)
+        WORKER_RAM.labels(name).set(wd.available_ram_mb)
+        self._updateWorkerStats()
+        if self.updatedWorkerCallback:
+            self.updatedWorkerCallback(name)
+
+    def reportCapacity(self, proto, info):
+        """Called when the worker announces new capacity. Announcements
+        made before :meth:`newWorker` registers the worker are applied by
+        it, not to a previous connection of the same name."""
+        if self.workers.get(proto.name) is not proto:
+            proto.pendingCapacity = dict(proto.pendingCapacity or {}, **info)
+            return
+        self.updateWorker(proto.name, info)
+
+    def updateWorkerCache(self, name, summary):
+        """Called when the worker sends a new summary of its cache."""
+        self.workerData[name].updateCache(summary)
+
+    def deliverResults(self, name, finished):
+        """Delivers results of tasks which the worker finished while it was
+        disconnected. ``finished`` is a list like returned by its
+        ``get_finished``. Results of unknown tasks are ignored."""
+        wd = self.workerData.get(name)
+        for outcome in finished:
+            tid = outcome['task_id']
+            if wd is None or tid not in wd.tasks:
+                continue
+            log.info('Worker {w} reported {tid} after reconnecting',
+                    w=name, tid=tid)
+            if 'error' in outcome:
+                self.deferreds[tid].errback(
+                        makeRemoteException(outcome['error'], uid=name))
+            else:
+                self.deferreds[tid].callback(outcome['result'])
+
+    def _resumeWorker(self, name, proto, worker, adopted):
+        """Takes back a reconnected worker which still runs ``adopted``
+        tasks. Their results are reported with ``report_finished``."""
+        timeout = self.disconnected.pop(name)
+        if timeout.active():
+            timeout.cancel()
+        wd = self.workerData[name]
+        for tid in wd.tasks - adopted:
+            self.deferreds[tid].errback(WorkerGone())
+        log.info('Worker {w} resumed with {n} running tasks',
+                w=name, n=len(adopted))
+        self.workers[name] = proto
+        wd.cache = worker.cache
+        # Timeouts of the calls were cancelled when the old connection was
+        # lost, so the tasks get the full TASK_TIMEOUT again.
+        for tid in sorted(wd.tasks):
+            self.resumedTimeouts[tid] = reactor.callLater(TASK_TIMEOUT,
+                    self._resumedTaskTimedOut, tid)
+        self.updateWorker(name, worker.info)
+
+    def _resumedTaskTimedOut(self, tid):
+        del self.resumedTimeouts[tid]
+        self.deferreds[tid].errback(TimeoutError())
+
+    def drainWorker(self, name):
+        """Stops sending tasks to the worker and tells it to disconnect
+        and exit once its running tasks are finished and reported."""
+        self.updateWorker(name, {'concurrency': 0})
+        return self.workers[name].call('drain')
+
     def workerLost(self, proto):
-        wd = self.workerData[proto.name]
+        name = proto.name
+        wd = self.workerData[name]
+        del self.workers[name]
+        if wd.tasks and self.resume_timeout > 0:
+            log.info('Waiting {t}s for {w} to report {n} running tasks',
+                    t=self.resume_timeout, w=name, n=len(wd.tasks))
+            self.disconnected[name] = reactor.callLater(self.resume_timeout,
+                    self._forgetWorker, name)
+            self.updateWorker(name, {'concurrency': 0})
+        else:
+            self._forgetWorker(name)
+
+    def _forgetWorker(self, name):
+        timeout = self.disconnected.pop(name, None)
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+        wd = self.workerData.pop(name)
+        for gauge in (WORKER_SLOTS, WORKER_BUSY_SLOTS, WORKER_RUNNING_TASKS,
+                      WORKER_RAM, WORKER_USED_RAM):
+            gauge.remove(name)
         # _free in runOnWorker will delete from wd.tasks, so copy here
-        del self.workers[proto.name]
-        del self.workerData[proto.name]
         for i in wd.tasks.copy():
             self.deferreds[i].errback(WorkerGone())
 
         self._updateWorkerStats()
         if self.lostWorkerCallback:
-            self.lostWorkerCallback(proto.name)
+            self.lostWorkerCallback(name)
 
     def getWorkers(self):
         return self.workerData
@@ -139,10 +335,23 @@ class WorkerManager(service.MultiService):
         wd.tasks.add(tid)
         d = w.call('run', task, timeout=TASK_TIMEOUT)
         self.deferreds[tid] = d
+        ram_mb = get_required_ram_for_job(task)
+        busy_slots = wd.concurrency if wd.is_running_cpu_exec else 1
+        WORKER_RUNNING_TASKS.labels(worker).inc()
+        WORKER_BUSY_SLOTS.labels(worker).inc(busy_slots)
+        WORKER_USED_RAM.labels(worker).inc(ram_mb)
 
         def _free(x):
             wd.tasks.discard(tid)
             del self.deferreds[tid]
+            timeout = self.resumedTimeouts.pop(tid, None)
+            if timeout is not None and timeout.active():
+                timeout.cancel()
+            # Metrics of a lost worker are already removed.
+            if self.workerData.get(worker) is wd:
+                WORKER_RUNNING_TASKS.labels(worker).dec()
+                WORKER_BUSY_SLOTS.labels(worker).dec(busy_slots)
+                WORKER_USED_RAM.labels(worker).dec(ram_mb)
             if wd.is_running_cpu_exec and wd.tasks:
                 log.critical('FATAL: impossible happened: worker was running '
                     'cpu-exec job, but still has tasks left. Aborting.')
@@ -154,7 +363,10 @@ class WorkerManager(service.MultiService):
             failure.trap(TimeoutError)
             # This is probably the ugliest, most blunt solution possible,
             # but it at least works. TODO kill the task on the worker.
-            w.transport.loseConnection()
+            # The worker may have resumed on another connection meanwhile.
+            proto = self.workers.get(worker)
+            if proto is not None:
+                proto.transport.loseConnection()
             log.warn('WARNING: Worker {w} timed out while executing {tid}',
                     w=worker, tid=tid)
             return failure
@@ -168,19 +380,6 @@ class WorkerManager(service.MultiService):
 
         This method should be called when some worker joins or leaves.
         """
-        any_cpus_ram = [
-            worker.available_ram_mb
-            for _, worker in six.iteritems(self.workerData)
-            if worker.can_run_cpu_exec]
-
-        vcpu_onlys_ram = [
-            worker.available_ram_mb
-            for _, worker in six.iteritems(self.workerData)
-            if not worker.can_run_cpu_exec]
-
-        self.minAnyCpuWorkerRam = min(any_cpus_ram) if any_cpus_ram else None
-        self.maxAnyCpuWorkerRam = max(any_cpus_ram) if any_cpus_ram else None
-        self.minVcpuOnlyWorkerRam = (
-            min(vcpu_onlys_ram) if vcpu_onlys_ram else None)
-        self.maxVcpuOnlyWorkerRam = (
-            max(vcpu_onlys_ram) if vcpu_onlys_ram else None)
+        (self.minAnyCpuWorkerRam, self.maxAnyCpuWorkerRam,
+         self.minVcpuOnlyWorkerRam, self.maxVcpuOnlyWorkerRam) = \
+                get_workers_ram_stats(self.workerData)
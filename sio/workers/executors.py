@@ -2,12 +2,16 @@ from __future__ import absolute_import
 import os
 import subprocess
 import tempfile
+import select
 import signal
-from threading import Timer
+import time
+from threading import Lock, Thread, Timer
 import logging
 import re
 import sys
 import traceback
+import json
+import copy
 from os import path
 
 from sio.workers import util, elf_loader_patch
@@ -54,10 +58,127 @@ def ulimit(command, mem_limit=None, time_limit=None, **kwargs):
 
     return command
 
+#: What to do with a command writing more than ``output_limit``, see
+#: :func:`execute_command`.
+OUTPUT_LIMIT_ACTIONS = ('drain', 'kill')
+
+
+class _OutputCapture(object):
+    """Reads output of a command from a pipe into a memory buffer.
+
+       At most ``limit`` bytes are kept (``None`` or ``0`` mean no limit),
+       the buffer grows up to it as needed. Anything written after that is moved to ``/dev/null``
+       (with ``splice`` where available) without being copied to Python,
+       or, if ``action`` is ``'kill'``, the process group of the command is
+       killed. ``truncated`` tells if any output was lost.
+       The reader stops at end of file or, once the command has exited,
+       as soon as the pipe is empty, so that background processes keeping
+       the pipe open do not block it.
+    """
+
+    INITIAL_SIZE = 2**16
+    CHUNK_SIZE = 2**16
+    #: Time (in s) for which output is still read after the command exited.
+    EXITED_READ_TIME = 1
+
+    def __init__(self, limit=None, action='drain'):
+        if action not in OUTPUT_LIMIT_ACTIONS:
+            raise ValueError('Unknown output limit action %r' % (action,))
+        self.limit = limit or None
+        self.action = action
+        self.truncated = False
+        self.pid = None
+        self.size = 0
+        self.buffer = bytearray(min(limit or self.INITIAL_SIZE,
+                                    self.INITIAL_SIZE))
+        self.read_fd, self.write_fd = os.pipe()
+        self._wake_read_fd, self._wake_write_fd = os.pipe()
+        self._thread = None
+
+    def start(self, pid=None):
+        """Starts reading, once the command (with process group ``pid``)
+           got ``write_fd``."""
+        self.pid = pid
+        os.close(self.write_fd)
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def finish(self):
+        """Waits for the remaining output of the exited command and returns
+           it."""
+        os.write(self._wake_write_fd, b'x')
+        self._thread.join()
+        for fd in (self.read_fd, self._wake_read_fd, self._wake_write_fd):
+            os.close(fd)
+        return bytes(self.buffer[:self.size])
+
+    def _readinto(self):
+        if self.size == len(self.buffer):
+            self.buffer.extend(bytearray(min(len(self.buffer),
+                    (self.limit or sys.maxsize) - self.size)))
+        readv = getattr(os, 'readv', None)
+        if readv is None:
+            data = os.read(self.read_fd, len(self.buffer) - self.size)
+            self.buffer[self.size:self.size + len(data)] = data
+            return len(data)
+        view = memoryview(self.buffer)
+        tail = view[self.size:]
+        try:
+            return readv(self.read_fd, [tail])
+        finally:
+            tail.release()
+            view.release()
+
+    def _discard(self, devnull):
+        splice = getattr(os, 'splice', None)
+        if splice is not None:
+            try:
+                return splice(self.read_fd, devnull, self.CHUNK_SIZE)
+            except OSError:
+                pass
+        return len(os.read(self.read_fd, self.CHUNK_SIZE))
+
+    def _run(self):
+        deadline = None
+        with open(os.devnull, 'wb') as devnull:
+            while True:
+                if deadline is not None:
+                    ready, _, _ = select.select([self.read_fd], [], [], 0)
+                    if not ready or time.time() > deadline:
+                        break
+                else:
+                    ready, _, _ = select.select(
+                            [self.read_fd, self._wake_read_fd], [], [])
+                    if self._wake_read_fd in ready:
+                        deadline = time.time() + self.EXITED_READ_TIME
+                    if self.read_fd not in ready:
+                        continue
+
+                if self.limit is None or self.size < self.limit:
+                    read = self._readinto()
+                    self.size += read
+                else:
+                    read = self._discard(devnull.fileno())
+                    if read and not self.truncated:
+                        self.truncated = True
+                        self._limit_exceeded()
+                if not read:
+                    break
+
+    def _limit_exceeded(self):
+        if self.action == 'kill' and self.pid is not None:
+            try:
+                os.killpg(self.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
 def execute_command(command, env=None, split_lines=False, stdin=None,
                     stdout=None, stderr=None, forward_stderr=False,
                     capture_output=False, output_limit=None,
-                    real_time_limit=None,
+                    output_limit_action='drain', real_time_limit=None,
+                    cpu_affinity=None,
                     ignore_errors=False, extra_ignore_errors=(), **kwargs):
     """Utility function to run arbitrary command.
        ``stdin``
@@ -76,6 +197,21 @@ def execute_command(command, env=None, split_lines=False, stdin=None,
 
        ``output_limit``
          Limits returned output when ``capture_output=True`` (in bytes).
+         Only that much is kept in memory.
+
+       ``output_limit_action``
+         What happens to output exceeding ``output_limit``: ``'drain'``
+         (default) discards it as soon as it is written, ``'kill'`` kills
+         the command (with its process group).
+
+       ``split_lines``
+         Returns the captured output as a list of lines. If ``'lazy'``,
+         a :class:`sio.workers.util.LazyLines` is returned instead, which
+         splits lines only as they are used.
+
+       ``cpu_affinity``
+         If given, a list of CPUs to which the command is restricted (with
+         ``sched_setaffinity``). Ignored on systems which do not support it.
 
        Returns renv: dictionary containing:
        ``real_time_used``
@@ -89,14 +225,19 @@ def execute_command(command, env=None, split_lines=False, stdin=None,
 
        ``stdout``
          Only when ``capture_output=True``: output of the command
+
+       ``output_truncated``
+         Only when ``capture_output=True``: whether the output exceeded
+         ``output_limit``.
     """
-    # Using temporary file is way faster than using subproces.PIPE
-    # and it prevents deadlocks.
     command = shellquote(command)
 
     logger.debug('Executing: %s', command)
 
-    stdout = capture_output and tempfile.TemporaryFile() or stdout
+    capture = None
+    if capture_output:
+        capture = _OutputCapture(output_limit, output_limit_action)
+        stdout = capture.write_fd
     # redirect output to /dev/null if None given
     devnull = open(os.devnull, 'wb')
     stdout = stdout or devnull
@@ -107,18 +248,32 @@ def execute_command(command, env=None, split_lines=False, stdin=None,
         for key, value in six.iteritems(env):
             env[key] = str(value)
 
+    preexec_fn = os.setpgrp
+    if cpu_affinity is not None and hasattr(os, 'sched_setaffinity'):
+        def preexec_fn():
+            os.setpgrp()
+            os.sched_setaffinity(0, cpu_affinity)
+
     perf_timer = util.PerfTimer()
-    p = subprocess.Popen(command,
-                         stdin=stdin,
-                         stdout=stdout,
-                         stderr=forward_stderr and subprocess.STDOUT
-                                                or stderr,
-                         shell=True,
-                         close_fds=True,
-                         universal_newlines=True,
-                         env=env,
-                         cwd=tempcwd(),
-                         preexec_fn=os.setpgrp)
+    try:
+        p = subprocess.Popen(command,
+                             stdin=stdin,
+                             stdout=stdout,
+                             stderr=forward_stderr and subprocess.STDOUT
+                                                    or stderr,
+                             shell=True,
+                             close_fds=True,
+                             universal_newlines=True,
+                             env=env,
+                             cwd=tempcwd(),
+                             preexec_fn=preexec_fn)
+    except:
+        if capture:
+            capture.start()
+            capture.finish()
+        raise
+    if capture:
+        capture.start(p.pid)
 
     kill_timer = None
     if real_time_limit:
@@ -140,11 +295,12 @@ def execute_command(command, env=None, split_lines=False, stdin=None,
             str(command), rc, perf_timer.elapsed)
 
     devnull.close()
-    if capture_output:
-        stdout.seek(0)
-        ret_env['stdout'] = stdout.read(output_limit or -1)
-        stdout.close()
-        if split_lines:
+    if capture:
+        ret_env['stdout'] = capture.finish()
+        ret_env['output_truncated'] = capture.truncated
+        if split_lines == 'lazy':
+            ret_env['stdout'] = util.LazyLines(ret_env['stdout'])
+        elif split_lines:
             ret_env['stdout'] = ret_env['stdout'].split(b'\n')
 
     if rc and not ignore_errors and rc not in extra_ignore_errors:
@@ -208,6 +364,12 @@ class BaseExecutor(object):
        ``output_limit``
          Limits amount of data program can write to stdout, in KiB.
 
+       ``output_limit_action``
+         What to do when the captured output exceeds ``output_limit``:
+         ``'drain'`` (the default) or ``'kill'``, see
+         :func:`execute_command`. ``renv['output_truncated']`` tells
+         whether the limit was exceeded.
+
        ``mem_limit``
          Memory limit (``ulimit -v``), in KiB.
 
@@ -217,14 +379,17 @@ class BaseExecutor(object):
        ``real_time_limit``
          Wall clock time limit, in miliseconds.
 
+       ``cpu_affinity``
+         List of CPUs the program may run on.
+
        ``environ``
          If present, this should be the ``environ`` dictionary. It's used to
-         extract values for ``mem_limit``, ``time_limit``, ``real_time_limit``
-         and ``output_limit`` from it.
+         extract values for ``mem_limit``, ``time_limit``, ``real_time_limit``,
+         ``output_limit`` and ``output_limit_action`` from it.
 
        ``environ_prefix``
-         Prefix for ``mem_limit``, ``time_limit``, ``real_time_limit`` and
-         ``output_limit`` keys in ``environ``.
+         Prefix for ``mem_limit``, ``time_limit``, ``real_time_limit``,
+         ``output_limit`` and ``output_limit_action`` keys in ``environ``.
 
        ``**kwargs``
          Other arguments handled by some executors. See their documentation.
@@ -244,6 +409,11 @@ class BaseExecutor(object):
        ``time_used``, ``result_code``, ``mem_used``, ``num_syscalls``
     """
 
+    #: Whether the results depend only on the program, its input and limits
+    #: (and not on the load of the machine), so they may be memoized.
+    #: See :mod:`sio.executors.memo`.
+    deterministic = False
+
     def __enter__(self):
         raise NotImplementedError('BaseExecutor is abstract!')
 
@@ -253,12 +423,44 @@ class BaseExecutor(object):
     def _execute(self, command, **kwargs):
         raise NotImplementedError('BaseExecutor is abstract!')
 
+    def _popen(self, command, **kwargs):
+        raise NotImplementedError('%s does not support long-running '
+                                  'processes' % self.__class__.__name__)
+
+    def popen(self, command, env=None, cwd=None, stderr=None, **kwargs):
+        """Starts ``command`` in the executor environment without waiting
+           for it to finish.
+
+           This is meant for long-running helper processes (like compile
+           servers) which talk to the worker over their standard input and
+           output. No resource limits are applied. ``command`` and ``env``
+           are handled like in ``__call__``, ``cwd`` defaults to the current
+           temporary directory and ``stderr`` to ``/dev/null``. Executors
+           running commands in a sandbox also accept ``binds``, see
+           :class:`PRootExecutor`.
+
+           Returns :class:`subprocess.Popen` object with ``stdin`` and
+           ``stdout`` pipes. The process is put in its own process group.
+        """
+        if not isinstance(command, list):
+            command = [noquote(command), ]
+
+        if not env:
+            env = os.environ.copy()
+
+        env['LC_ALL'] = 'en_US.UTF-8'
+        env['LANGUAGE'] = 'en_US.UTF-8'
+
+        return self._popen(command, env=env, cwd=cwd or tempcwd(),
+                           stderr=stderr, **kwargs)
+
     def __call__(self, command, env=None, split_lines=False,
                 ignore_errors=False, extra_ignore_errors=(),
                 stdin=None, stdout=None, stderr=None,
                 forward_stderr=False, capture_output=False,
                 mem_limit=None, time_limit=None,
-                real_time_limit=None, output_limit=None, environ={},
+                real_time_limit=None, output_limit=None,
+                output_limit_action='drain', environ={},
                 environ_prefix='', **kwargs):
         if not isinstance(command, list):
             command = [noquote(command), ]
@@ -270,6 +472,9 @@ class BaseExecutor(object):
                     environ_prefix + 'real_time_limit', real_time_limit)
             output_limit = environ.get(
                     environ_prefix + 'output_limit', output_limit)
+            output_limit_action = environ.get(
+                    environ_prefix + 'output_limit_action',
+                    output_limit_action)
 
         if not env:
             env = os.environ.copy()
@@ -283,6 +488,7 @@ class BaseExecutor(object):
                 stdin=stdin, stdout=stdout, stderr=stderr,
                 mem_limit=mem_limit, time_limit=time_limit,
                 real_time_limit=real_time_limit, output_limit=output_limit,
+                output_limit_action=output_limit_action,
                 forward_stderr=forward_stderr, capture_output=capture_output,
                 environ=environ, environ_prefix=environ_prefix, **kwargs)
 
@@ -307,6 +513,24 @@ class UnprotectedExecutor(BaseExecutor):
         renv = execute_command(command, **kwargs)
         return renv
 
+    def _popen(self, command, env=None, cwd=None, stderr=None, **kwargs):
+        command = shellquote(command)
+        logger.debug('Starting: %s', command)
+
+        for key, value in six.iteritems(env):
+            env[key] = str(value)
+
+        with open(os.devnull, 'wb') as devnull:
+            return subprocess.Popen(command,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=stderr or devnull,
+                                    shell=True,
+                                    close_fds=True,
+                                    env=env,
+                                    cwd=cwd,
+                                    preexec_fn=os.setpgrp)
+
 TIME_OUTPUT_RE = re.compile(r'^user\s+([0-9]+)m([0-9.]+)s$', re.MULTILINE)
 class DetailedUnprotectedExecutor(UnprotectedExecutor):
     """This executor returns extended process status (over UnprotectedExecutor.)
@@ -407,18 +631,24 @@ class SandboxExecutor(UnprotectedExecutor):
         return "%s:%s" % (path.join(self.path, suffix),
                             path.join(self.path, 'usr', suffix))
 
-    def _execute(self, command, **kwargs):
-        if not kwargs.get('use_path', False) and command[0][0] != '/':
+    def _prepare(self, command, env, use_path=False):
+        if not use_path and command[0][0] != '/':
             command[0] = os.path.join(self.path, command[0])
 
-        env = kwargs.get('env')
         env['PATH'] = '%s:%s' % (self._env_paths('bin'), env['PATH'])
 
         if not self.sandbox.has_fixup('elf_loader_patch'):
             env['LD_LIBRARY_PATH'] = self._env_paths('lib')
 
+    def _execute(self, command, **kwargs):
+        self._prepare(command, kwargs.get('env'),
+                      kwargs.get('use_path', False))
         return super(SandboxExecutor, self)._execute(command, **kwargs)
 
+    def _popen(self, command, **kwargs):
+        self._prepare(command, kwargs['env'], kwargs.pop('use_path', False))
+        return super(SandboxExecutor, self)._popen(command, **kwargs)
+
 class _SIOSupervisedExecutor(SandboxExecutor):
     _supervisor_codes = {
             0: 'OK',
@@ -517,6 +747,8 @@ class VCPUExecutor(_SIOSupervisedExecutor):
        ``result_string``: string describing ``result_code``
     """
 
+    deterministic = True
+
     def __init__(self):
         self.options = ['-f', '3']
         super(VCPUExecutor, self).__init__('vcpu_exec-sandbox')
@@ -551,6 +783,8 @@ class Sio2JailExecutor(SandboxExecutor):
     REAL_TIME_LIMIT_MULTIPLIER = 16
     REAL_TIME_LIMIT_ADDEND = 1000  # (in ms)
 
+    deterministic = True
+
     def __init__(self):
         super(Sio2JailExecutor, self).__init__('sio2jail_exec-sandbox')
 
@@ -686,6 +920,11 @@ class SupervisedExecutor(_SIOSupervisedExecutor):
         with java:
             return super(SupervisedExecutor, self)._execute(command, **kwargs)
 
+# Prepared options of chroot executors, see PRootExecutor._load_template.
+_templates = {}
+_templates_lock = Lock()
+
+
 class PRootExecutor(BaseExecutor):
     """PRootExecutor executor mimics ``chroot`` with ``mount --bind``.
 
@@ -693,15 +932,27 @@ class PRootExecutor(BaseExecutor):
        Current working directory is visible as itself and ``/tmp``.
        Also ``sandbox.path`` remains accessible under ``sandbox.path``.
 
+       Processes started with :meth:`popen` outlive a single job, so they
+       see their own working directory as itself instead of the current
+       working directory. If ``binds`` is passed to :meth:`popen`, the
+       directories from that list are visible (as themselves) instead.
+
        If *sandbox* doesn't contain ``/bin/sh`` or ``/lib``,
        then some basic is bound from *proot sandbox*.
 
+       The options depending only on the sandboxes are prepared once per
+       process and sandbox version, on the first entry.
+
        For more information about PRoot see http://proot.me.
 
        PRootExecutor adds support of following arguments in ``__call__``:
 
          ``proot_options`` Options passed to *proot* binary after those
                            automatically generated.
+
+         ``read_only_binds`` Directories visible as themselves. PRoot
+                             cannot make them read-only, but
+                             :class:`NamespaceExecutor` does.
     """
 
     def __init__(self, sandbox):
@@ -710,9 +961,6 @@ class PRootExecutor(BaseExecutor):
         self.proot = SandboxExecutor('proot-sandbox')
 
         self.options = []
-        with self.chroot:
-            with self.proot:
-                self._proot_options()
 
     def __enter__(self):
         self.proot.__enter__()
@@ -722,6 +970,11 @@ class PRootExecutor(BaseExecutor):
             self.proot.__exit__(*sys.exc_info())
             raise
 
+        try:
+            self._load_template()
+        except:
+            self.__exit__(*sys.exc_info())
+            raise
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -773,21 +1026,63 @@ class PRootExecutor(BaseExecutor):
                 self._bind(sh_patched, sh_target, force=True)
 
         self._bind(os.path.join(self.proot.path, 'lib'), 'lib')
-        self._bind(tempcwd(), 'tmp', force=True)
 
         # Make absolute `outside paths' visible in sandbox
         self._bind(self.chroot.path, force=True)
-        self._bind(tempcwd(), force=True)
+
+    def _make_template(self):
+        """Prepares what is reused by all executors of the same sandboxes.
+           Called with the sandboxes entered."""
+        self.options = []
+        self._proot_options()
+        return self.options
+
+    def _apply_template(self, template):
+        self.options = list(template)
+
+    def _load_template(self):
+        key = (type(self), self.chroot.name, self.proot.sandbox.name)
+        version = (self.chroot.version, self.proot.sandbox.version)
+        with _templates_lock:
+            cached_version, template = _templates.get(key, (None, None))
+        if template is None or cached_version != version:
+            template = self._make_template()
+            with _templates_lock:
+                _templates[key] = (version, template)
+        self._apply_template(template)
+
+    def _job_options(self):
+        """Binds of the current working directory, added on every call."""
+        cwd = tempcwd()
+        return ['-b', '%s:%s' % (cwd, path_join_abs(self.rpath, 'tmp')),
+                '-b', '%s:%s' % (cwd, path_join_abs(self.rpath, cwd))]
+
+    def _command(self, command, options):
+        return [path.join('proot', 'proot')] + self.options + options + \
+                [path.join(self.rpath, 'bin', 'sh'), '-c', command]
+
+    def _bind_options(self, binds):
+        """Options binding directories ``binds`` as themselves."""
+        options = []
+        for what in binds:
+            options += ['-b',
+                        '%s:%s' % (what, path_join_abs(self.rpath, what))]
+        return options
 
     def _execute(self, command, **kwargs):
         if kwargs['time_limit'] and kwargs['real_time_limit'] is None:
             kwargs['real_time_limit'] = 3 * kwargs['time_limit']
 
-        options = self.options + kwargs.pop('proot_options', [])
-        command = [path.join('proot', 'proot')] + options + \
-                    [path.join(self.rpath, 'bin', 'sh'), '-c', command]
+        options = self._job_options() + \
+                self._bind_options(kwargs.pop('read_only_binds', [])) + \
+                kwargs.pop('proot_options', [])
+        return self.proot._execute(self._command(command, options), **kwargs)
 
-        return self.proot._execute(command, **kwargs)
+    def _popen(self, command, **kwargs):
+        options = self._bind_options(kwargs.pop('binds', None)
+                                     or [kwargs['cwd']]) + \
+                kwargs.pop('proot_options', [])
+        return self.proot._popen(self._command(command, options), **kwargs)
 
     @property
     def rpath(self):
@@ -798,3 +1093,307 @@ class PRootExecutor(BaseExecutor):
     def path(self):
         """Contains real, absolute path to sandbox root."""
         return self.chroot.path
+
+
+def _parse_proot_options(options):
+    """Returns the root, binds and initial working directory given in
+       PRoot-style ``options``."""
+    root, binds, pwd = None, [], None
+    options = iter(options)
+    for option in options:
+        if option == '-r':
+            root = next(options)
+        elif option == '-b':
+            what, _, where = next(options).partition(':')
+            binds.append((what, where or what))
+        elif option == '-w':
+            pwd = next(options)
+        elif option == '-v':
+            next(options)
+        else:
+            logger.warning('Ignoring unsupported PRoot option %s', option)
+    return root, binds, pwd
+
+
+class _MountTree(object):
+    """The directory tree built by :class:`NamespaceExecutor`.
+
+       Nodes are dicts: directories of the ``tmpfs`` have ``children``,
+       binds have ``bind`` (the host path), ``read_only`` and also
+       ``children`` (mount points inside the bound directory), symbolic
+       links have ``symlink``. Directories of the sandbox root are bound as
+       a whole and split into their entries only when something has to be
+       bound inside them. Other binds which need a mount point they do not
+       contain are split into their entries the same way, but on a private
+       scratch directory instead of the ``tmpfs``, so that they stay
+       writable and no mount points are created in the bound directories.
+    """
+
+    def __init__(self, root, binds=()):
+        self.root = self._expand(root)
+        for what, where in binds:
+            self.bind(what, where)
+
+    def _leaf(self, host_path, explicit=False, read_only=False,
+              writable=False):
+        if not explicit and path.islink(host_path):
+            return {'symlink': os.readlink(host_path)}
+        return {'bind': host_path, 'explicit': explicit,
+                'writable': explicit or writable,
+                'is_dir': path.isdir(host_path), 'read_only': read_only,
+                'children': {}}
+
+    def _expand(self, host_path):
+        return {'children': dict((name, self._leaf(path.join(host_path, name)))
+                                 for name in os.listdir(host_path))}
+
+    def _split(self, node):
+        """Turns the bind ``node`` into a scratch directory with its
+           entries bound separately, keeping mount points inside it."""
+        children = dict((name, self._leaf(path.join(node['bind'], name),
+                                          read_only=node['read_only'],
+                                          writable=True))
+                        for name in os.listdir(node['bind']))
+        children.update(node['children'])
+        explicit, read_only = node['explicit'], node['read_only']
+        node.clear()
+        node.update({'scratch': True, 'explicit': explicit,
+                     'read_only': read_only, 'children': children})
+
+    def _child(self, node, name):
+        """Returns the node for ``name`` in directory ``node``, making sure
+           it can contain mount points."""
+        if 'bind' in node and not path.lexists(path.join(node['bind'], name)):
+            self._split(node)
+        children = node['children']
+        child = children.get(name)
+        if child is None or 'symlink' in child or \
+                ('bind' in child and not child['is_dir']):
+            child = children[name] = {'children': {}}
+        elif 'bind' in child and not child['writable']:
+            child = children[name] = self._expand(child['bind'])
+        return child
+
+    def bind(self, what, where, read_only=False):
+        parts = [part for part in where.split(path.sep) if part]
+        if not parts:
+            self.root = self._expand(what)
+            return
+
+        node = self.root
+        for part in parts[:-1]:
+            node = self._child(node, part)
+        if 'bind' in node and \
+                not path.lexists(path.join(node['bind'], parts[-1])):
+            self._split(node)
+        leaf = self._leaf(what, explicit=True, read_only=read_only)
+        previous = node['children'].get(parts[-1])
+        if previous is not None:
+            # Earlier binds below this point stay visible, as in PRoot.
+            leaf['children'] = self._explicit(previous)
+        node['children'][parts[-1]] = leaf
+
+    @classmethod
+    def _explicit(cls, node):
+        """Returns children of ``node`` containing explicit binds."""
+        children = {}
+        for name, child in six.iteritems(node.get('children', {})):
+            if child.get('explicit'):
+                children[name] = child
+            else:
+                nested = cls._explicit(child)
+                if nested:
+                    children[name] = {'children': nested}
+        return children
+
+    def plan(self):
+        """Returns the operations for :mod:`sio.workers.nsexec`, its
+           sources and the scratch directory created for split binds
+           (or ``None``), which has to be removed after the run."""
+        sources, ops, scratch = [], [], []
+
+        def _scratch_dir():
+            if not scratch:
+                scratch.append(tempfile.mkdtemp(prefix='sioworkers_mounts_'))
+            return tempfile.mkdtemp(dir=scratch[0])
+
+        def _walk(node, where):
+            for name in sorted(node['children']):
+                child = node['children'][name]
+                child_where = where + path.sep + name
+                if 'symlink' in child:
+                    ops.append(['symlink', child_where, child['symlink']])
+                elif 'bind' in child or 'scratch' in child:
+                    sources.append(child.get('bind') or _scratch_dir())
+                    ops.append(['bind', child_where, len(sources) - 1,
+                                child.get('is_dir', True),
+                                child['read_only']])
+                    _walk(child, child_where)
+                else:
+                    ops.append(['dir', child_where])
+                    _walk(child, child_where)
+
+        _walk(self.root, '')
+        return sources, ops, scratch[0] if scratch else None
+
+
+def _remove_scratch(scratch):
+    if scratch is not None:
+        util.rmtree(scratch)
+
+
+class _MountedProcess(object):
+    """Wraps :class:`subprocess.Popen` of :meth:`NamespaceExecutor.popen`
+       to remove the scratch directory of the process once it is reaped
+       with :meth:`wait` or :meth:`poll`."""
+
+    def __init__(self, process, scratch):
+        self._process = process
+        self._scratch = scratch
+
+    def __getattr__(self, name):
+        return getattr(self._process, name)
+
+    def poll(self):
+        returncode = self._process.poll()
+        if returncode is not None:
+            self._cleanup()
+        return returncode
+
+    def wait(self, *args, **kwargs):
+        returncode = self._process.wait(*args, **kwargs)
+        self._cleanup()
+        return returncode
+
+    def _cleanup(self):
+        _remove_scratch(self._scratch)
+        self._scratch = None
+
+
+class NamespaceExecutor(PRootExecutor):
+    """Like :class:`PRootExecutor`, but instead of tracing every syscall
+       of the program with *ptrace*, the sandbox root is built from bind
+       mounts in new unprivileged user and mount namespaces, so the program
+       runs at native speed.
+
+       Paths are visible the same way as in :class:`PRootExecutor`. The root
+       directory itself is read-only, its entries are the entries of the
+       sandbox. Binds given in ``proot_options`` are supported (``-b``,
+       ``-r`` and ``-w``, other options are ignored). A bind which goes
+       through a symbolic link in the sandbox replaces that link with
+       a directory. Directories in ``read_only_binds`` are mounted
+       read-only.
+
+       A bind inside a bound directory which lacks its mount point (like
+       the working directory at its own path inside ``/tmp``) does not
+       create it there. Instead the entries of the outer directory are
+       bound one by one on a private scratch directory, removed after the
+       run, so files created directly in it (e.g. in ``/tmp``) are not kept.
+
+       Requires Linux with unprivileged user namespaces enabled, see
+       :meth:`is_supported`.
+    """
+
+    NSEXEC = path.join(path.dirname(path.abspath(__file__)), 'nsexec.py')
+
+    _supported = None
+
+    @classmethod
+    def is_supported(cls):
+        """Checks (once per process) if namespaces can be created."""
+        if cls._supported is None:
+            with open(os.devnull, 'wb') as devnull:
+                cls._supported = subprocess.call(
+                        [sys.executable, '-E', '-S', cls.NSEXEC, '--check'],
+                        stdout=devnull, stderr=devnull) == 0
+        return cls._supported
+
+    def __init__(self, sandbox):
+        super(NamespaceExecutor, self).__init__(sandbox)
+        self._host = UnprotectedExecutor()
+
+    def _make_template(self):
+        options = super(NamespaceExecutor, self)._make_template()
+        root, binds, pwd = _parse_proot_options(options)
+        return options, _MountTree(root, binds), pwd
+
+    def _apply_template(self, template):
+        options, self._tree, self._template_pwd = template
+        super(NamespaceExecutor, self)._apply_template(options)
+
+    def _command(self, command, options, cwd=None, read_only_binds=()):
+        root, binds, pwd = _parse_proot_options(options)
+        if root is None:
+            # The prepared tree is shared, so it has to be copied.
+            tree = copy.deepcopy(self._tree)
+            for what, where in binds:
+                tree.bind(what, where)
+        else:
+            tree = _MountTree(root, _parse_proot_options(self.options)[1] +
+                                    binds)
+        for what in read_only_binds:
+            tree.bind(what, path_join_abs(self.rpath, what), read_only=True)
+        sources, ops, scratch = tree.plan()
+
+        plan = {
+            'sources': sources,
+            'ops': ops,
+            'cwd': pwd or self._template_pwd or cwd or tempcwd(),
+            'shell': path.join(self.rpath, 'bin', 'sh'),
+        }
+        return [sys.executable, '-E', '-S', self.NSEXEC, json.dumps(plan),
+                shellquote(command)], scratch
+
+    def _execute(self, command, **kwargs):
+        if kwargs['time_limit'] and kwargs['real_time_limit'] is None:
+            kwargs['real_time_limit'] = 3 * kwargs['time_limit']
+
+        options = self._job_options() + kwargs.pop('proot_options', [])
+        command, scratch = self._command(command, options,
+                read_only_binds=kwargs.pop('read_only_binds', ()))
+        try:
+            return self._host._execute(command, **kwargs)
+        finally:
+            _remove_scratch(scratch)
+
+    def _popen(self, command, **kwargs):
+        options = self._bind_options(kwargs.pop('binds', None)
+                                     or [kwargs['cwd']]) + \
+                kwargs.pop('proot_options', [])
+        command, scratch = self._command(command, options, kwargs['cwd'])
+        try:
+            process = self._host._popen(command, **kwargs)
+        except:
+            _remove_scratch(scratch)
+            raise
+        return _MountedProcess(process, scratch)
+
+
+#: Executors running commands with a sandbox as the root directory,
+#: by name used in ``environ['chroot_executor']``.
+CHROOT_EXECUTORS = {
+    'proot': PRootExecutor,
+    'namespace': NamespaceExecutor,
+}
+DEFAULT_CHROOT_EXECUTOR = os.environ.get('SIO_CHROOT_EXECUTOR', 'proot')
+
+
+def get_chroot_executor(sandbox, environ=None):
+    """Returns an executor which runs commands with ``sandbox`` as the root
+       directory.
+
+       The executor is chosen by ``environ['chroot_executor']`` or, if not
+       given, by ``SIO_CHROOT_EXECUTOR`` environment variable of the worker:
+       ``proot`` (:class:`PRootExecutor`, the default) or ``namespace``
+       (:class:`NamespaceExecutor`). If namespaces are not supported on
+       the machine, :class:`PRootExecutor` is used instead.
+    """
+    name = (environ or {}).get('chroot_executor', DEFAULT_CHROOT_EXECUTOR)
+    executor_class = CHROOT_EXECUTORS.get(name)
+    if executor_class is None:
+        raise ValueError('Unknown chroot executor %r' % (name,))
+    if executor_class is NamespaceExecutor and \
+            not NamespaceExecutor.is_supported():
+        logger.warning('User namespaces are not supported, using PRoot')
+        executor_class = PRootExecutor
+    return executor_class(sandbox)
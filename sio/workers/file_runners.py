@@ -1,7 +1,7 @@
 from __future__ import absolute_import
 from sio.workers.executors import UnprotectedExecutor, \
     DetailedUnprotectedExecutor, VCPUExecutor, Sio2JailExecutor, \
-    SupervisedExecutor, PRootExecutor
+    SupervisedExecutor, PRootExecutor, NamespaceExecutor
 from sio.workers.util import RegisteredSubclassesBase
 import os.path
 
@@ -85,7 +85,8 @@ class Executable(LanguageModeWrapper):
 
     handled_exec_mode = 'executable'
     handled_executors = UnprotectedExecutor, DetailedUnprotectedExecutor, \
-        PRootExecutor, VCPUExecutor, Sio2JailExecutor, SupervisedExecutor
+        PRootExecutor, NamespaceExecutor, VCPUExecutor, Sio2JailExecutor, \
+        SupervisedExecutor
 
     def __call__(self, file, args, **kwargs):
         if os.path.isabs(file):
@@ -114,7 +115,7 @@ class Java(_BaseJava):
 
     handled_exec_mode = 'java'
     handled_executors = UnprotectedExecutor, DetailedUnprotectedExecutor, \
-        PRootExecutor
+        PRootExecutor, NamespaceExecutor
 
     def __call__(self, file, args, entry_point=None, **kwargs):
         environ = kwargs.get('environ', {})
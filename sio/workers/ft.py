@@ -1,17 +1,16 @@
 from __future__ import absolute_import
 import os
-import six.moves.urllib.error
-import six.moves.urllib.parse
-import six.moves.urllib.request
 import time
 import shutil
 import logging
 import threading
 import hashlib
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
-import filetracker
+# filetracker and urllib are imported where needed, as they are slow to
+# import and not used by all jobs.
 from sio.workers import _original_cwd, util
 
 lock = threading.Lock()
@@ -20,6 +19,10 @@ lock = threading.Lock()
 # we cache clients in dict
 ft_clients = dict()
 
+#: Number of filetracker paths remembered by :func:`recently_cached`.
+RECENTLY_CACHED_LIMIT = 10000
+_recently_cached = OrderedDict()
+
 
 def get_url_hash(filetracker_url):
     return hashlib.md5(filetracker_url).hexdigest()
@@ -35,6 +38,7 @@ def get_cache_dir(filetracker_url):
 # set thread local client instance (stored in _instance).
 # Every Client has to have seperate cache folder
 def init_instance(filetracker_url):
+    import filetracker
     url_hash = get_url_hash(filetracker_url)
     lock.acquire()
     if not url_hash in ft_clients:
@@ -49,6 +53,7 @@ def init_instance(filetracker_url):
 def instance():
     """Returns a singleton instance of :class:`filetracker.Client`."""
     if getattr(util.threadlocal_dir, 'ft_client_instance', None) is None:
+        import filetracker
         launch_filetracker_server()
         util.threadlocal_dir.ft_client_instance = filetracker.Client()
     return util.threadlocal_dir.ft_client_instance
@@ -103,18 +108,37 @@ def download(environ, key, dest=None, skip_if_exists=False, **kwargs):
         dest = os.path.join(dest, os.path.split(source)[1])
 
     dest = util.tempcwd(dest)
-    if not _use_filetracker(source, environ):
-        source = os.path.join(_original_cwd, source)
-        if not os.path.exists(dest) or not os.path.samefile(source, dest):
-            shutil.copy(source, dest)
-    else:
-        kwargs.setdefault('add_to_cache', False)
-        logger.debug("Downloading %s", source)
-        perf_timer = util.PerfTimer()
-        instance().get_file(source, dest, **kwargs)
-        logger.debug(" completed in %.2fs", perf_timer.elapsed)
+    with util.timed('download', file=key):
+        if not _use_filetracker(source, environ):
+            source = os.path.join(_original_cwd, source)
+            if not os.path.exists(dest) or \
+                    not os.path.samefile(source, dest):
+                shutil.copy(source, dest)
+        else:
+            kwargs.setdefault('add_to_cache', False)
+            logger.debug("Downloading %s", source)
+            perf_timer = util.PerfTimer()
+            instance().get_file(source, dest, **kwargs)
+            logger.debug(" completed in %.2fs", perf_timer.elapsed)
+            if kwargs['add_to_cache']:
+                _remember_cached(source)
     return dest
 
+
+def _remember_cached(path):
+    with lock:
+        _recently_cached.pop(path, None)
+        _recently_cached[path] = True
+        if len(_recently_cached) > RECENTLY_CACHED_LIMIT:
+            _recently_cached.popitem(last=False)
+
+
+def recently_cached():
+    """Returns filetracker paths most recently downloaded to the cache by
+       this process (at most ``RECENTLY_CACHED_LIMIT``, oldest first)."""
+    with lock:
+        return list(_recently_cached)
+
 def upload(environ, key, source, dest=None, **kwargs):
     """Uploads the file from ``source`` to filetracker under ``environ[key]``
        name.
@@ -139,15 +163,17 @@ def upload(environ, key, source, dest=None, **kwargs):
         dest = environ[key]
     elif dest.endswith(os.sep):
         dest = os.path.join(dest, os.path.split(source)[1])
-    if not _use_filetracker(dest, environ):
-        dest = os.path.join(_original_cwd, dest)
-        if not os.path.exists(dest) or not os.path.samefile(source, dest):
-            shutil.copy(source, dest)
-    else:
-        logger.debug("Uploading %s", dest)
-        perf_timer = util.PerfTimer()
-        dest = instance().put_file(dest, source, **kwargs)
-        logger.debug(" completed in %.2fs", perf_timer.elapsed)
+    with util.timed('upload', file=key):
+        if not _use_filetracker(dest, environ):
+            dest = os.path.join(_original_cwd, dest)
+            if not os.path.exists(dest) or \
+                    not os.path.samefile(source, dest):
+                shutil.copy(source, dest)
+        else:
+            logger.debug("Uploading %s", dest)
+            perf_timer = util.PerfTimer()
+            dest = instance().put_file(dest, source, **kwargs)
+            logger.debug(" completed in %.2fs", perf_timer.elapsed)
     environ[key] = dest
     return dest
 
@@ -178,6 +204,8 @@ def launch_filetracker_server():
 
     if 'FILETRACKER_PUBLIC_URL' not in os.environ:
         return
+    import six.moves.urllib.error
+    import six.moves.urllib.request
     public_url = os.environ['FILETRACKER_PUBLIC_URL'].split()[0]
     try:
         six.moves.urllib.request.urlopen(public_url + '/status')
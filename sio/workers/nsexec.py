@@ -0,0 +1,164 @@
+"""Helper of :class:`sio.workers.executors.NamespaceExecutor`.
+
+Creates new user and mount namespaces, builds the root directory of the
+sandbox from bind mounts on a ``tmpfs`` according to the given plan, chroots
+there and executes the command with ``/bin/sh -c``.
+
+Usage::
+
+    nsexec.py PLAN COMMAND
+    nsexec.py --check
+
+``PLAN`` is a JSON object with ``sources`` (host paths to bind),
+``ops`` (operations building the tree, see :func:`_apply`), ``cwd`` and
+``shell``.
+
+This file is run directly with ``python -E -S`` to keep the startup fast, so
+it must not import anything but the standard library.
+"""
+from __future__ import print_function
+import ctypes
+import json
+import os
+import sys
+
+CLONE_NEWNS = 0x00020000
+CLONE_NEWUSER = 0x10000000
+
+MS_RDONLY = 1
+MS_NOSUID = 2
+MS_NODEV = 4
+MS_NOEXEC = 8
+MS_REMOUNT = 32
+MS_NOATIME = 1024
+MS_NODIRATIME = 2048
+MS_BIND = 4096
+MS_REC = 16384
+MS_PRIVATE = 1 << 18
+MS_RELATIME = 1 << 21
+
+# Flags of the underlying mount (as in statvfs) which a read-only remount of
+# its bind in a user namespace has to keep, with the mount flags for them.
+_LOCKED_FLAGS = [(2, MS_NOSUID), (4, MS_NODEV), (8, MS_NOEXEC),
+                 (1024, MS_NOATIME), (2048, MS_NODIRATIME),
+                 (4096, MS_RELATIME)]
+
+# Where the new root is assembled. Mounts are private to the namespace, so
+# covering it does not affect anyone, and bind sources are opened earlier.
+BASE = '/tmp'
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+
+def _check(result, what):
+    if result != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, '%s: %s' % (what, os.strerror(errno)))
+
+
+def _bytes(s):
+    if s is None or isinstance(s, bytes):
+        return s
+    return s.encode(sys.getfilesystemencoding())
+
+
+def _mount(source, target, fstype, flags, data=None):
+    _check(_libc.mount(_bytes(source), _bytes(target), _bytes(fstype),
+                       ctypes.c_ulong(flags), _bytes(data)),
+           'mount %s' % target)
+
+
+def _remount_read_only(target):
+    statvfs_flags = os.statvfs(target).f_flag
+    flags = MS_REMOUNT | MS_BIND | MS_RDONLY
+    for statvfs_flag, mount_flag in _LOCKED_FLAGS:
+        if statvfs_flags & statvfs_flag:
+            flags |= mount_flag
+    _mount(None, target, None, flags)
+
+
+def _write(filename, data):
+    with open(filename, 'w') as f:
+        f.write(data)
+
+
+def _unshare():
+    uid, gid = os.getuid(), os.getgid()
+    _check(_libc.unshare(CLONE_NEWUSER | CLONE_NEWNS), 'unshare')
+    if os.path.exists('/proc/self/setgroups'):
+        _write('/proc/self/setgroups', 'deny')
+    _write('/proc/self/uid_map', '%d %d 1' % (uid, uid))
+    _write('/proc/self/gid_map', '%d %d 1' % (gid, gid))
+    _mount(None, '/', None, MS_REC | MS_PRIVATE)
+
+
+def _apply(plan):
+    """Builds the tree in ``BASE``. Operations are:
+
+       ``["dir", path]``
+         Creates a directory (if it does not exist).
+
+       ``["symlink", path, target]``
+         Creates a symbolic link.
+
+       ``["bind", path, source_index, is_dir, read_only]``
+         Creates a mount point (if it does not exist) and bind-mounts
+         the source there. Read-only binds are remounted at the end, when
+         mount points inside them are already created.
+    """
+    _unshare()
+    # O_PATH descriptors keep the sources reachable after BASE is covered.
+    # They are opened in the new namespace, as mounts of another namespace
+    # cannot be bound.
+    sources = [os.open(source, getattr(os, 'O_PATH', os.O_RDONLY))
+               for source in plan['sources']]
+    _mount('tmpfs', BASE, 'tmpfs', MS_NOSUID, 'mode=755')
+    read_only = []
+    for op in plan['ops']:
+        target = BASE + op[1]
+        if op[0] == 'dir':
+            if not os.path.isdir(target):
+                os.mkdir(target)
+        elif op[0] == 'symlink':
+            os.symlink(op[2], target)
+        elif op[0] == 'bind':
+            if not os.path.lexists(target):
+                if op[3]:
+                    os.mkdir(target)
+                else:
+                    open(target, 'w').close()
+            _mount('/proc/self/fd/%d' % sources[op[2]], target, None,
+                   MS_BIND | MS_REC)
+            if op[4]:
+                read_only.append(target)
+        else:
+            raise ValueError('Unknown operation %r' % (op,))
+    for target in read_only:
+        _remount_read_only(target)
+    _mount('tmpfs', BASE, 'tmpfs', MS_REMOUNT | MS_RDONLY | MS_NOSUID)
+
+    for fd in sources:
+        os.close(fd)
+
+
+def main(argv):
+    try:
+        if argv[1:] == ['--check']:
+            _unshare()
+            return 0
+
+        plan, command = json.loads(argv[1]), argv[2]
+        _apply(plan)
+        os.chroot(BASE)
+        try:
+            os.chdir(plan['cwd'])
+        except OSError:
+            os.chdir('/')
+        os.execv(plan['shell'], [plan['shell'], '-c', command])
+    except (OSError, IOError, ValueError) as e:
+        print('nsexec: %s' % e, file=sys.stderr)
+        return 127
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -14,7 +14,8 @@ except (ImportError, AttributeError):
     import simplejson as json
 
 from sio.workers import Failure
-from sio.workers.util import first_entry_point, TemporaryCwd
+from sio.workers.util import first_entry_point, TemporaryCwd, timed, \
+        collect_timings
 from sio.workers.ft import init_instance
 
 
@@ -63,26 +64,36 @@ def run(environ):
          Hostname of the machine running the job (i.e. the machine executing
          this function).
 
+       ``timings``
+         List of phases of the job (``tmpdir``, ``download``, ``sandbox``,
+         ``compile``, ``exec``, ``checker``, ``upload``, ``job``, ...) with
+         their ``wall`` and ``cpu`` time in milliseconds, in order of
+         completion. Phases may be nested, e.g. ``download`` within
+         ``job``. See :func:`sio.workers.util.timed`.
+
        Refer to :ref:`sio-workers-filters` for more information about filters.
     """
 
-    with TemporaryCwd():
-        try:
-            if environ.get('filetracker_url', None):
-                init_instance(environ['filetracker_url'])
-            environ = _run_filters('prefilters', environ)
-            environ = _add_meta(environ)
-            environ = first_entry_point('sio.jobs',
-                                        environ['job_type'])(environ)
-            environ['result'] = 'SUCCESS'
-            environ = _run_filters('postfilters', environ)
-        except Failure as e:
-            environ = _save_failure(e, environ)
+    with collect_timings() as timings:
+        with TemporaryCwd():
             try:
+                if environ.get('filetracker_url', None):
+                    init_instance(environ['filetracker_url'])
+                environ = _run_filters('prefilters', environ)
+                environ = _add_meta(environ)
+                job = first_entry_point('sio.jobs', environ['job_type'])
+                with timed('job'):
+                    environ = job(environ)
+                environ['result'] = 'SUCCESS'
                 environ = _run_filters('postfilters', environ)
             except Failure as e:
-                pass
+                environ = _save_failure(e, environ)
+                try:
+                    environ = _run_filters('postfilters', environ)
+                except Failure as e:
+                    pass
 
+    environ['timings'] = timings
     return environ
 
 def main():
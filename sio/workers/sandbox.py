@@ -4,25 +4,24 @@ import fcntl
 import os.path
 from hashlib import sha1
 import time
-import tarfile
 import shutil
 import logging
+import threading
 import weakref
-import six.moves.urllib.error
-import six.moves.urllib.parse
-import six.moves.urllib.request
-import email
 import errno
 
 from sio.workers import ft, _original_cwd
 from sio.workers.elf_loader_patch import _patch_elf_loader
-from sio.workers.util import rmtree
+from sio.workers.util import rmtree, timed
 
 SANDBOXES_BASEDIR = os.environ.get('SIO_SANDBOXES_BASEDIR',
         os.path.expanduser(os.path.join('~', '.sio-sandboxes')))
 SANDBOXES_URL = os.environ.get('SIO_SANDBOXES_URL',
                     'http://downloads.sio2project.mimuw.edu.pl/sandboxes')
 CHECK_INTERVAL = int(os.environ.get('SIO_SANDBOXES_CHECK_INTERVAL', 3600))
+#: Time (in seconds) for which used sandboxes are kept entered, see
+#: :class:`_LeasePool`. Zero disables leasing.
+LEASE_TIME = int(os.environ.get('SIO_SANDBOXES_LEASE_TIME', 0))
 
 logger = logging.getLogger(__name__)
 
@@ -147,18 +146,31 @@ class Sandbox(object):
         _mkdir(SANDBOXES_BASEDIR)
 
         self._in_context = 0
+        self._context_lock = threading.RLock()
+        self.lock = None
 
     def __enter__(self):
-        self._in_context += 1
-        if self._in_context == 1:
-            self.lock = _FileLock(self.path + '.lock')
-            self._get()
+        with self._context_lock:
+            self._in_context += 1
+            if self._in_context == 1:
+                try:
+                    if self.lock is None:
+                        self.lock = _FileLock(self.path + '.lock')
+                    # Someone may have upgraded the sandbox in the meantime.
+                    self.__dict__.pop('operative_fixups', None)
+                    with timed('sandbox', sandbox=self.name):
+                        self._get()
+                except:
+                    self._in_context -= 1
+                    raise
+                _leases.lease(self)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self._in_context -= 1
-        if self._in_context == 0:
-            self.lock.unlock()
+        with self._context_lock:
+            self._in_context -= 1
+            if self._in_context == 0:
+                self.lock.unlock()
 
     def __str__(self):
         return "<Sandbox: %s at %s>" % (self.name, self.path,)
@@ -226,6 +238,7 @@ class Sandbox(object):
             return True
 
     def _parse_last_modified(self, response):
+        import email.utils
         last_modified = response.info().get('last-modified')
         if last_modified:
             last_modified = email.utils.parsedate_tz(last_modified)
@@ -258,6 +271,16 @@ class Sandbox(object):
 
         return name in self.operative_fixups
 
+    @property
+    def version(self):
+        """Version of the installed sandbox (the hash of its image), or
+           ``None`` if not known. Valid only while the sandbox is entered."""
+        try:
+            with open(os.path.join(self.path, '.hash'), 'rb') as f:
+                return f.read().strip().decode('ascii') or None
+        except IOError:
+            return None
+
     def _get(self):
         """Downloads and installs the sandbox if it is not installed correctly
         or should be updated.
@@ -268,6 +291,10 @@ class Sandbox(object):
         we start downloading the sandbox thus we are deleting
         the `.lock` file inside that directory.
         """
+        # Needed only for installing, which is rare.
+        import tarfile
+        import six.moves.urllib.request
+
         name = self.name
         path = self.path
 
@@ -330,6 +357,7 @@ class Sandbox(object):
                         "did not contain expected directory '%s'" % name)
 
             self._apply_fixups()
+            self.__dict__.pop('operative_fixups', None)
 
             hash_file = os.path.join(path, '.hash')
             open(hash_file, 'wb').write(str(version))
@@ -343,6 +371,57 @@ class Sandbox(object):
 
         self.lock.lock_shared()
 
+class _LeasePool(object):
+    """Keeps sandboxes entered (and so shared-locked) for ``LEASE_TIME``
+       seconds after they are first entered, so that executors used for
+       consecutive tests enter them without touching the lock file or
+       checking for updates.
+
+       The lease is not extended by later use, so the sandbox is checked
+       for updates at least every ``LEASE_TIME`` seconds. Other processes
+       cannot upgrade a leased sandbox, use :func:`drain_leases` to let
+       them do it earlier.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases = {}
+
+    def lease(self, sandbox):
+        """Called by :class:`Sandbox` just after it is entered."""
+        if not LEASE_TIME:
+            return
+        with self._lock:
+            if sandbox.name in self._leases:
+                return
+            sandbox.__enter__()
+            timer = threading.Timer(LEASE_TIME, self.release, (sandbox.name,))
+            timer.daemon = True
+            self._leases[sandbox.name] = (sandbox, timer)
+        timer.start()
+
+    def release(self, name):
+        with self._lock:
+            sandbox, timer = self._leases.pop(name, (None, None))
+        if sandbox is not None:
+            timer.cancel()
+            sandbox.__exit__(None, None, None)
+
+    def drain(self):
+        with self._lock:
+            names = list(self._leases)
+        for name in names:
+            self.release(name)
+
+_leases = _LeasePool()
+
+def drain_leases():
+    """Releases all sandboxes kept entered by this process.
+
+    Sandboxes currently in use stay locked until they are exited.
+    """
+    _leases.drain()
+
 def get_sandbox(name):
     """Constructs a :class:`Sandbox` with the given ``name``.
 
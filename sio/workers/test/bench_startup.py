@@ -0,0 +1,95 @@
+"""Benchmark of ``sio-batch`` and ``sio-compile`` startup and of entry point
+resolution.
+
+Usage::
+
+    python -m sio.workers.test.bench_startup [--runs N]
+
+Cold start is measured by running each command in a new interpreter:
+``sio-batch`` runs a ``ping`` job, ``sio-compile`` is measured up to the
+point where the compiler is resolved, as the compilation itself is not
+interesting here. The sioworkers distribution has to be installed, so that
+its entry points can be found.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+import timeit
+
+from sio.workers.util import PerfTimer, first_entry_point, \
+        refresh_entry_points
+
+SIO_BATCH = '''
+import sys
+from sio.workers.runner import main
+main()
+print('pkg_resources' in sys.modules, file=sys.stderr)
+'''
+
+SIO_COMPILE = '''
+import sys
+from sio.compilers import job
+from sio.workers.util import first_entry_point
+first_entry_point('sio.compilers', 'system-cpp')
+print('pkg_resources' in sys.modules, file=sys.stderr)
+'''
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _cold_start(script, runs):
+    env = dict(os.environ, environ=json.dumps({'job_type': 'ping',
+                                                'ping': 'bench'}))
+    times = []
+    for _ in range(runs):
+        timer = PerfTimer()
+        process = subprocess.Popen([sys.executable, '-c', script], env=env,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        _, stderr = process.communicate()
+        times.append(timer.elapsed)
+        if process.returncode:
+            raise RuntimeError(stderr.decode('utf-8', 'replace'))
+    uses_pkg_resources = stderr.strip().splitlines()[-1] == b'True'
+    return times, uses_pkg_resources
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10,
+                        help='number of runs of each measurement')
+    args = parser.parse_args()
+
+    for name, script in (('sio-batch', SIO_BATCH),
+                         ('sio-compile', SIO_COMPILE)):
+        times, uses_pkg_resources = _cold_start(script, args.runs)
+        print('%s cold start: median %.3fs (min %.3fs, max %.3fs), '
+              'pkg_resources imported: %s' % (name, _median(times),
+              min(times), max(times), uses_pkg_resources))
+
+    def uncached():
+        refresh_entry_points()
+        first_entry_point('sio.jobs', 'ping')
+
+    def cached():
+        first_entry_point('sio.jobs', 'ping')
+
+    for name, function in (('uncached', uncached), ('cached', cached)):
+        number = args.runs * 10
+        elapsed = timeit.timeit(function, number=number)
+        print('first_entry_point %s: %.3fms per call'
+              % (name, 1000 * elapsed / number))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+#include <stdio.h>
+#include <string.h>
+#include <unistd.h>
+/* Checker supporting the persistent protocol, reporting its pid */
+
+int check(const char *out, const char *hint) {
+    char buf[255] = "", buf2[255] = "";
+    FILE* fdo = fopen(out, "r");
+    FILE* fdh = fopen(hint, "r");
+    fscanf(fdh, "%254s", buf);
+    fscanf(fdo, "%254s", buf2);
+    fclose(fdo);
+    fclose(fdh);
+    return strcmp(buf, buf2) == 0;
+}
+
+int main(int argc, char **argv) {
+    char in[4096], out[4096], hint[4096];
+    if (argc == 2 && strcmp(argv[1], "--persistent") == 0) {
+        puts("ready");
+        fflush(stdout);
+        while (scanf("%4095s %4095s %4095s", in, out, hint) == 3) {
+            printf("%s\n%d\n\n", check(out, hint) ? "OK" : "WRONG",
+                   (int) getpid());
+            fflush(stdout);
+        }
+        return 0;
+    }
+    printf("%s\none-shot\n\n", check(argv[2], argv[3]) ? "OK" : "WRONG");
+    return 0;
+}
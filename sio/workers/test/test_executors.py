@@ -3,6 +3,10 @@ import glob
 import os.path
 import re
 import filecmp
+import sys
+import tempfile
+import threading
+import time
 
 from nose.tools import ok_, eq_, assert_not_equal, nottest, raises, \
         assert_raises
@@ -12,14 +16,17 @@ from sio.compilers.job import run as run_compiler
 from sio.executors.common import run as run_executor
 from sio.executors.ingen import run as run_ingen
 from sio.executors.inwer import run as run_inwer
-from sio.executors.checker import RESULT_STRING_LENGTH_LIMIT
-from sio.workers import ft
+from sio.executors import batch, checker, memo, sio2jail_exec, vcpu_exec
+from sio.executors.checker import RESULT_STRING_LENGTH_LIMIT, \
+        run as run_checker
+from sio.workers import ft, executors
 from sio.workers.execute import execute
 from sio.workers.executors import UnprotectedExecutor, \
         DetailedUnprotectedExecutor, SupervisedExecutor, VCPUExecutor, \
-        ExecError, _SIOSupervisedExecutor
+        ExecError, _SIOSupervisedExecutor, PRootExecutor, NamespaceExecutor
 from sio.workers.file_runners import get_file_runner
-from sio.workers.util import tempcwd, TemporaryCwd
+from sio.workers.util import tempcwd, TemporaryCwd, LazyLines, rmtree, \
+        collect_timings, first_entry_point, DEFAULT_BATCH_PARALLELISM
 import six
 
 # sio2-executors tests
@@ -329,6 +336,44 @@ def test_untrusted_checkers():
         # Wrong model solution
         yield raises(SystemError)(_test), '/chk-rtn2.c', None
 
+def test_persistent_checkers():
+    def _test(checker, callback, sandboxed=False):
+        with TemporaryCwd():
+            upload_files()
+            checker_bin = compile(checker, '/chk.e')['out_file']
+        results = []
+        for _ in range(2):
+            with TemporaryCwd():
+                executor = SupervisedExecutor(use_program_return_code=True) \
+                        if sandboxed else DetailedUnprotectedExecutor()
+                renv = compile_and_run('/add_print.c', {
+                        'in_file': '/input',
+                        'check_output': True,
+                        'hint_file': '/hint',
+                        'chk_file': checker_bin,
+                        'untrusted_checker': True,
+                        'persistent_checker': True,
+                        'use_checker_cache': False,
+                }, executor, use_sandboxes=sandboxed)
+                print_env(renv)
+                res_ok(renv)
+                results.append(renv['result_string'])
+        callback(results)
+
+    def same_process(results):
+        eq_(results[0], results[1])
+        ok_(results[0].isdigit())
+
+    def one_shot(results):
+        eq_(results, ['OK', 'OK'])
+
+    yield _test, '/chk-persistent.c', same_process
+    # Checkers not supporting the protocol are run the usual way.
+    yield _test, '/chk.c', one_shot
+
+    if ENABLE_SANDBOXES:
+        yield _test, '/chk-persistent.c', same_process, True
+
 def test_inwer():
     def _test(inwer, in_file, use_sandboxes, callback):
         with TemporaryCwd():
@@ -381,7 +426,8 @@ def test_inwer():
                 check_inwer_big_output(use_sandboxes)
 
 def test_ingen():
-    def _test(ingen, re_string, upload_dir, use_sandboxes, callback):
+    def _test(ingen, re_string, upload_dir, use_sandboxes, callback,
+              chroot_executor='proot'):
         with TemporaryCwd():
             upload_files()
             ingen_bin = compile(ingen, '/ingen.e')['out_file']
@@ -392,6 +438,7 @@ def test_ingen():
                     'exe_file': ingen_bin,
                     'use_sandboxes': use_sandboxes,
                     'ingen_output_limit': SMALL_OUTPUT_LIMIT,
+                    'chroot_executor': chroot_executor,
                     }
             renv = run_ingen(env)
             print_env(renv)
@@ -452,6 +499,155 @@ def test_ingen():
     if ENABLE_SANDBOXES:
         yield _test, '/ingen_nosy.c', 'myfile.txt', 'somedir', True, \
                 check_proot_fail
+    if ENABLE_SANDBOXES and NamespaceExecutor.is_supported():
+        for test in test_sets:
+            yield _test, test['program'], test['re_string'], test['dir'], \
+                    True, \
+                    check_upload(test['dir'], test['files'], test['output']), \
+                    'namespace'
+
+def test_chroot_executors():
+    if not ENABLE_SANDBOXES or not NamespaceExecutor.is_supported():
+        return
+
+    def _run(executor_class):
+        with TemporaryCwd():
+            with open(tempcwd('in'), 'w') as f:
+                f.write('42\n')
+            with executor_class('null-sandbox') as executor:
+                renv = executor(['sh', '-c',
+                        'pwd; cat /tmp/in; ls; echo ok > out'],
+                        capture_output=True, split_lines=True)
+            eq_(open(tempcwd('out')).read(), 'ok\n')
+            eq_(sorted(os.listdir(tempcwd())), ['in', 'out'])
+            renv['stdout'][0] = renv['stdout'][0].replace(
+                    tempcwd().encode('utf-8'), b'CWD')
+            return renv['stdout']
+
+    # Both executors show the same tree to the program.
+    eq_(_run(PRootExecutor), _run(NamespaceExecutor))
+
+def test_namespace_executor_host_side():
+    # Only what happens around nsexec, so it runs without sandboxes.
+    class _Host(UnprotectedExecutor):
+        def _execute(self, command, **kwargs):
+            self.kwargs = kwargs
+            return {'return_code': 0}
+
+    def _command(command, options, cwd=None, read_only_binds=()):
+        os.makedirs(os.path.join(scratch, 'mnt'))
+        return command, scratch
+
+    executor = NamespaceExecutor('null-sandbox')
+    executor._host = _Host()
+    executor._command = _command
+    executor._job_options = lambda: []
+    executor._bind_options = lambda binds: []
+    with TemporaryCwd():
+        scratch = tempcwd('scratch')
+        executor(['true'], time_limit=1000)
+        eq_(executor._host.kwargs['real_time_limit'], 3000)
+        ok_(not os.path.exists(scratch))
+
+        process = executor.popen(['true'])
+        ok_(os.path.exists(scratch))
+        eq_(process.wait(), 0)
+        ok_(not os.path.exists(scratch))
+
+def test_namespace_mount_tree():
+    root = tempfile.mkdtemp()
+    job = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(root, 'tmp'))
+        open(os.path.join(job, 'a.c'), 'w').close()
+        # The job directory is visible as /tmp and as itself, inside /tmp.
+        nested = '/tmp/' + os.path.basename(job)
+        tree = executors._MountTree(root, [(job, '/tmp'), (job, nested)])
+        sources, ops, scratch = tree.plan()
+        try:
+            eq_(os.listdir(job), ['a.c'])
+            ok_(scratch is not None)
+            binds = dict((op[1], sources[op[2]]) for op in ops
+                         if op[0] == 'bind')
+            ok_(binds['/tmp'].startswith(scratch + os.sep))
+            eq_(binds['/tmp/a.c'], os.path.join(job, 'a.c'))
+            eq_(binds[nested], job)
+        finally:
+            rmtree(scratch)
+
+        # No scratch is needed when mount points exist.
+        tree = executors._MountTree(root, [(job, '/tmp/a.c')])
+        eq_(tree.plan()[2], None)
+    finally:
+        rmtree(root)
+        rmtree(job)
+
+def test_chroot_executor_popen_binds():
+    if not ENABLE_SANDBOXES:
+        return
+
+    def _test(executor_class, use_binds):
+        visible = tempfile.mkdtemp()
+        hidden = tempfile.mkdtemp()
+        try:
+            for directory in (visible, hidden):
+                open(os.path.join(directory, os.path.basename(directory)),
+                     'w').close()
+            kwargs = {'binds': [visible]} if use_binds else {}
+            with executor_class('null-sandbox') as executor:
+                process = executor.popen(
+                        ['sh', '-c', 'ls %s %s' % (visible, hidden)],
+                        cwd=visible, **kwargs)
+                process.stdin.close()
+                output = process.stdout.read().decode('utf-8')
+                process.wait()
+                process.stdout.close()
+            in_(os.path.basename(visible), output.split())
+            not_in_(os.path.basename(hidden), output.split())
+        finally:
+            rmtree(visible)
+            rmtree(hidden)
+
+    # Without binds only the working directory is visible.
+    yield _test, PRootExecutor, False
+    yield _test, PRootExecutor, True
+    if NamespaceExecutor.is_supported():
+        yield _test, NamespaceExecutor, False
+        yield _test, NamespaceExecutor, True
+
+def test_chroot_executor_read_only_binds():
+    executor = PRootExecutor('null-sandbox')
+    eq_(executor._bind_options(['/a', '/b']),
+        ['-b', '/a:/a', '-b', '/b:/b'])
+
+    if not ENABLE_SANDBOXES or not NamespaceExecutor.is_supported():
+        return
+
+    directory = tempfile.mkdtemp()
+    try:
+        open(os.path.join(directory, 'visible'), 'w').close()
+        with TemporaryCwd():
+            with NamespaceExecutor('null-sandbox') as executor:
+                renv = executor(['sh', '-c', 'ls %s; echo > %s/written'
+                                 % (directory, directory)],
+                                read_only_binds=[directory],
+                                capture_output=True, ignore_errors=True)
+        in_(b'visible', renv['stdout'])
+        ok_(renv['return_code'])
+        ok_(not os.path.exists(os.path.join(directory, 'written')))
+    finally:
+        rmtree(directory)
+
+def test_chroot_executor_templates():
+    if not ENABLE_SANDBOXES:
+        return
+
+    executors._templates.clear()
+    with PRootExecutor('null-sandbox') as first:
+        options = first.options
+    with PRootExecutor('null-sandbox') as second:
+        eq_(options, second.options)
+    eq_(len(executors._templates), 1)
 
 # Direct tests
 def test_uploading_out():
@@ -467,6 +663,227 @@ def test_uploading_out():
         ft.download({'path': '/output'}, 'path', 'd_out')
         in_('84', open(tempcwd('d_out')).read())
 
+def test_exec_memo():
+    calls = []
+
+    def _counting(name, function):
+        def _wrapper(*args, **kwargs):
+            calls.append(name)
+            return function(*args, **kwargs)
+        return _wrapper
+
+    def _run(expected_calls, **extra_env):
+        del calls[:]
+        with TemporaryCwd():
+            renv = run_executor(dict(env, **extra_env), executor,
+                                use_sandboxes=False)
+            print_env(renv)
+            # The program prints an extra line, missing in the hint.
+            res_wa(renv)
+            eq_(calls, expected_calls)
+            ft.download({'path': '/output'}, 'path', 'd_out')
+            in_('84', open(tempcwd('d_out')).read())
+
+    executor = DetailedUnprotectedExecutor()
+    # Pretend the executor counts instructions.
+    executor.deterministic = True
+    executor._execute = _counting('exec', executor._execute)
+    run_diff = checker._run_diff
+    checker._run_diff = _counting('check', run_diff)
+    cache_dir = memo.CACHE_DIR
+    memo.CACHE_DIR = tempfile.mkdtemp()
+    try:
+        with TemporaryCwd():
+            upload_files()
+            cenv = compile('/add_print.c', use_sandboxes=False)
+        env = {
+            'exe_file': cenv['out_file'],
+            'exec_info': cenv['exec_info'],
+            'in_file': '/input',
+            'out_file': '/output',
+            'check_output': True,
+            'hint_file': '/hint',
+            'use_exec_memo': True,
+            'use_checker_cache': False,
+        }
+        _run(['exec', 'check'])
+        _run([])
+        _run(['exec', 'check'], use_exec_memo=False)
+        # The same output is checked only once.
+        _run(['exec'], exec_time_limit=1000)
+
+        # Errors which may be caused by the machine are not memoized.
+        execute = executor._execute
+
+        def _system_error(*args, **kwargs):
+            renv = execute(*args, **kwargs)
+            renv['result_code'] = 'SE'
+            return renv
+        executor._execute = _system_error
+        for _ in range(2):
+            del calls[:]
+            with TemporaryCwd():
+                renv = run_executor(dict(env, exec_time_limit=2000),
+                                    executor, use_sandboxes=False)
+            eq_(renv['result_code'], 'SE')
+            eq_(calls, ['exec'])
+    finally:
+        rmtree(memo.CACHE_DIR)
+        memo.CACHE_DIR = cache_dir
+        checker._run_diff = run_diff
+
+def test_checker_cache():
+    def _test(env, cache_size, use_cache, expected_calls):
+        checker._cache.clear()
+        calls = []
+        keys = []
+        run_diff = checker._run_diff
+        check_key = memo.check_key
+        size = checker._cache.size
+
+        def _run_diff(env):
+            calls.append(env['out_file'])
+            return run_diff(env)
+
+        def _check_key(*args):
+            keys.append(args)
+            return check_key(*args)
+
+        checker._run_diff = _run_diff
+        memo.check_key = _check_key
+        checker._cache.size = cache_size
+        try:
+            # Any files differing from the hint will do as outputs.
+            for output in ('/add_print.c', '/echo.c', '/add_print.c'):
+                with TemporaryCwd():
+                    upload_files()
+                    renv = run_checker(dict(env, out_file=output,
+                                            use_checker_cache=use_cache),
+                                       use_sandboxes=False)
+                    print_env(renv)
+                    res_wa(renv)
+        finally:
+            checker._run_diff = run_diff
+            memo.check_key = check_key
+            checker._cache.size = size
+        eq_(calls, expected_calls)
+        # Outputs are not hashed when there is no cache to look them up in.
+        eq_(bool(keys), bool(cache_size and use_cache))
+
+    env = {'in_file': '/input', 'hint_file': '/hint', 'use_exec_memo': False}
+    all_calls = ['/add_print.c', '/echo.c', '/add_print.c']
+    yield _test, env, 16, True, ['/add_print.c', '/echo.c']
+    yield _test, env, 16, False, all_calls
+    yield _test, env, 0, True, all_calls
+
+def test_checker_result():
+    # On Python 3 checker output is read as bytes.
+    for output in (['OK', 'fine', '50'], LazyLines(b'OK\nfine\n50')):
+        result = checker._result(output)
+        eq_(result['result_code'], 'OK')
+        eq_(result['result_percentage'], 50.0)
+    eq_(checker._result(LazyLines(b'WRONG\nno'))['result_code'], 'WA')
+
+def test_batch_exec():
+    lock = threading.Lock()
+    running = [0, 0]  # currently and at most
+    running_cpus = []
+
+    def _counting_executor():
+        executor = DetailedUnprotectedExecutor()
+        execute = executor._execute
+
+        def _execute(command, **kwargs):
+            if kwargs['environ'].get('fail'):
+                raise RuntimeError('Test %d failed' % kwargs['environ']['id'])
+            # The CPUs are made up, so the program is not really pinned.
+            cpus = kwargs.pop('cpu_affinity')
+            with lock:
+                eq_(len(cpus), 1)
+                not_in_(cpus[0], running_cpus)
+                running_cpus.append(cpus[0])
+                running[0] += 1
+                running[1] = max(running)
+            try:
+                time.sleep(0.1)
+                return execute(command, **kwargs)
+            finally:
+                with lock:
+                    running[0] -= 1
+                    running_cpus.remove(cpus[0])
+        executor._execute = _execute
+        return executor
+
+    def _run(tests, **extra_env):
+        running[1] = 0
+        available_cpus = batch.available_cpus
+        batch.available_cpus = lambda: list(range(16))
+        try:
+            with TemporaryCwd():
+                upload_files()
+                cenv = compile('/add_print.c', use_sandboxes=False)
+                env = dict({'exe_file': cenv['out_file'],
+                            'exec_info': cenv['exec_info'],
+                            'in_file': '/input',
+                            'tests': tests}, **extra_env)
+                return batch.run(env, _counting_executor, use_sandboxes=False)
+        finally:
+            batch.available_cpus = available_cpus
+
+    def _test(parallelism, expected_parallelism):
+        tests = [{'id': i, 'out_file': '/output%d' % i, 'upload_out': True}
+                 for i in range(8)]
+        renv = _run(tests, batch_parallelism=parallelism)
+        print_env(renv)
+        eq_([test['id'] for test in renv['tests']], list(range(8)))
+        for test in renv['tests']:
+            res_ok(test)
+        ok_(1 <= running[1] <= expected_parallelism)
+
+    def _test_error(failing):
+        tests = [{'id': i, 'fail': i == failing} for i in range(8)]
+        with assert_raises(RuntimeError) as cm:
+            _run(tests, batch_parallelism=2)
+        eq_(str(cm.exception), 'Test %d failed' % failing)
+
+    def _test_other_jobs():
+        available_cpus = batch.available_cpus
+        batch.available_cpus = lambda: list(range(4))
+        first = batch._reserve_cpus(2)
+        try:
+            eq_(first, [0, 1])
+            # CPUs used by another job come last.
+            second = batch._reserve_cpus(3)
+            eq_(second, [2, 3, 0])
+            batch._release_cpus(second)
+        finally:
+            batch._release_cpus(first)
+            batch.available_cpus = available_cpus
+        eq_(batch._cpu_users, {})
+
+    yield _test, 1, 1
+    yield _test, 3, 3
+    yield _test, None, DEFAULT_BATCH_PARALLELISM
+    yield _test_error, 0
+    yield _test_error, 7
+    yield (_test_other_jobs,)
+
+def test_cpu_affinity():
+    if not hasattr(os, 'sched_setaffinity'):
+        return
+    cpu = batch.available_cpus()[-1]
+    with TemporaryCwd():
+        _, stdout = execute([sys.executable, '-c',
+                'import os; print(sorted(os.sched_getaffinity(0)))'],
+                cpu_affinity=[cpu])
+    eq_(stdout.strip(), ('[%d]' % cpu).encode())
+
+def test_batch_exec_entry_points():
+    eq_(first_entry_point('sio.jobs', 'vcpu-batch-exec'),
+        vcpu_exec.run_batch)
+    eq_(first_entry_point('sio.jobs', 'sio2jail-batch-exec'),
+        sio2jail_exec.run_batch)
+
 @nottest
 def _test_transparent_exec(source, executor, callback, kwargs):
     with TemporaryCwd():
@@ -502,6 +919,11 @@ def test_capturing_stdout():
         ok_(isinstance(env['stdout'], list))
         eq_(len(env['stdout']), 3)
 
+    def lines_split_lazily(env):
+        ok_(isinstance(env['stdout'], LazyLines))
+        eq_(len(env['stdout']), 3)
+        eq_(env['stdout'][1], b'stdout')
+
     executors = [UnprotectedExecutor]
     if ENABLE_SANDBOXES:
         executors = executors + [VCPUExecutor]
@@ -511,10 +933,45 @@ def test_capturing_stdout():
                 {'capture_output': True}
         yield _test_exec, '/add_print.c', executor(), lines_split, \
                 {'capture_output': True, 'split_lines': True}
+        yield _test_exec, '/add_print.c', executor(), lines_split_lazily, \
+                {'capture_output': True, 'split_lines': 'lazy'}
         yield _test_exec, '/add_print.c', executor(), with_stderr, \
                 {'capture_output': True, 'forward_stderr': True}
 
 
+def test_capturing_big_output():
+    with TemporaryCwd():
+        renv = UnprotectedExecutor()(['head', '-c', str(2**28), '/dev/zero'],
+                capture_output=True, output_limit=2**10)
+    eq_(renv['return_code'], 0)
+    eq_(renv['stdout'], b'\0' * 2**10)
+    ok_(renv['output_truncated'])
+
+def test_output_limit_actions():
+    with TemporaryCwd():
+        renv = UnprotectedExecutor()(['echo', 'abc'], capture_output=True,
+                output_limit=4)
+        ok_(not renv['output_truncated'])
+
+        # Would never finish without being killed.
+        renv = UnprotectedExecutor()(['yes'], capture_output=True,
+                output_limit=2**10, ignore_errors=True,
+                environ={'test_output_limit_action': 'kill'},
+                environ_prefix='test_')
+        ok_(renv['output_truncated'])
+        eq_(len(renv['stdout']), 2**10)
+        ok_(renv['return_code'] != 0)
+
+def test_zero_output_limit():
+    # Means no limit, so nothing is lost nor killed.
+    with TemporaryCwd():
+        renv = UnprotectedExecutor()(['echo', 'abc'], capture_output=True,
+                output_limit=0, environ={'test_output_limit_action': 'kill'},
+                environ_prefix='test_')
+    eq_(renv['return_code'], 0)
+    eq_(renv['stdout'], b'abc\n')
+    ok_(not renv['output_truncated'])
+
 def test_return_codes():
     def ret_42(env):
         eq_(42, env['return_code'])
@@ -665,3 +1122,27 @@ def test_execute():
         rc, out = execute(['ls', tempcwd()])
         in_(b'spam', out)
 
+
+def test_timings():
+    with TemporaryCwd(), collect_timings() as timings:
+        upload_files()
+        del timings[:]
+        compile_and_run('/add_print.c', {
+            'in_file': '/input',
+            'out_file': '/output',
+            'check_output': True,
+            'hint_file': '/hint',
+            'use_exec_memo': False,
+            'use_checker_cache': False,
+        }, DetailedUnprotectedExecutor())
+
+    phases = [timing['phase'] for timing in timings]
+    for phase in ('download', 'compile', 'exec', 'checker', 'upload'):
+        in_(phase, phases)
+    ok_(phases.index('compile') < phases.index('exec')
+        < phases.index('checker'))
+    eq_(set(timing['file'] for timing in timings
+            if timing['phase'] == 'download'),
+        set(['source_file', 'exe_file', 'in_file', 'hint_file']))
+    for timing in timings:
+        ok_(timing['wall'] >= 0 and timing['cpu'] >= 0)
@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+import os
+import tempfile
+import time
+
+from nose.tools import ok_, eq_
+
+from sio.workers import sandbox
+from sio.workers.util import rmtree
+
+# Sandboxes here are fake, installed directories which are recently checked
+# for updates, so they are never downloaded.
+
+
+def _install(basedir, name):
+    path = os.path.join(basedir, name)
+    os.makedirs(path)
+    with open(os.path.join(path, '.fixups_applied'), 'w') as f:
+        f.write('elf_loader_patch\n')
+    with open(os.path.join(path, '.last_check'), 'w') as f:
+        f.write(str(int(time.time())))
+
+
+def _with_leases(lease_time):
+    def decorator(test):
+        def wrapper():
+            basedir = tempfile.mkdtemp()
+            saved = sandbox.SANDBOXES_BASEDIR, sandbox.LEASE_TIME
+            sandbox.SANDBOXES_BASEDIR, sandbox.LEASE_TIME = basedir, lease_time
+            try:
+                _install(basedir, 'fake-sandbox')
+                test(sandbox.Sandbox('fake-sandbox'))
+            finally:
+                sandbox.drain_leases()
+                sandbox.SANDBOXES_BASEDIR, sandbox.LEASE_TIME = saved
+                rmtree(basedir)
+        wrapper.__name__ = test.__name__
+        return wrapper
+    return decorator
+
+
+def _count_gets(box):
+    gets = []
+    get = box._get
+
+    def _get():
+        gets.append(True)
+        get()
+    box._get = _get
+    return gets
+
+
+@_with_leases(0)
+def test_without_leases(box):
+    gets = _count_gets(box)
+    with box:
+        with box:
+            eq_(box._in_context, 2)
+    eq_(box._in_context, 0)
+    with box:
+        pass
+    eq_(len(gets), 2)
+
+
+@_with_leases(60)
+def test_lease_reuse(box):
+    gets = _count_gets(box)
+    with box:
+        lock = box.lock
+    # Still entered, by the lease.
+    eq_(box._in_context, 1)
+    with box:
+        pass
+    eq_(len(gets), 1)
+    ok_(box.lock is lock)
+
+    sandbox.drain_leases()
+    eq_(box._in_context, 0)
+    with box:
+        pass
+    eq_(len(gets), 2)
+    ok_(box.lock is lock)
+
+
+@_with_leases(1)
+def test_lease_expiry(box):
+    with box:
+        pass
+    timer = sandbox._leases._leases[box.name][1]
+    timer.join(5)
+    eq_(box._in_context, 0)
+    ok_(box.name not in sandbox._leases._leases)
+
+
+@_with_leases(60)
+def test_drain_leaves_used_sandboxes_entered(box):
+    with box:
+        sandbox.drain_leases()
+        eq_(box._in_context, 1)
+    eq_(box._in_context, 0)
@@ -0,0 +1,47 @@
+from __future__ import absolute_import
+import json
+import os
+import subprocess
+import sys
+
+from nose.tools import ok_, eq_
+
+from sio.workers.util import PerfTimer
+
+# Cold start of sio-batch running a ping job, in seconds, over the startup
+# of the bare interpreter.
+STARTUP_BUDGET = 0.5
+
+# Modules which a ping job should not need.
+HEAVY_MODULES = ['pkg_resources', 'filetracker', 'tarfile',
+                 'urllib.request', 'sio.workers.executors',
+                 'sio.workers.sandbox']
+
+PING_JOB = '''
+import json
+import sys
+from sio.workers.runner import run
+environ = run({'job_type': 'ping', 'ping': 'startup'})
+print(json.dumps([environ.get('pong'), sorted(sys.modules)]))
+'''
+
+
+def _run(script):
+    timer = PerfTimer()
+    output = subprocess.check_output([sys.executable, '-c', script],
+                                     env=os.environ.copy())
+    return timer.elapsed, output
+
+
+def test_ping_startup():
+    baseline = min(_run('pass')[0] for _ in range(3))
+    runs = [_run(PING_JOB) for _ in range(3)]
+    elapsed = min(run[0] for run in runs)
+    pong, modules = json.loads(runs[0][1].decode('utf-8'))
+
+    eq_(pong, 'startup')
+    for module in HEAVY_MODULES:
+        ok_(module not in modules, '%s imported by a ping job' % module)
+    ok_(elapsed - baseline < STARTUP_BUDGET,
+        'ping job startup took %.3fs over the interpreter startup'
+        % (elapsed - baseline))
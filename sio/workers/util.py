@@ -1,6 +1,5 @@
 from __future__ import absolute_import
 from contextlib import contextmanager
-import pkg_resources
 import time
 import logging
 import stat
@@ -13,13 +12,72 @@ import six
 logger = logging.getLogger(__name__)
 
 
+# Entry points resolved in this process, see first_entry_point.
+_entry_points = {}
+_loaded_entry_points = {}
+_missing_entry_points = set()
+_entry_points_lock = threading.Lock()
+
+
+def _scan_entry_points(group):
+    """Returns a list of ``(name, entry point)`` pairs of the ``group``."""
+    try:
+        from importlib import metadata
+    except ImportError:
+        import pkg_resources
+        return [(ep.name, ep) for ep in pkg_resources.iter_entry_points(group)]
+
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=group)
+    else:
+        entry_points = entry_points.get(group, ())
+    return [(ep.name, ep) for ep in entry_points]
+
+
+def refresh_entry_points():
+    """Forgets all entry points resolved by :func:`first_entry_point`, so that
+       newly installed distributions are seen."""
+    with _entry_points_lock:
+        _entry_points.clear()
+        _loaded_entry_points.clear()
+        _missing_entry_points.clear()
+
+
 def first_entry_point(group, name=None):
-    for ep in pkg_resources.iter_entry_points(group, name):
-        try:
-            return ep.load()
-        except ImportError as e:
-            logger.warning('ImportError: %s: %s' % (ep, e,))
-            pass
+    """Loads the first entry point named ``name`` (or any, if ``None``) from
+       ``group`` which can be imported.
+
+       Installed entry points are scanned once per process and the results,
+       including names not found, are cached. Use
+       :func:`refresh_entry_points` to scan them again.
+    """
+    key = (group, name)
+    with _entry_points_lock:
+        if key in _loaded_entry_points:
+            return _loaded_entry_points[key]
+        missing = key in _missing_entry_points
+        entry_points = _entry_points.get(group)
+    if not missing:
+        if entry_points is None:
+            entry_points = _scan_entry_points(group)
+            with _entry_points_lock:
+                _entry_points[group] = entry_points
+
+        for ep_name, ep in entry_points:
+            if name is not None and ep_name != name:
+                continue
+            try:
+                value = ep.load()
+            except ImportError as e:
+                logger.warning('ImportError: %s: %s' % (ep, e,))
+                continue
+            with _entry_points_lock:
+                _loaded_entry_points[key] = value
+            return value
+
+        with _entry_points_lock:
+            _missing_entry_points.add(key)
     raise RuntimeError("Module providing '%s:%s' not found" %
             (group, name or ''))
 
@@ -57,6 +115,23 @@ def ceil_ms2s(miliseconds):
     """
     return int((miliseconds + 999) / 1000)
 
+# Number of tests of a batch job run at once, unless set in the job.
+DEFAULT_BATCH_PARALLELISM = 4
+
+def batch_parallelism(environ):
+    """Returns the maximum number of tests of a batch job (see
+       :mod:`sio.executors.batch`) run at once. sioworkersd reserves memory
+       for that many tests, so workers must not run more.
+
+       >>> batch_parallelism({'tests': [{}] * 10, 'batch_parallelism': 2})
+       2
+       >>> batch_parallelism({'tests': [{}] * 2})
+       2
+    """
+    tests = environ.get('tests') or [{}]
+    return max(1, min(len(tests), environ.get('batch_parallelism')
+                                  or DEFAULT_BATCH_PARALLELISM))
+
 class Writable(object):
     """Context manager making file writable.
 
@@ -86,6 +161,52 @@ def rmtree(path):
 
 threadlocal_dir = threading.local()
 
+
+def _thread_cpu_time():
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+    # Python 2: CPU time of the whole process.
+    return sum(os.times()[:2])
+
+
+@contextmanager
+def timed(phase, **details):
+    """Records the wall and CPU time (in ms) spent in the block as
+       ``phase`` of the current job, together with ``details``. CPU time is
+       that of the calling thread, without child processes.
+
+       Timings are collected by :func:`sio.workers.runner.run` in
+       ``environ['timings']``. Outside of a job this does nothing.
+    """
+    timings = getattr(threadlocal_dir, 'timings', None)
+    if timings is None:
+        yield
+        return
+    wall = time.time()
+    cpu = _thread_cpu_time()
+    try:
+        yield
+    finally:
+        entry = {'phase': phase,
+                 'wall': round(1000 * (time.time() - wall), 3),
+                 'cpu': round(1000 * (_thread_cpu_time() - cpu), 3)}
+        entry.update(details)
+        timings.append(entry)
+
+
+@contextmanager
+def collect_timings():
+    """Collects phases recorded with :func:`timed` by the enclosed code
+       in the current thread. Yields the list of them."""
+    timings = []
+    previous = getattr(threadlocal_dir, 'timings', None)
+    threadlocal_dir.timings = timings
+    try:
+        yield timings
+    finally:
+        threadlocal_dir.timings = previous
+
+
 def tempcwd(path=None):
     # Someone might call tempcwd twice, i.e. tempcwd(tempcwd('something'))
     # Do nothing in this case.
@@ -106,19 +227,21 @@ class TemporaryCwd(object):
         self.old_path = None
 
     def __enter__(self):
-        self.path = tempfile.mkdtemp(prefix='sioworkers_')
-        logger.info('Using temporary directory %s', self.path)
-        p = self.path
-        if self.extra:
-            p = os.path.join(self.path, self.extra)
-            os.mkdir(p)
+        with timed('tmpdir'):
+            self.path = tempfile.mkdtemp(prefix='sioworkers_')
+            logger.info('Using temporary directory %s', self.path)
+            p = self.path
+            if self.extra:
+                p = os.path.join(self.path, self.extra)
+                os.mkdir(p)
         self.old_path = getattr(threadlocal_dir, 'tmpdir', None)
         threadlocal_dir.tmpdir = p
 
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        shutil.rmtree(self.path)
+        with timed('cleanup'):
+            shutil.rmtree(self.path)
         threadlocal_dir.tmpdir = self.old_path
 
 
@@ -158,6 +281,59 @@ def decode_fields(fields):
     return _decode_decorator
 
 
+class LazyLines(object):
+    """Lines of ``data`` split on ``b'\\n'``, like ``data.split(b'\\n')``,
+       but produced only as far as they are used.
+
+       Supports iteration, indexing, ``len`` and comparison with lists.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._lines = None
+
+    def _list(self):
+        if self._lines is None:
+            self._lines = self.data.split(b'\n')
+        return self._lines
+
+    def __iter__(self):
+        if self._lines is not None:
+            return iter(self._lines)
+        return self._iter()
+
+    def _iter(self):
+        start = 0
+        while True:
+            end = self.data.find(b'\n', start)
+            if end == -1:
+                yield self.data[start:]
+                return
+            yield self.data[start:end]
+            start = end + 1
+
+    def __getitem__(self, index):
+        if isinstance(index, six.integer_types) and index >= 0 \
+                and self._lines is None:
+            for i, line in enumerate(self._iter()):
+                if i == index:
+                    return line
+            raise IndexError('line index out of range')
+        return self._list()[index]
+
+    def __len__(self):
+        return self.data.count(b'\n') + 1
+
+    def __eq__(self, other):
+        return self._list() == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self._list())
+
+
 def null_ctx_manager():
     def dummy():
         yield
@@ -3,18 +3,24 @@ from __future__ import print_function
 import six.moves.urllib.parse
 import importlib
 import platform
+import signal
 from zope.interface import implements
 
 from twisted.python import usage
 from twisted.plugin import IPlugin
 from twisted.application import service
 from twisted.application import internet
+from twisted.internet import reactor
 
 from sio.protocol.worker import WorkerFactory
+from sio.workers import sandbox
 from sio.sioworkersd.workermanager import WorkerManager
 from sio.sioworkersd.scheduler import getDefaultSchedulerClassName
 from sio.sioworkersd.taskmanager import TaskManager
 from sio.sioworkersd import siorpc
+from sio.sioworkersd import offload
+from sio.sioworkersd.reactormonitor import ReactorMonitor
+from sio.sioworkersd import trace
 
 
 def _host_from_url(url):
@@ -22,10 +28,20 @@ def _host_from_url(url):
 
 
 class WorkerOptions(usage.Options):
-    # TODO: default concurrency to number of detected cpus
     optParameters = [['port', 'p', 7888, "sioworkersd port number", int],
-                     ['concurrency', 'c', 1, "maximum concurrent jobs", int],
-                     ['ram', 'r', 1024, 'available RAM in MiB', int],
+                     ['concurrency', 'c', 0, "maximum concurrent jobs "
+                        "(0 to use the number of available CPUs)", int],
+                     ['ram', 'r', 0, "available RAM in MiB (0 to use the "
+                        "available memory less --reserved-ram)", int],
+                     ['reserved-ram', '', 512,
+                        "RAM in MiB left for the system when detecting "
+                        "available RAM", int],
+                     ['capacity-check-interval', '', 60,
+                        "how often (in seconds) detected capacity is checked "
+                        "for changes", int],
+                     ['cache-update-interval', '', 60,
+                        "how often (in seconds) the summary of cached files "
+                        "is sent to sioworkersd", int],
                      ['name', 'n', platform.node(), "worker name"]]
     optFlags = [['can-run-cpu-exec', None,
                     "Mark this worker as suitable for running tasks, which "
@@ -40,6 +56,9 @@ class WorkerOptions(usage.Options):
 
 class WorkerServiceMaker(object):
     """Run worker process.
+
+    SIGUSR2 toggles draining: a draining worker finishes running jobs, but
+    announces no free slots, so it gets no new ones.
     """
     implements(service.IServiceMaker, IPlugin)
     tapname = 'worker'
@@ -47,13 +66,30 @@ class WorkerServiceMaker(object):
     options = WorkerOptions
 
     def makeService(self, options):
-        return internet.TCPClient(options['host'], options['port'],
-                WorkerFactory(
-                    concurrency=options['concurrency'],
-                    available_ram_mb=options['ram'],
-                    # Twisted argument parser set this to 0 or 1.
-                    can_run_cpu_exec=bool(options['can-run-cpu-exec']),
-                    name=options['name']))
+        factory = WorkerFactory(
+                concurrency=options['concurrency'] or None,
+                available_ram_mb=options['ram'] or None,
+                # Twisted argument parser set this to 0 or 1.
+                can_run_cpu_exec=bool(options['can-run-cpu-exec']),
+                name=options['name'],
+                reserved_ram_mb=options['reserved-ram'])
+
+        # SIGUSR1 is taken by twistd for reopening logs.
+        def _toggle_draining(signum, frame):
+            reactor.callFromThread(factory.setDraining, not factory.draining)
+        signal.signal(signal.SIGUSR2, _toggle_draining)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      sandbox.drain_leases)
+
+        top = service.MultiService()
+        internet.TCPClient(options['host'], options['port'], factory) \
+                .setServiceParent(top)
+        if factory.detect_concurrency or factory.detect_ram:
+            internet.TimerService(options['capacity-check-interval'],
+                                  factory.detectCapacity).setServiceParent(top)
+        internet.TimerService(options['cache-update-interval'],
+                              factory.announceCache).setServiceParent(top)
+        return top
 
 
 class ServerOptions(usage.Options):
@@ -66,8 +102,27 @@ class ServerOptions(usage.Options):
         ['scheduler', 's', getDefaultSchedulerClassName(),
              "scheduler class"],
         ['max-task-ram', '', 2048,
-            "maximum task required RAM (in MiB) allowed by the scheduler"]
+            "maximum task required RAM (in MiB) allowed by the scheduler"],
+        ['trace-file', '', '',
+            "file to record scheduler events to (see sio.sioworkersd.trace)"],
+        ['trace-max-size', '', 64,
+            "maximum size (in MiB) of a trace file before it is rotated"],
+        ['trace-backups', '', 5, "number of rotated trace files kept"],
+        ['offload-processes', '', 0,
+            "number of processes encoding results returned to SIO and "
+            "decoding large messages from workers (0 does it in the main "
+            "process)"],
+        ['resume-timeout', '', 120,
+            "how long (in seconds) tasks of a disconnected worker wait for "
+            "it to reconnect and report them, before they are run again "
+            "elsewhere"],
+        ['stall-threshold', '', 0.5,
+            "delays of the reactor (in seconds) to log as stalls"]
     ]
+    optFlags = [['group-affinity', None,
+                    "Run tasks of one group (or with the same exe_file) on "
+                    "the same worker when possible, so that files and "
+                    "sandboxes are prepared once."]]
 
 
 class ServerServiceMaker(object):
@@ -78,7 +133,7 @@ class ServerServiceMaker(object):
 
     def makeService(self, options):
         # root service, leaf in the tree of dependency
-        workerm = WorkerManager()
+        workerm = WorkerManager(float(options['resume-timeout']))
 
         sched_module, sched_class = options['scheduler'].rsplit('.', 1)
         try:
@@ -91,19 +146,39 @@ class ServerServiceMaker(object):
             print("[ERROR] Invalid scheduler class: " + sched_class + "\n")
             raise
 
+        scheduler = SchedulerClass(workerm)
+        if options['trace-file']:
+            recorder = trace.TraceRecorder(options['trace-file'],
+                    int(options['trace-max-size']) * 2**20,
+                    int(options['trace-backups']))
+            reactor.addSystemEventTrigger('after', 'shutdown',
+                                          recorder.close)
+            scheduler = trace.TracingScheduler(scheduler, recorder)
+
+        pool = offload.ProcessPool(int(options['offload-processes']))
+        # Not before twistd daemonizes, as its threads would not survive.
+        reactor.callWhenRunning(pool.start)
+        reactor.addSystemEventTrigger('after', 'shutdown', pool.stop)
+
         taskm = TaskManager(options['database'],
                             workerm,
-                            SchedulerClass(workerm),
-                            options['max-task-ram'])
+                            scheduler,
+                            options['max-task-ram'],
+                            pool,
+                            bool(options['group-affinity']))
         taskm.setServiceParent(workerm)
 
         rpc = siorpc.makeSite(workerm, taskm)
         internet.TCPServer(int(options['rpc-port']), rpc,
                 interface=options['rpc-listen']).setServiceParent(workerm)
 
-        internet.TCPServer(int(options['worker-port']), workerm.makeFactory(),
+        internet.TCPServer(int(options['worker-port']),
+                workerm.makeFactory(pool),
                 interface=options['worker-listen']).setServiceParent(workerm)
 
+        ReactorMonitor(threshold=float(options['stall-threshold'])) \
+                .setServiceParent(workerm)
+
         return workerm
 
 